@@ -0,0 +1,361 @@
+#!/usr/bin/python3
+"""
+Benchmarks oloraculo and funes on synthetic lobbies, without a server: the
+plugins run on minqlx_fake (and persistence_fake), with the real trueskill or
+trueskill_fake.
+
+  benchmark.py --players 2,4,8,12,16,24 --matches 1000,100000,1000000 \
+      --output /tmp/benchmark.json --baseline benchmark_baseline.json
+
+Cases, for every lobby size (and history size, for funes):
+
+  oloraculo.cmd_oloraculo           !oloraculo, predictions cache cleared
+  oloraculo.get_match_qualities     every split of the lobby (exhaustive)
+  funes.get_funes_stats             every split of the lobby, this week and
+                                    since the first week
+  funes.get_teams_history           one split, since the first week
+
+Each case reports the best time of --repeat runs and the peak memory
+allocated during one more run (traced with tracemalloc, which is slow, so
+apart from the timed runs). Cases running longer than --timeout seconds are
+stopped and reported as such.
+
+Results are written as JSON:
+
+  {"trueskill": "fake", "cases": {"name": {"seconds": s, "peak_bytes": b}}}
+
+Given a --baseline (a previous output), cases slower or bigger than it by more
+than --tolerance are flagged as regressions, and the exit status is 1.
+Only what the baseline has is compared: --memory_only leaves times out of the
+output, since they depend on the machine (compare those to a baseline made on
+the same one). benchmark_baseline.json has the default cases with
+--timeout 10 --memory_only; regenerate it when a change moves them on purpose.
+"""
+
+import argparse
+import contextlib
+import datetime
+import importlib
+import itertools
+import json
+import os
+import random
+import signal
+import sys
+import tempfile
+import time
+import tracemalloc
+import minqlx_fake
+import persistence_fake
+import trueskill_fake
+
+from unittest.mock import patch
+
+sys.modules['minqlx'] = minqlx_fake
+sys.modules['persistence'] = persistence_fake
+
+FIRST_STEAM_ID = 76561198000000000
+# Players in the synthetic history; lobbies take the first ones.
+POOL_SIZE = 32
+MAPS = ['campgrounds', 'overkill', 'bloodrun', 'almostlost', 'toxicity']
+GAME_TYPES = ['ad', 'ctf', 'ca']
+# Weeks covered by the synthetic history, the last one being this week.
+WEEKS = 260
+PLAYERS = [2, 4, 8, 12, 16, 24]
+MATCHES = [1000, 10000, 100000]
+# get_match_qualities scores every split, far too slow above this by default.
+MAX_EXHAUSTIVE_PLAYERS = 16
+
+
+def log(msg):
+  sys.stderr.write('%s\n' % msg)
+
+
+def load_plugins(use_trueskill):
+  """Imports (funes, oloraculo) with the real trueskill or the fake."""
+  if not use_trueskill:
+    sys.modules['trueskill'] = trueskill_fake
+  elif sys.modules.get('trueskill') is trueskill_fake:
+    del sys.modules['trueskill']
+  return (importlib.import_module('funes'),
+          importlib.import_module('oloraculo'))
+
+
+def get_player_ids(count):
+  return [FIRST_STEAM_ID + index for index in range(count)]
+
+
+def get_week_keys(count):
+  """funes week keys of the last count weeks, oldest first."""
+  today = datetime.date.today()
+  keys = []
+  for weeks_ago in range(count - 1, -1, -1):
+    iso = (today - datetime.timedelta(weeks=weeks_ago)).isocalendar()
+    keys.append('%d-%02d' % (iso[0], iso[1]))
+  return keys
+
+
+def get_synthetic_history(match_count, seed=0):
+  """Funes history of match_count random matches, oldest first.
+
+  Half of the matches are between the first players of the pool (the
+  regulars, who make the benchmark lobbies), the rest between random ones.
+  """
+  rng = random.Random(seed)
+  pool = get_player_ids(POOL_SIZE)
+  weeks = get_week_keys(WEEKS)
+  history = []
+  for index in range(match_count):
+    players_per_team = rng.randint(1, max(PLAYERS) // 2)
+    if rng.random() < 0.5:
+      players = pool[:players_per_team * 2]
+      rng.shuffle(players)
+    else:
+      players = rng.sample(pool, players_per_team * 2)
+    scores = [rng.randint(0, 14), 15]
+    rng.shuffle(scores)
+    history.append([
+        weeks[(index + 1) * len(weeks) // match_count - 1],
+        rng.choice(MAPS),
+        rng.choice(GAME_TYPES),
+        sorted(players[:players_per_team]),
+        sorted(players[players_per_team:]),
+    ] + scores)
+  return history
+
+
+def get_synthetic_stats(seed=0):
+  """oloraculo stats of the whole pool, in every game type."""
+  rng = random.Random(seed)
+  stats = {}
+  for game_type in GAME_TYPES:
+    stats[game_type] = {
+        str(player_id): [
+            rng.uniform(15, 35),
+            rng.uniform(1, 8),
+            rng.randint(0, 500),
+            rng.randint(0, 500),
+            rng.randint(0, 20000),
+            rng.randint(0, 20000)
+        ] for player_id in get_player_ids(POOL_SIZE)
+    }
+  return stats
+
+
+class Timeout(Exception):
+  pass
+
+
+@contextlib.contextmanager
+def time_limit(seconds):
+
+  def handler(signum, frame):
+    raise Timeout()
+
+  previous = signal.signal(signal.SIGALRM, handler)
+  signal.setitimer(signal.ITIMER_REAL, seconds)
+  try:
+    yield
+  finally:
+    signal.setitimer(signal.ITIMER_REAL, 0)
+    signal.signal(signal.SIGALRM, previous)
+
+
+def measure(run, repeat, timeout):
+  """{'seconds': best time, 'peak_bytes': peak memory} of run()."""
+  try:
+    with time_limit(timeout):
+      times = []
+      for _ in range(repeat):
+        start = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - start)
+      tracemalloc.start()
+      try:
+        run()
+        peak = tracemalloc.get_traced_memory()[1]
+      finally:
+        tracemalloc.stop()
+  except Timeout:
+    return {'timeout': timeout}
+  return {'seconds': min(times), 'peak_bytes': peak}
+
+
+def set_lobby(player_count):
+  """Puts the first player_count players of the pool in red and blue."""
+  players = [
+      minqlx_fake.Player(player_id, 'player%d' % index)
+      for index, player_id in enumerate(get_player_ids(player_count))
+  ]
+  half = player_count // 2
+  minqlx_fake.Plugin.players_list = []
+  minqlx_fake.Plugin.set_players_by_team({
+      'red': players[:half],
+      'blue': players[half:]
+  })
+  return [player.steam_id for player in players]
+
+
+def get_oloraculo_cases(oloraculo, args):
+  plugin = oloraculo.oloraculo()
+  for player_count in args.players:
+    player_ids = set_lobby(player_count)
+
+    def cmd_oloraculo():
+      plugin.predictions_cache.clear()
+      minqlx_fake.Plugin.reset_log()
+      minqlx_fake.call_command('!oloraculo')
+
+    yield ('oloraculo.cmd_oloraculo/players=%d' % player_count, cmd_oloraculo)
+
+    if player_count <= args.max_exhaustive_players:
+      ratings = plugin.get_players_ratings(player_ids)
+      yield ('oloraculo.get_match_qualities/players=%d' % player_count,
+             lambda: plugin.get_match_qualities(player_ids, ratings))
+
+
+def get_funes_cases(funes, args, history_file_name):
+  for match_count in args.matches:
+    with open(history_file_name, 'w') as history_file:
+      for record in get_synthetic_history(match_count):
+        history_file.write(funes.encode_record(record))
+    minqlx_fake.reset()
+    plugin = funes.funes()
+
+    for player_count in args.players:
+      player_ids = set_lobby(player_count)
+      suffix = 'players=%d,matches=%d' % (player_count, match_count)
+      teams = (player_ids[:player_count // 2], player_ids[player_count // 2:])
+      yield ('funes.get_funes_stats/%s' % suffix,
+             lambda: plugin.get_funes_stats(player_ids, 'ad'))
+      yield ('funes.get_teams_history/%s' % suffix,
+             lambda: plugin.get_teams_history('ad', teams, aggregate=True))
+
+
+def run_benchmarks(args):
+  funes, oloraculo = load_plugins(args.trueskill == 'real')
+  results = {}
+  with tempfile.TemporaryDirectory() as directory, \
+      contextlib.ExitStack() as stack:
+    stats_file_name = os.path.join(directory, 'oloraculo_stats.json')
+    history_file_name = os.path.join(directory, 'funes_history.jsonl')
+    with open(stats_file_name, 'w') as stats_file:
+      stats_file.write(json.dumps(get_synthetic_stats()))
+    for module, name, value in [
+        (oloraculo, 'JSON_FILE_PATH', stats_file_name),
+        (oloraculo, 'LOG_FILE_PATH', stats_file_name + '.log'),
+        (oloraculo, 'HISTORY_PATH', os.path.join(directory, 'history')),
+        (funes, 'HISTORY_FILE_PATH', history_file_name),
+        (funes, 'JSON_FILE_PATH', os.path.join(directory, 'none.json')),
+    ]:
+      stack.enter_context(patch.object(module, name, value))
+
+    minqlx_fake.reset()
+    # Lazily: each case runs before the next one sets its lobby up.
+    for name, run in itertools.chain(
+        get_oloraculo_cases(oloraculo, args),
+        get_funes_cases(funes, args, history_file_name)):
+      if args.filter and args.filter not in name:
+        continue
+      results[name] = measure(run, args.repeat, args.timeout)
+      log(format_result(name, results[name]))
+  return {'trueskill': args.trueskill, 'cases': results}
+
+
+def format_result(name, result):
+  if 'timeout' in result:
+    return '%-56s timeout (%ds)' % (name, result['timeout'])
+  return '%-56s %10.4fs %10.1fKB' % (name, result['seconds'],
+                                     result['peak_bytes'] / 1024.0)
+
+
+def get_regressions(results, baseline, tolerance):
+  """Cases of results slower or bigger than in baseline, as messages."""
+  regressions = []
+  for name, result in sorted(results['cases'].items()):
+    before = baseline.get('cases', {}).get(name)
+    if before is None or 'timeout' in before:
+      continue
+    if 'timeout' in result:
+      message = '%s: timeout' % name
+      if 'seconds' in before:
+        message += ', was %.4fs' % before['seconds']
+      regressions.append(message)
+      continue
+    for key, unit in [('seconds', 's'), ('peak_bytes', 'B')]:
+      if key not in before:
+        continue
+      if result[key] > before[key] * (1 + tolerance):
+        regressions.append('%s: %s %.4g%s, was %.4g%s (x%.2f)' %
+                           (name, key, result[key], unit, before[key], unit,
+                            result[key] / max(before[key], 1e-9)))
+  return regressions
+
+
+def parse_ints(value):
+  return [int(v) for v in value.split(',') if v]
+
+
+def main(args):
+  results = run_benchmarks(args)
+  if args.output:
+    output = results
+    if args.memory_only:
+      cases = {}
+      for name, result in results['cases'].items():
+        cases[name] = {k: v for k, v in result.items() if k != 'seconds'}
+      output = dict(results, cases=cases)
+    with open(args.output, 'w') as output_file:
+      output_file.write(json.dumps(output, sort_keys=True, indent=2))
+  if not args.baseline:
+    return 0
+  with open(args.baseline) as baseline_file:
+    baseline = json.loads(baseline_file.read())
+  if baseline.get('trueskill') != results['trueskill']:
+    log('Baseline used trueskill %s, comparing anyway.' %
+        baseline.get('trueskill'))
+  regressions = get_regressions(results, baseline, args.tolerance)
+  for regression in regressions:
+    log('REGRESSION %s' % regression)
+  return 1 if regressions else 0
+
+
+arg_parser = argparse.ArgumentParser(
+    description='Benchmarks oloraculo and funes on synthetic lobbies.')
+arg_parser.add_argument('--players',
+                        type=parse_ints,
+                        default=PLAYERS,
+                        help='Comma separated lobby sizes.')
+arg_parser.add_argument('--matches',
+                        type=parse_ints,
+                        default=MATCHES,
+                        help='Comma separated funes history sizes.')
+arg_parser.add_argument('--max_exhaustive_players',
+                        type=int,
+                        default=MAX_EXHAUSTIVE_PLAYERS,
+                        help='Largest lobby for get_match_qualities.')
+arg_parser.add_argument('--trueskill',
+                        type=str,
+                        choices=['fake', 'real'],
+                        default='fake')
+arg_parser.add_argument('--repeat', type=int, default=3)
+arg_parser.add_argument('--timeout',
+                        type=float,
+                        default=60,
+                        help='Seconds before a case is given up.')
+arg_parser.add_argument('--filter',
+                        type=str,
+                        default='',
+                        help='Only run cases with this in their name.')
+arg_parser.add_argument('--output', type=str, default='')
+arg_parser.add_argument('--memory_only',
+                        action='store_true',
+                        help='Leave times out of --output.')
+arg_parser.add_argument('--baseline', type=str, default='')
+arg_parser.add_argument('--tolerance',
+                        type=float,
+                        default=0.25,
+                        help='Allowed slowdown / growth, 0.25 is 25%%.')
+
+if __name__ == '__main__':
+  sys.exit(main(arg_parser.parse_args()))
@@ -0,0 +1,95 @@
+import json
+import os
+import tempfile
+import unittest
+
+import benchmark
+
+
+class TestBenchmark(unittest.TestCase):
+
+  def test_synthetic_history(self):
+    history = benchmark.get_synthetic_history(100)
+    self.assertEqual(100, len(history))
+    self.assertEqual(history, benchmark.get_synthetic_history(100))
+    for week, map_name, game_type, red, blue, red_score, blue_score in history:
+      self.assertIn(map_name, benchmark.MAPS)
+      self.assertIn(game_type, benchmark.GAME_TYPES)
+      self.assertEqual(len(red), len(blue))
+      self.assertFalse(set(red) & set(blue))
+      self.assertEqual(15, max(red_score, blue_score))
+    # Oldest first, up to this week.
+    self.assertEqual(sorted(h[0] for h in history), [h[0] for h in history])
+    self.assertEqual(benchmark.get_week_keys(1)[0], history[-1][0])
+
+  def test_run(self):
+    with tempfile.TemporaryDirectory() as directory:
+      output = os.path.join(directory, 'results.json')
+      args = benchmark.arg_parser.parse_args([
+          '--players', '2,4', '--matches', '50', '--repeat', '1', '--output',
+          output
+      ])
+      self.assertEqual(0, benchmark.main(args))
+      results = json.loads(open(output).read())
+
+    self.assertEqual('fake', results['trueskill'])
+    self.assertEqual([
+        'funes.get_funes_stats/players=2,matches=50',
+        'funes.get_funes_stats/players=4,matches=50',
+        'funes.get_teams_history/players=2,matches=50',
+        'funes.get_teams_history/players=4,matches=50',
+        'oloraculo.cmd_oloraculo/players=2',
+        'oloraculo.cmd_oloraculo/players=4',
+        'oloraculo.get_match_qualities/players=2',
+        'oloraculo.get_match_qualities/players=4',
+    ], sorted(results['cases']))
+    for result in results['cases'].values():
+      self.assertGreaterEqual(result['seconds'], 0)
+      self.assertGreater(result['peak_bytes'], 0)
+
+  def test_timeout(self):
+
+    def forever():
+      while True:
+        pass
+
+    self.assertEqual({'timeout': 0.05}, benchmark.measure(forever, 1, 0.05))
+
+  def test_regressions(self):
+    baseline = {
+        'cases': {
+            'a': {'seconds': 1.0, 'peak_bytes': 1000},
+            'b': {'seconds': 1.0, 'peak_bytes': 1000},
+            'c': {'seconds': 1.0, 'peak_bytes': 1000},
+            'd': {'timeout': 60},
+        }
+    }
+    results = {
+        'cases': {
+            'a': {'seconds': 1.2, 'peak_bytes': 900},
+            'b': {'seconds': 0.5, 'peak_bytes': 2000},
+            'c': {'timeout': 60},
+            'd': {'seconds': 10.0, 'peak_bytes': 1000},
+            'new': {'seconds': 1.0, 'peak_bytes': 1000},
+        }
+    }
+    regressions = benchmark.get_regressions(results, baseline, 0.25)
+    self.assertEqual(2, len(regressions))
+    self.assertTrue(regressions[0].startswith('b: peak_bytes'))
+    self.assertTrue(regressions[1].startswith('c: timeout'))
+    # Timeouts are always regressions.
+    self.assertEqual(['c: timeout, was 1.0000s'],
+                     benchmark.get_regressions(results, baseline, 1.5))
+
+    # Without times, as benchmark_baseline.json.
+    for case in baseline['cases'].values():
+      case.pop('seconds', None)
+    results['cases']['a']['seconds'] = 100.0
+    self.assertEqual(['b: peak_bytes', 'c: timeout'], [
+        regression[:13]
+        for regression in benchmark.get_regressions(results, baseline, 0.25)
+    ])
+
+
+if __name__ == '__main__':
+  unittest.main()
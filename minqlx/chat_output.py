@@ -0,0 +1,184 @@
+import collections
+import functools
+import minqlx
+import re
+import threading
+import time
+"""
+Batched chat output for plugin commands and hooks.
+
+Plugins mix Buffered in before minqlx.Plugin (and Instrumented):
+
+  class funes(chat_output.Buffered, instrumentation.Instrumented,
+              minqlx.Plugin):
+
+While a command or hook runs, its self.msg() lines are kept. When it
+returns they are sent as few print commands as possible: lines are wrapped at
+MAX_LINE_LENGTH and joined with newlines into messages of up to
+MAX_MESSAGE_LENGTH. Messages of every plugin then go through EMITTER, a token
+bucket of MESSAGE_RATE messages per second (up to MESSAGE_BURST at once), so
+a long stats dump can't flood the clients: what doesn't fit now is sent on a
+later frame, in order.
+
+self.msg() outside of a handler (e.g. on a minqlx.thread) is sent right
+away, still through EMITTER. player.tell() isn't buffered.
+"""
+
+# Longest line clients show before it wraps.
+MAX_LINE_LENGTH = 100
+# Longest print command the server sends.
+MAX_MESSAGE_LENGTH = 1000
+MESSAGE_RATE = 4
+MESSAGE_BURST = 8
+COLOR_REGEX = re.compile(r'\^\d')
+
+
+def wrap_line(line, limit=MAX_LINE_LENGTH):
+  """Splits line into lines of up to limit characters, on spaces if possible.
+
+  Continuation lines start with the last color of the previous one.
+  """
+  lines = []
+  color = ''
+  while len(color) + len(line) > limit:
+    line = color + line
+    cut = line.rfind(' ', len(color) + 1, limit + 1)
+    if cut == -1:
+      cut = limit
+    lines.append(line[:cut])
+    colors = COLOR_REGEX.findall(line[:cut])
+    color = colors[-1] if colors else color
+    line = line[cut:].lstrip(' ')
+  lines.append(color + line)
+  return lines
+
+
+def get_messages(lines,
+                 max_line_length=MAX_LINE_LENGTH,
+                 max_message_length=MAX_MESSAGE_LENGTH):
+  """Joins lines into as few messages as possible."""
+  messages = []
+  for line in lines:
+    for part in wrap_line(line, max_line_length):
+      if messages and len(messages[-1]) + 1 + len(part) <= max_message_length:
+        messages[-1] += '\n' + part
+      else:
+        messages.append(part)
+  return messages
+
+
+class TokenBucket(object):
+
+  def __init__(self, rate=MESSAGE_RATE, burst=MESSAGE_BURST, clock=None):
+    self.rate = rate
+    self.burst = burst
+    self.clock = clock or time.monotonic
+    self.tokens = burst
+    self.last_time = self.clock()
+
+  def refill(self):
+    now = self.clock()
+    self.tokens = min(self.burst,
+                      self.tokens + (now - self.last_time) * self.rate)
+    self.last_time = now
+
+  def take(self):
+    self.refill()
+    if self.tokens < 1:
+      return False
+    self.tokens -= 1
+    return True
+
+  def get_wait(self):
+    """Seconds until the next token."""
+    self.refill()
+    return max(0.0, (1 - self.tokens) / self.rate)
+
+
+class Emitter(object):
+  """Sends messages in order, as fast as bucket allows."""
+
+  def __init__(self, bucket=None):
+    self.bucket = bucket or TokenBucket()
+    # Guards the queue: handlers on threads print too.
+    self.lock = threading.Lock()
+    # [(send, message), ...]
+    self.queue = collections.deque()
+    self.scheduled = False
+
+  def emit(self, send, lines):
+    messages = get_messages(lines)
+    with self.lock:
+      self.queue.extend((send, message) for message in messages)
+    self.drain()
+
+  def drain(self, scheduled=False):
+    with self.lock:
+      if scheduled:
+        self.scheduled = False
+      sent = 0
+      # A scheduled drain waited for a token, it always sends one.
+      while self.queue and (self.bucket.take() or (scheduled and not sent)):
+        send, message = self.queue.popleft()
+        send(message)
+        sent += 1
+      wait = None
+      if self.queue and not self.scheduled:
+        self.scheduled = True
+        wait = self.bucket.get_wait()
+    if wait is not None:
+      minqlx.delay(wait)(self.drain_scheduled)()
+
+  def drain_scheduled(self):
+    self.drain(True)
+
+
+EMITTER = Emitter()
+# {plugin: [lines]} of the handlers running on each thread.
+BUFFERS = threading.local()
+
+
+def get_buffers():
+  if not hasattr(BUFFERS, 'lines'):
+    BUFFERS.lines = {}
+  return BUFFERS.lines
+
+
+class Buffered(object):
+  """Plugin mixin: buffers self.msg() while a command or hook runs."""
+
+  def buffer_output(self, handler):
+
+    @functools.wraps(handler)
+    def buffered(*args, **kwargs):
+      buffers = get_buffers()
+      if self in buffers:
+        # Called from another handler of this plugin, which flushes.
+        return handler(*args, **kwargs)
+      buffers[self] = []
+      try:
+        return handler(*args, **kwargs)
+      finally:
+        self.flush_output(buffers.pop(self))
+
+    return buffered
+
+  def flush_output(self, lines):
+    if lines:
+      EMITTER.emit(super().msg, lines)
+
+  def msg(self, message, *args, **kwargs):
+    lines = get_buffers().get(self)
+    if lines is None or args or kwargs:
+      send = super().msg
+      EMITTER.emit(lambda text: send(text, *args, **kwargs), [message])
+      return
+    lines.append(message)
+
+  def add_command(self, name, handler, *args, **kwargs):
+    return super().add_command(name, self.buffer_output(handler), *args,
+                               **kwargs)
+
+  def add_hook(self, event, handler, *args, **kwargs):
+    return super().add_hook(event, self.buffer_output(handler), *args,
+                            **kwargs)
@@ -0,0 +1,145 @@
+import sys
+import minqlx_fake
+import unittest
+
+from unittest.mock import patch
+
+sys.modules['minqlx'] = minqlx_fake
+import chat_output
+
+
+class FakeClock(object):
+
+  def __init__(self):
+    self.now = 0.0
+
+  def __call__(self):
+    return self.now
+
+
+class FakeScheduler(object):
+  """Replaces minqlx.delay: keeps the delayed calls until run()."""
+
+  def __init__(self):
+    self.waits = []
+    self.calls = []
+
+  def delay(self, wait):
+
+    def decorator(func):
+      self.waits.append(wait)
+      return lambda: self.calls.append(func)
+
+    return decorator
+
+  def run(self):
+    calls, self.calls = self.calls, []
+    for func in calls:
+      func()
+
+
+class Plugin(chat_output.Buffered, minqlx_fake.Plugin):
+
+  def __init__(self):
+    self.add_command('dump', self.cmd_dump)
+    self.add_hook('game_end', self.handle_game_end)
+
+  def cmd_dump(self, player, msg, channel):
+    for index in range(int(msg[1])):
+      self.msg('^5line %d' % index)
+    self.handle_game_end({})
+
+  def handle_game_end(self, data):
+    self.msg('game over')
+
+
+class TestChatOutput(unittest.TestCase):
+
+  def setUp(self):
+    minqlx_fake.reset()
+
+  def test_wrap_line(self):
+    self.assertEqual(['short'], chat_output.wrap_line('short', 10))
+    self.assertEqual(['one two', 'three'],
+                     chat_output.wrap_line('one two three', 10))
+    self.assertEqual(['abcdefghij', 'klm'],
+                     chat_output.wrap_line('abcdefghijklm', 10))
+    # Colors carry over.
+    self.assertEqual(['^1red ^2green', '^2more'],
+                     chat_output.wrap_line('^1red ^2green more', 14))
+
+  def test_get_messages(self):
+    lines = ['a' * 4, 'b' * 4, 'c' * 4, 'd' * 12]
+    self.assertEqual(['aaaa\nbbbb', 'cccc', 'dddddddddd', 'dd'],
+                     chat_output.get_messages(lines, 10, 12))
+    self.assertEqual([], chat_output.get_messages([]))
+
+  def test_token_bucket(self):
+    clock = FakeClock()
+    bucket = chat_output.TokenBucket(rate=2, burst=3, clock=clock)
+    self.assertEqual([True, True, True, False],
+                     [bucket.take() for _ in range(4)])
+    self.assertEqual(0.5, bucket.get_wait())
+    clock.now = 0.5
+    self.assertTrue(bucket.take())
+    self.assertFalse(bucket.take())
+    # Never more than burst.
+    clock.now = 100
+    self.assertEqual(3, sum(bucket.take() for _ in range(10)))
+
+  def test_emitter_rate_limit(self):
+    clock = FakeClock()
+    scheduler = FakeScheduler()
+    emitter = chat_output.Emitter(
+        chat_output.TokenBucket(rate=1, burst=2, clock=clock))
+    sent = []
+    lines = ['%02d' % index + 'x' * 78 for index in range(25)]
+    with patch.object(minqlx_fake, 'delay', scheduler.delay):
+      # 12 lines per message.
+      emitter.emit(sent.append, lines)
+      emitter.emit(sent.append, ['w'])
+      self.assertEqual(2, len(sent))
+      # One drain is scheduled for the rest, in a second.
+      self.assertEqual([1.0], scheduler.waits)
+
+      clock.now = 1.0
+      scheduler.run()
+      self.assertEqual(3, len(sent))
+      self.assertEqual([1.0, 1.0], scheduler.waits)
+
+      clock.now = 2.0
+      scheduler.run()
+      self.assertEqual(lines + ['w'], '\n'.join(sent).split('\n'))
+      self.assertEqual([], scheduler.calls)
+
+  def test_buffered(self):
+    plugin = Plugin()
+    minqlx_fake.call_command('!dump 30')
+    self.assertEqual(['line %d' % i for i in range(30)] + ['game over'],
+                     minqlx_fake.Plugin.messages)
+    self.assertEqual(1, minqlx_fake.Plugin.print_commands)
+
+    minqlx_fake.end_game()
+    self.assertEqual(2, minqlx_fake.Plugin.print_commands)
+
+    # Not in a handler: right away.
+    plugin.msg('hello')
+    self.assertEqual('hello', minqlx_fake.Plugin.messages[-1])
+    self.assertEqual(3, minqlx_fake.Plugin.print_commands)
+
+  def test_buffered_flushes_on_error(self):
+    plugin = Plugin()
+
+    def fail(player, msg, channel):
+      plugin.msg('about to fail')
+      raise ValueError()
+
+    plugin.add_command('fail', fail)
+    with self.assertRaises(ValueError):
+      minqlx_fake.call_command('!fail')
+    self.assertEqual(['about to fail'], minqlx_fake.Plugin.messages)
+    self.assertEqual({}, chat_output.get_buffers())
+
+
+if __name__ == '__main__':
+  unittest.main()
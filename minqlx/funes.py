@@ -1,30 +1,236 @@
+import array
+import collections.abc
 import datetime
-import copy
-import itertools
 import json
 import minqlx
 import os
-import re
+
+if __package__:
+  # Loaded by minqlx, as <plugins_dir>.<name>.
+  from . import chat_output
+  from . import instrumentation
+  from . import persistence
+  from . import player_names
+else:
+  import chat_output
+  import instrumentation
+  import persistence
+  import player_names
 
 HEADER_COLOR_STRING = '^2'
 SUBTITLE_COLOR_STRING = '^3'
-JSON_FILE_NAME = 'funes_history.json'
+HISTORY_FILE_NAME = 'funes_history.jsonl'
 ROOT_PATH = os.path.dirname(os.path.realpath(__file__))
+HISTORY_FILE_PATH = os.path.join(ROOT_PATH, HISTORY_FILE_NAME)
+# The whole history as a JSON list, before HISTORY_FILE_NAME. Migrated on
+# load, see migrate_history.
+JSON_FILE_NAME = 'funes_history.json'
 JSON_FILE_PATH = os.path.join(ROOT_PATH, JSON_FILE_NAME)
 IS_BOT_ID = lambda x: x > 90000000000000000
 
 
-class funes(minqlx.Plugin):
+def thaw_record(record):
+  """A history record as in the JSON file, with lists."""
+  return [list(v) if isinstance(v, tuple) else v for v in record]
+
+
+def encode_record(record):
+  """A line of HISTORY_FILE_NAME."""
+  return json.dumps(record, separators=(',', ':')) + '\n'
+
+
+class Interner(object):
+  """Small int codes of values, in order of first use."""
+
+  def __init__(self):
+    # {value: code, ...}
+    self.codes = {}
+    self.values = []
+
+  def __len__(self):
+    return len(self.values)
+
+  def get_code(self, value):
+    code = self.codes.get(value)
+    if code is None:
+      code = len(self.values)
+      self.codes[value] = code
+      self.values.append(value)
+    return code
+
+
+class History(object):
+  """History records, stored column by column.
+
+  Record N is row N of every column array. Weeks, maps and game types are
+  interned strings, steam ids are interned players and teams are interned
+  rosters: bitmasks with bit N set for player N. Records come back as tuples,
+  with teams as tuples of sorted steam ids.
+  """
+
+  def __init__(self):
+    self.weeks = Interner()
+    self.maps = Interner()
+    self.game_types = Interner()
+    self.players = Interner()
+    # Of bitmasks.
+    self.rosters = Interner()
+    # Players in each roster.
+    self.roster_sizes = array.array('H')
+    self.week_codes = array.array('H')
+    self.map_codes = array.array('H')
+    self.game_type_codes = array.array('B')
+    self.red_rosters = array.array('I')
+    self.blue_rosters = array.array('I')
+    self.red_scores = array.array('i')
+    self.blue_scores = array.array('i')
+
+  def __len__(self):
+    return len(self.week_codes)
+
+  def __getitem__(self, index):
+    return (self.weeks.values[self.week_codes[index]],
+            self.maps.values[self.map_codes[index]],
+            self.game_types.values[self.game_type_codes[index]],
+            self.get_team(self.red_rosters[index]),
+            self.get_team(self.blue_rosters[index]), self.red_scores[index],
+            self.blue_scores[index])
+
+  def append(self, record):
+    """Adds record, or raises TypeError / OverflowError and changes nothing."""
+    week_key, map_name, game_type, red_ids, blue_ids, red_score, blue_score = (
+        record)
+    # Everything that can fail, before the first interner or column changes:
+    # scores, teams that aren't sequences, values that can't be interned and
+    # new codes that don't fit their column.
+    scores = array.array('i', [red_score, blue_score])
+    red_ids = tuple(red_ids)
+    blue_ids = tuple(blue_ids)
+    for player_id in red_ids + blue_ids:
+      hash(player_id)
+    for interner, value, column in [(self.weeks, week_key, self.week_codes),
+                                    (self.maps, map_name, self.map_codes),
+                                    (self.game_types, game_type,
+                                     self.game_type_codes)]:
+      if value not in interner.codes:
+        array.array(column.typecode, [len(interner)])
+    row = [
+        self.weeks.get_code(week_key),
+        self.maps.get_code(map_name),
+        self.game_types.get_code(game_type),
+        self.get_roster(red_ids),
+        self.get_roster(blue_ids)
+    ]
+    for column, value in zip([
+        self.week_codes, self.map_codes, self.game_type_codes,
+        self.red_rosters, self.blue_rosters
+    ], row):
+      column.append(value)
+    self.red_scores.append(scores[0])
+    self.blue_scores.append(scores[1])
+
+  def find_roster(self, player_ids):
+    """Roster of player_ids, or None if they never played together."""
+    mask = 0
+    for player_id in player_ids:
+      code = self.players.codes.get(player_id)
+      if code is None:
+        return None
+      mask |= 1 << code
+    return self.rosters.codes.get(mask)
+
+  def get_mask(self, player_ids):
+    """Bitmask of the known players of player_ids."""
+    mask = 0
+    for player_id in player_ids:
+      code = self.players.codes.get(player_id)
+      if code is not None:
+        mask |= 1 << code
+    return mask
+
+  def get_roster(self, player_ids):
+    mask = 0
+    for player_id in player_ids:
+      mask |= 1 << self.players.get_code(player_id)
+    roster = self.rosters.get_code(mask)
+    if roster == len(self.roster_sizes):
+      self.roster_sizes.append(bin(mask).count('1'))
+    return roster
+
+  def get_team(self, roster):
+    """Sorted steam ids of roster."""
+    bits = bin(self.rosters.values[roster])[:1:-1]
+    return tuple(
+        sorted(self.players.values[code]
+               for code, bit in enumerate(bits)
+               if bit == '1'))
+
+
+class HistorySnapshot(collections.abc.Sequence):
+  """Read-only view of the first records of a History.
+
+  Records are only ever appended to the history, and come back as tuples, so
+  the view can share it instead of copying it. It compares equal to the same
+  history as lists (as in the JSON file).
+  """
+
+  def __init__(self, records):
+    self._records = records
+    self._length = len(records)
+
+  def __len__(self):
+    return self._length
+
+  def __getitem__(self, index):
+    if isinstance(index, slice):
+      return [self[i] for i in range(*index.indices(self._length))]
+    if index < 0:
+      index += self._length
+    if not 0 <= index < self._length:
+      raise IndexError('history index out of range')
+    return self._records[index]
+
+  def __eq__(self, other):
+    if not isinstance(other, collections.abc.Sequence):
+      return NotImplemented
+    return len(self) == len(other) and all(
+        thaw_record(record) == thaw_record(other_record)
+        for record, other_record in zip(self, other))
+
+  def __repr__(self):
+    return repr([thaw_record(record) for record in self])
+
+
+class funes(chat_output.Buffered, instrumentation.Instrumented,
+            minqlx.Plugin):
 
   def __init__(self):
-    # Dict: {'red':[id, ...], 'blue':[id, ...]}
+    # Dict: {'red': (id, ...), 'blue': (id, ...)}
     self.current_teams = {}
-    # List: [['yyyy-ww', 'map', 'gt', [r_ids], [b_ids], r_score, b_score], ...]
+    # History: [('yyyy-ww', 'map', 'gt', (r_ids), (b_ids), r_score, b_score),
+    # ...]. Only appended to, see HistorySnapshot.
     self.history = None
+    # Dict: {(game type, map or None, roster, roster): [wins, wins, week wins,
+    # week wins]}, of the first and second roster of the key (the lower code
+    # first), ever and in matchups_week. Codes are those of self.history.
+    # Matches are under their map and under None (any map).
+    self.matchups = {}
+    # Week key of the week wins in matchups.
+    self.matchups_week = None
+    # (inode, mtime, size) of the history file when last read or written.
+    self.file_signature = None
+    # Bytes of the history file in self.history.
+    self.history_offset = 0
+    # Whether the history file ended with a line without a newline.
+    self.history_partial = False
+    # Lines of our own records in the history file past history_offset. They
+    # are in self.history already, so loads skip them.
+    self.saved_lines = []
     self.load_history()
     self.add_command('funes', self.cmd_funes, 2)
     self.add_hook('game_start', self.handle_game_start)
     self.add_hook('game_end', self.handle_game_end)
+    self.add_hook('unload', self.handle_unload)
 
   def print_log(self, msg):
     self.msg('%sFunes:^7 %s' % (HEADER_COLOR_STRING, msg))
@@ -32,10 +238,6 @@ class funes(minqlx.Plugin):
   def print_error(self, msg):
     self.msg('%sFunes:^1 %s' % (HEADER_COLOR_STRING, msg))
 
-  def get_clean_name(self, name):
-    return re.sub(r'([\W]*\]v\[[\W]*|^\W+|\W+$|[^a-zA-Z0-9\ ]+.+\W$)', '',
-                  name).lower().strip()
-
   def get_week_key(self):
     iso = datetime.date.today().isocalendar()
     return '-'.join([str(iso[0]), '%02d' % iso[1]])
@@ -45,58 +247,199 @@ class funes(minqlx.Plugin):
     self.msg('%sFunes v1.0:^7 %s' % (HEADER_COLOR_STRING, message))
     self.msg('%s%s' % (HEADER_COLOR_STRING, '-' * 80))
 
+  def get_file_signature(self):
+    try:
+      stat = os.stat(HISTORY_FILE_PATH)
+    except OSError:
+      return None
+    return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+  def record_written(self, line, size):
+    """Called once line (size bytes, with padding) is in the history file.
+
+    If nothing else was appended since the last load, the history is still
+    current and the line needn't be read. Otherwise the next load reads the
+    lines in between, and skips this one.
+    """
+    signature = self.get_file_signature()
+    if (signature is not None and self.file_signature is not None and
+        signature[0] == self.file_signature[0] and
+        self.history_offset == self.file_signature[2] == signature[2] - size):
+      self.file_signature = signature
+      self.history_offset = signature[2]
+      self.saved_lines.remove(line)
+
   def load_history(self):
+    """Reads the history file, unless it didn't change since the last load.
+
+    If it only grew (other servers append to it too), just the new lines are
+    read.
+    """
+    if (not os.path.exists(HISTORY_FILE_PATH) and
+        os.path.exists(JSON_FILE_PATH)):
+      self.migrate_history()
+
+    persistence.flush(HISTORY_FILE_PATH)
+    signature = self.get_file_signature()
+    if signature is not None and signature == self.file_signature:
+      return
+
+    grew = (signature is not None and self.file_signature is not None and
+            signature[0] == self.file_signature[0] and
+            signature[2] > self.file_signature[2])
+    if not grew:
+      # A new one: snapshots of the old one stay as they were.
+      self.history = History()
+      self.history_offset = 0
+      self.saved_lines = []
+    loaded = len(self.history)
     try:
-      self.history = json.loads(open(JSON_FILE_PATH).read())
-      self.print_log('Loaded %s history events.' % len(self.history))
+      self.history_offset, invalid = self.read_history(self.history_offset)
     except Exception as e:
       self.print_error('Could not load history (%s)' % e)
-      self.history = []
+      self.history = History()
+      self.history_offset, invalid = 0, 0
+      grew = False
+    self.file_signature = signature
+
+    if grew:
+      for index in range(loaded, len(self.history)):
+        self.index_record(index)
+      self.print_log('Loaded %s new history events.' %
+                     (len(self.history) - loaded))
+    else:
+      self.index_history()
+      self.print_log('Loaded %s history events.' % len(self.history))
+    if invalid:
+      self.print_error('Skipped %d invalid history lines.' % invalid)
+
+  def read_history(self, offset):
+    """Adds the records of the history file from offset on to the history.
+
+    Offsets are in bytes. A last line without a newline may still be being
+    written: it is left for the next load. Returns (offset read up to,
+    invalid lines).
+    """
+    invalid = 0
+    self.history_partial = False
+    with open(HISTORY_FILE_PATH, 'rb') as history_file:
+      history_file.seek(offset)
+      for line in history_file:
+        if not line.endswith(b'\n'):
+          self.history_partial = True
+          break
+        offset += len(line)
+        if line == b'\n':
+          # See save_record.
+          continue
+        if line in self.saved_lines:
+          self.saved_lines.remove(line)
+          continue
+        try:
+          datum = json.loads(line)
+        except ValueError:
+          invalid += 1
+          continue
+        if not isinstance(datum, list) or len(datum) != 7:
+          invalid += 1
+          continue
+        try:
+          self.history.append(datum)
+        except (TypeError, OverflowError):
+          invalid += 1
+    return offset, invalid
+
+  def migrate_history(self):
+    """Writes the history in JSON_FILE_NAME to HISTORY_FILE_NAME.
+
+    The old file is left as it was, but isn't read again.
+    """
+    try:
+      history = json.loads(open(JSON_FILE_PATH).read())
+    except Exception as e:
+      self.print_error('Could not migrate history (%s)' % e)
+      return
     # fix "legacy" entries (i.e. those without mapname in 2nd index)
-    for datum in self.history:
+    for datum in history:
       if len(datum) == 6:
         datum.insert(1, '')
-
-  def save_history(self):
-    open(JSON_FILE_PATH,
-         'w+').write(json.dumps(self.history, sort_keys=True, indent=2))
+    persistence.save(HISTORY_FILE_PATH,
+                     ''.join(encode_record(datum) for datum in history))
+    self.print_log('Migrated %d history events from %s.' %
+                   (len(history), JSON_FILE_NAME))
+
+  def index_history(self):
+    """Rebuilds matchups, with the wins of this week."""
+    self.matchups = {}
+    self.matchups_week = self.get_week_key()
+    for index in range(len(self.history)):
+      self.index_record(index)
+
+  def index_record(self, index):
+    """Adds record index of self.history to matchups."""
+    history = self.history
+    red_score = history.red_scores[index]
+    blue_score = history.blue_scores[index]
+    if red_score == blue_score:
+      return
+    red = history.red_rosters[index]
+    blue = history.blue_rosters[index]
+    rosters = (red, blue) if red <= blue else (blue, red)
+    winner = int((red if red_score > blue_score else blue) != rosters[0])
+    this_week = (history.week_codes[index] == history.weeks.codes.get(
+        self.matchups_week))
+    game_type = history.game_type_codes[index]
+    for map_code in set([history.map_codes[index], None]):
+      wins = self.matchups.get((game_type, map_code) + rosters)
+      if wins is None:
+        wins = [0, 0, 0, 0]
+        self.matchups[(game_type, map_code) + rosters] = wins
+      wins[winner] += 1
+      if this_week:
+        wins[2 + winner] += 1
+
+  def save_record(self, record):
+    """Appends record, already in self.history, to the history file."""
+    data = encode_record(record)
+    line = data.encode()
+    if self.history_partial:
+      # Left by a crash, or finished by now (and this adds a blank line):
+      # either way the record mustn't be written at the end of that line.
+      data = '\n' + data
+      self.history_partial = False
+    self.saved_lines.append(line)
+    size = len(data.encode())
+    persistence.append(HISTORY_FILE_PATH, data,
+                       lambda: self.record_written(line, size))
     self.print_log('History saved.')
 
+  def handle_unload(self, plugin):
+    persistence.flush()
+
   def get_history(self):
-    return copy.deepcopy(self.history)
+    return HistorySnapshot(self.history)
 
   def get_teams_history(self, game_type, teams, map_name=None, aggregate=False):
-    relevant_matches = []
-    week_key = self.get_week_key()
-    team_0_ids = sorted(teams[0])
-    team_1_ids = sorted(teams[1])
-
-    history = [0, 0]
-    for match in self.history:
-      if not aggregate and match[0] != week_key:
-        # don't need this date
-        continue
-
-      if map_name and match[1] != map_name:
-        # wrong map
-        continue
-
-      if match[2] != game_type:
-        # wrong game type
-        continue
-
-      if not (team_0_ids in match and team_1_ids in match):
-        # wrong teams
-        continue
-
-      team_0_score = match[match.index(team_0_ids) + 2]
-      team_1_score = match[match.index(team_1_ids) + 2]
-      if team_0_score > team_1_score:
-        history[0] += 1
-      elif team_0_score < team_1_score:
-        history[1] += 1
-
-    return history
+    if self.matchups_week != self.get_week_key():
+      # Week wins are of another week.
+      self.index_history()
+
+    history = self.history
+    game_type_code = history.game_types.codes.get(game_type)
+    map_code = history.maps.codes.get(map_name) if map_name else None
+    rosters = [history.find_roster(teams[0]), history.find_roster(teams[1])]
+    if (game_type_code is None or (map_name and map_code is None) or
+        None in rosters):
+      return [0, 0]
+
+    swapped = rosters[1] < rosters[0]
+    if swapped:
+      rosters.reverse()
+    wins = self.matchups.get((game_type_code, map_code) + tuple(rosters))
+    if wins is None:
+      return [0, 0]
+    wins = wins[:2] if aggregate else wins[2:]
+    return [wins[1], wins[0]] if swapped else wins
 
   def get_first_week(self):
     if len(self.history) > 0:
@@ -111,7 +454,11 @@ class funes(minqlx.Plugin):
     self.load_history()
 
     teams = self.teams()
-    self.current_teams = copy.deepcopy(teams)
+    # Just the ids, the players may be gone at game end.
+    self.current_teams = {
+        team: tuple(p.steam_id for p in teams.get(team, []))
+        for team in ['red', 'blue']
+    }
     red_team = teams['red']
     blue_team = teams['blue']
     if len(red_team) == 0 or len(blue_team) == 0:
@@ -130,9 +477,9 @@ class funes(minqlx.Plugin):
                                        map_name=self.game.map)
 
     red_names = ', '.join(
-        sorted([self.get_clean_name(p.clean_name) for p in red_team]))
+        sorted([player_names.DIRECTORY.add(p) for p in red_team]))
     blue_names = ', '.join(
-        sorted([self.get_clean_name(p.clean_name) for p in blue_team]))
+        sorted([player_names.DIRECTORY.add(p) for p in blue_team]))
 
     self.print_header('teams history (%s, %s)' % (game_type, map_name))
     self.msg('  ^1%s^7 ^3%d^7 v ^3%d^7 ^4%s^7' %
@@ -175,7 +522,7 @@ class funes(minqlx.Plugin):
     }
     """
 
-    teams = copy.deepcopy(self.current_teams)
+    teams = self.current_teams
     self.current_teams = {}
 
     if data['ABORTED']:
@@ -206,49 +553,80 @@ class funes(minqlx.Plugin):
       self.print_log('Not updating history: no team won.')
       return
 
-    red_team = teams['red']
-    blue_team = teams['blue']
-    if len(red_team) == 0 or len(blue_team) == 0:
+    red_ids = teams.get('red', ())
+    blue_ids = teams.get('blue', ())
+    if len(red_ids) == 0 or len(blue_ids) == 0:
       self.print_log('Not updating history: one or more empty teams.')
       return
 
-    datum = [
-        self.get_week_key(), data['MAP'], game_type,
-        sorted([p.steam_id for p in red_team]),
-        sorted([p.steam_id for p in blue_team]), self.game.red_score,
-        self.game.blue_score
-    ]
+    datum = (self.get_week_key(), data['MAP'], game_type,
+             tuple(sorted(red_ids)), tuple(sorted(blue_ids)),
+             self.game.red_score, self.game.blue_score)
 
     self.history.append(datum)
+    self.index_record(len(self.history) - 1)
     self.print_log('History updated.')
-    self.save_history()
+    self.save_record(datum)
 
   def get_funes_stats(self, players_present, game_type, map_name=None):
+    history = self.history
     players_per_team = int(len(players_present) / 2)
-    teams = list(
-        itertools.combinations(sorted(players_present), players_per_team))
+    present = history.get_mask(players_present)
+    week_code = history.weeks.codes.get(self.get_week_key())
+    game_type_code = history.game_types.codes.get(game_type)
+    map_code = history.maps.codes.get(map_name) if map_name else None
+    if game_type_code is None or (map_name and map_code is None):
+      return [], []
+
+    # Dict: {roster: whether it's players_per_team players present}.
+    eligible = {}
+
+    def is_eligible(roster):
+      if roster not in eligible:
+        eligible[roster] = (
+            history.roster_sizes[roster] == players_per_team and
+            not history.rosters.values[roster] & ~present)
+      return eligible[roster]
+
+    # Dict: {(roster a, roster b): [week wins a, b, wins a, b]}, a <= b.
+    matchups = {}
+    for week, map_index, game_type_index, red, blue, red_score, blue_score in (
+        zip(history.week_codes, history.map_codes, history.game_type_codes,
+            history.red_rosters, history.blue_rosters, history.red_scores,
+            history.blue_scores)):
+      if (game_type_index != game_type_code or
+          (map_name and map_index != map_code) or red_score == blue_score):
+        continue
 
-    seen_matches = set()
-    day_line_data = []
-    aggregated_line_data = []
+      if (not is_eligible(red) or not is_eligible(blue) or
+          history.rosters.values[red] & history.rosters.values[blue]):
+        continue
 
-    for team_a in teams:
-      for team_b in teams:
-        match_key = repr(sorted((sorted(team_a), sorted(team_b))))
-        if list(set(team_a) & set(team_b)) or match_key in seen_matches:
-          continue
+      rosters = (red, blue) if red <= blue else (blue, red)
+      winner = red if red_score > blue_score else blue
+      winner = int(winner != rosters[0])
+      wins = matchups.setdefault(rosters, [0, 0, 0, 0])
+      wins[2 + winner] += 1
+      if week == week_code:
+        wins[winner] += 1
+
+    # In the order of itertools.combinations of the sorted players.
+    lines = []
+    for (roster_a, roster_b), wins in matchups.items():
+      team_a = history.get_team(roster_a)
+      team_b = history.get_team(roster_b)
+      if team_b < team_a:
+        team_a, team_b = team_b, team_a
+        wins = [wins[1], wins[0], wins[3], wins[2]]
+      lines.append((team_a, team_b, wins))
+    lines.sort()
 
-        seen_matches.add(match_key)
-        history = self.get_teams_history(game_type, (team_a, team_b),
-                                         map_name=map_name)
-        aggregate = self.get_teams_history(game_type, (team_a, team_b),
-                                           map_name=map_name,
-                                           aggregate=True)
-        if history != [0, 0]:
-          day_line_data.append((team_a, history[0], history[1], team_b))
-        if aggregate != [0, 0]:
-          aggregated_line_data.append(
-              (team_a, aggregate[0], aggregate[1], team_b))
+    day_line_data = []
+    aggregated_line_data = []
+    for team_a, team_b, wins in lines:
+      if wins[0] or wins[1]:
+        day_line_data.append((team_a, wins[0], wins[1], team_b))
+      aggregated_line_data.append((team_a, wins[2], wins[3], team_b))
 
     def line_sorter(line):
       return -(line[1] + line[2])
@@ -260,15 +638,11 @@ class funes(minqlx.Plugin):
 
   def print_history(self, map_name, players_present, day_line_data,
                     aggregated_line_data):
-    names_by_id = dict(
-        zip(players_present, [
-            self.get_clean_name(p.clean_name)
-            for p in self.players()
-            if p.team in ['red', 'blue']
-        ]))
+    player_names.DIRECTORY.add_players(
+        [p for p in self.players() if p.team in ['red', 'blue']])
 
     def team_str(team):
-      return ', '.join([names_by_id[i] for i in team])
+      return ', '.join([player_names.DIRECTORY.get(i) for i in team])
 
     today_str = 'This week:'
     if len(day_line_data) > 0:
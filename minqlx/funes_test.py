@@ -1,8 +1,11 @@
-import copy
 import datetime
+import itertools
 import json
 import minqlx_fake
+import os
+import persistence_fake
 import sys
+import tempfile
 import unittest
 
 from unittest.mock import mock_open
@@ -10,6 +13,7 @@ from unittest.mock import patch
 from unittest.mock import MagicMock
 
 sys.modules['minqlx'] = minqlx_fake
+sys.modules['persistence'] = persistence_fake
 import funes
 
 BOT_ID = 90000000000000123
@@ -70,23 +74,63 @@ HISTORY_DATA = [
     ['2018-11', 'patio', 'ad', [13, 14, 16], [10, 12, 15], 16, 14],
 ]
 
-HISTORY_JSON = json.dumps(HISTORY_DATA)
+HISTORY_JSONL = ''.join(
+    json.dumps(datum) + '\n' for datum in HISTORY_DATA).encode()
+
+
+def get_funes_stats_by_partitions(fun, players_present, game_type, map_name):
+  """funes.get_funes_stats, one get_teams_history per split of the lobby."""
+  teams = list(
+      itertools.combinations(sorted(players_present),
+                             len(players_present) // 2))
+  day_line_data = []
+  aggregated_line_data = []
+  for index, team_a in enumerate(teams):
+    for team_b in teams[index + 1:]:
+      if set(team_a) & set(team_b):
+        continue
+      for aggregate, line_data in [(False, day_line_data),
+                                   (True, aggregated_line_data)]:
+        history = fun.get_teams_history(game_type, (team_a, team_b),
+                                        map_name=map_name,
+                                        aggregate=aggregate)
+        if history != [0, 0]:
+          line_data.append((team_a, history[0], history[1], team_b))
+  day_line_data.sort(key=lambda line: -(line[1] + line[2]))
+  aggregated_line_data.sort(key=lambda line: -(line[1] + line[2]))
+  return day_line_data, aggregated_line_data
 
 
 class FakeFile(object):
 
   def __init__(self, data):
     self._data = data
+    self._offset = 0
 
-  def read(self):
-    return self._data
+  def open(self, mode):
+    if mode == 'w':
+      self._data = b''
+    self._offset = 0
+    return self
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    pass
+
+  def __iter__(self):
+    return iter(self._data[self._offset:].splitlines(True))
+
+  def seek(self, offset):
+    self._offset = offset
 
   def write(self, data):
-    self._data = data
+    self._data += data.encode()
 
 
 def fake_open(fake):
-  return lambda file_name, mode=None: fake
+  return lambda file_name, mode='r': fake.open(mode)
 
 
 class FakeDateWeek10(datetime.date):
@@ -118,12 +162,14 @@ class TestFunes(unittest.TestCase):
     self.assertFalse(
         [line for line in minqlx_fake.Plugin.messages if txt in line])
 
-  def assertSavedJson(self, expected, mocked_open):
+  def assertAppendedRecord(self, expected, mocked_open):
+    mocked_open.assert_called_with(funes.HISTORY_FILE_PATH, 'a')
     file_handle = mocked_open.return_value.__enter__.return_value
-    first_write = file_handle.write.call_args_list[0]
-    write_arguments = first_write[0]
-    saved_json = write_arguments[0]
-    self.assertEqual(expected, json.loads(saved_json))
+    self.assertEqual(1, file_handle.write.call_count)
+    line = file_handle.write.call_args[0][0]
+    self.assertEqual(1, line.count('\n'))
+    self.assertTrue(line.endswith('\n'))
+    self.assertEqual(expected, json.loads(line))
 
   def team(self, ids):
     return [PLAYER_ID_MAP[id] for id in ids]
@@ -134,10 +180,51 @@ class TestFunes(unittest.TestCase):
     self.assertEqual(['funes'],
                      [cmd[0] for cmd in minqlx_fake.Plugin.registered_commands])
 
-    self.assertEqual(['game_start', 'game_end'],
+    self.assertEqual(['game_start', 'game_end', 'unload'],
                      [hook[0] for hook in minqlx_fake.Plugin.registered_hooks])
 
-  @patch('builtins.open', mock_open(read_data=HISTORY_JSON))
+  def test_history(self):
+    history = funes.History()
+    for datum in HISTORY_DATA:
+      history.append(datum)
+    self.assertEqual(HISTORY_DATA, [funes.thaw_record(r) for r in history])
+    self.assertEqual(('2018-11', 'patio', 'ad', (13, 14, 16), (10, 12, 15),
+                      16, 14), history[-1])
+    self.assertEqual(5, len(history.weeks))
+    self.assertEqual(2, len(history.maps))
+    self.assertEqual(8, len(history.players))
+    # Same team, same roster.
+    self.assertEqual(history.red_rosters[6], history.red_rosters[-1])
+    # 10 and 11 are the first players, 99 isn't in the history.
+    self.assertEqual(0b11, history.get_mask([10, 11, 99]))
+
+    # Invalid records change nothing.
+    def get_sizes():
+      return [
+          len(history), len(history.blue_scores), len(history.weeks),
+          len(history.maps), len(history.game_types), len(history.players),
+          len(history.rosters), len(history.roster_sizes)
+      ]
+
+    sizes = get_sizes()
+    for datum in [['2019-01', 'nueva', 'ca', [98], [99], 'x', 1],
+                  ['2019-01', 'nueva', 'ca', [98], [99], 2**40, 1],
+                  ['2019-01', 'nueva', 'ca', [98, [10]], [99], 2, 1],
+                  ['2019-01', 'nueva', 'ca', [98], 99, 2, 1],
+                  ['2019-01', ['nueva'], 'ca', [98], [99], 2, 1]]:
+      with self.assertRaises((TypeError, OverflowError)):
+        history.append(datum)
+      self.assertEqual(sizes, get_sizes())
+
+    # Nor do codes that don't fit.
+    for index in range(256 - len(history.game_types)):
+      history.append(['2018-12', 'playa', str(index), [10], [11], 2, 1])
+    sizes = get_sizes()
+    with self.assertRaises(OverflowError):
+      history.append(['2018-12', 'playa', 'one too many', [98], [99], 2, 1])
+    self.assertEqual(sizes, get_sizes())
+
+  @patch('builtins.open', mock_open(read_data=HISTORY_JSONL))
   def test_loads_history(self):
     fun = funes.funes()
     self.assertEqual(HISTORY_DATA, fun.get_history())
@@ -152,12 +239,158 @@ class TestFunes(unittest.TestCase):
     self.assertEqual([0, 0], fun.get_teams_history('ad', teams))
     self.assertEqual([0, 0], fun.get_teams_history('ad', teams, aggregate=True))
 
-  @patch('builtins.open', mock_open(read_data='[["1","c",[2,3],[4,5],6,7]]'))
-  def test_loads_history_legacy(self):
+  @patch('builtins.open',
+         mock_open(read_data=b'invalid\n' + HISTORY_JSONL + b'["2019-01", "p'))
+  def test_loads_history_invalid_lines(self):
     fun = funes.funes()
-    self.assertEqual([['1', '', 'c', [2, 3], [4, 5], 6, 7]], fun.get_history())
+    # The last line is still being written.
+    self.assertEqual(HISTORY_DATA, fun.get_history())
+    self.assertInMessages('Skipped 1 invalid history lines.')
+
+  def test_saves_history_after_partial_line(self):
+    with tempfile.TemporaryDirectory() as directory:
+      file_name = os.path.join(directory, 'funes_history.jsonl')
+      open(file_name, 'wb').write(HISTORY_JSONL + b'["2019-01", "p')
+      with patch('funes.HISTORY_FILE_PATH', file_name):
+        fun = funes.funes()
+        self.assertEqual(HISTORY_DATA, fun.get_history())
+        minqlx_fake.run_game(PLAYER_ID_MAP, MAP_NAME, [15, 12], [13, 16], 7,
+                             15)
+
+        # a crash left the partial line: it's skipped, not the new record
+        minqlx_fake.reset()
+        fun = funes.funes()
+        self.assertEqual(len(HISTORY_DATA) + 1, len(fun.get_history()))
+        self.assertEqual(['patio', 'ad', [12, 15], [13, 16], 7, 15],
+                         funes.thaw_record(fun.get_history()[-1])[1:])
+        self.assertInMessages('Skipped 1 invalid history lines.')
+
+        # or another server finished it in the meantime
+        open(file_name, 'wb').write(HISTORY_JSONL[:-20])
+        minqlx_fake.reset()
+        fun = funes.funes()
+        with open(file_name, 'ab') as history_file:
+          history_file.write(HISTORY_JSONL[-20:])
+        fun.save_record(HISTORY_DATA[0])
+        minqlx_fake.reset()
+        fun = funes.funes()
+        self.assertEqual(HISTORY_DATA + HISTORY_DATA[:1], fun.get_history())
+        self.assertNotInMessages('invalid')
 
-  @patch('builtins.open', new_callable=mock_open, read_data=HISTORY_JSON)
+  @patch('datetime.date', FakeDateWeek10)
+  def test_reloads_history(self):
+    with tempfile.TemporaryDirectory() as directory:
+      file_name = os.path.join(directory, 'funes_history.jsonl')
+      open(file_name, 'wb').write(HISTORY_JSONL[:-1])
+      with patch('funes.HISTORY_FILE_PATH', file_name):
+        fun = funes.funes()
+        history = fun.history
+        self.assertEqual(HISTORY_DATA[:-1], fun.get_history())
+
+        # Unchanged: nothing is read.
+        with patch('funes.open', side_effect=AssertionError, create=True):
+          fun.load_history()
+        self.assertIs(history, fun.history)
+
+        # Grown: only the new lines are read.
+        new_datum = [
+            '2018-10', 'playa', 'ad', [10, 11, 12], [13, 14, 15], 9, 15
+        ]
+        with open(file_name, 'a') as history_file:
+          history_file.write('\n' + json.dumps(new_datum) + '\n')
+        teams = ([10, 11, 12], [13, 14, 15])
+        self.assertEqual([1, 0], fun.get_teams_history('ad', teams))
+        with patch.object(funes.History,
+                          'append',
+                          autospec=True,
+                          side_effect=funes.History.append) as append:
+          fun.load_history()
+        self.assertEqual(2, append.call_count)
+        self.assertIs(history, fun.history)
+        self.assertEqual(HISTORY_DATA + [new_datum], fun.get_history())
+        self.assertEqual([1, 1], fun.get_teams_history('ad', teams))
+
+        # Our own records aren't read again.
+        minqlx_fake.run_game(PLAYER_ID_MAP, MAP_NAME, teams[0], teams[1], 15,
+                             3)
+        self.assertEqual(len(HISTORY_DATA) + 2, len(fun.get_history()))
+        self.assertEqual([2, 1], fun.get_teams_history('ad', teams))
+        with patch.object(funes.History, 'append') as append:
+          fun.load_history()
+        self.assertEqual(0, append.call_count)
+
+        # Replaced: read again.
+        snapshot = fun.get_history()
+        persistence_fake.save(file_name, HISTORY_JSONL.decode())
+        fun.load_history()
+        self.assertIsNot(history, fun.history)
+        self.assertEqual(HISTORY_DATA, fun.get_history())
+        self.assertEqual(len(HISTORY_DATA) + 2, len(snapshot))
+
+  def test_reloads_history_other_server(self):
+    with tempfile.TemporaryDirectory() as directory:
+      file_name = os.path.join(directory, 'funes_history.jsonl')
+      open(file_name, 'wb').write(HISTORY_JSONL)
+      with patch('funes.HISTORY_FILE_PATH', file_name):
+        fun = funes.funes()
+        # another server saves a match, then this one
+        other_datum = HISTORY_DATA[1]
+        with open(file_name, 'a') as history_file:
+          history_file.write(json.dumps(other_datum) + '\n')
+        datum = HISTORY_DATA[0]
+        fun.history.append(datum)
+        fun.save_record(datum)
+
+        # only the other one is read
+        fun.load_history()
+        expected = HISTORY_DATA + [datum, other_datum]
+        self.assertEqual(expected, fun.get_history())
+        fun.load_history()
+        self.assertEqual(expected, fun.get_history())
+        minqlx_fake.reset()
+        self.assertEqual(HISTORY_DATA + [other_datum, datum],
+                         funes.funes().get_history())
+
+  def test_migrates_history(self):
+    with tempfile.TemporaryDirectory() as directory:
+      json_file_name = os.path.join(directory, 'funes_history.json')
+      history_file_name = os.path.join(directory, 'funes_history.jsonl')
+      legacy = [['1', 'c', [2, 3], [4, 5], 6, 7]]
+      open(json_file_name, 'w').write(
+          json.dumps(HISTORY_DATA + legacy, indent=2))
+      with patch('funes.JSON_FILE_PATH', json_file_name), \
+          patch('funes.HISTORY_FILE_PATH', history_file_name):
+        fun = funes.funes()
+        expected = HISTORY_DATA + [['1', '', 'c', [2, 3], [4, 5], 6, 7]]
+        self.assertEqual(expected, fun.get_history())
+        self.assertEqual(expected,
+                         [json.loads(line) for line in open(history_file_name)])
+        self.assertInMessages('Migrated 38 history events')
+
+        # Only once.
+        minqlx_fake.Plugin.reset_log()
+        os.remove(json_file_name)
+        fun = funes.funes()
+        self.assertEqual(expected, fun.get_history())
+        self.assertNotInMessages('Migrated')
+
+  @patch('builtins.open', new_callable=mock_open, read_data=HISTORY_JSONL)
+  @patch('datetime.date', FakeDateWeek10)
+  def test_get_history_snapshot(self, m):
+    fun = funes.funes()
+    history = fun.get_history()
+    minqlx_fake.run_game(PLAYER_ID_MAP, MAP_NAME, [15, 12], [13, 16], 15, 14)
+
+    self.assertEqual(HISTORY_DATA, history)
+    self.assertEqual(len(HISTORY_DATA) + 1, len(fun.get_history()))
+    self.assertEqual(['2018-10', MAP_NAME, 'ad', [12, 15], [13, 16], 15, 14],
+                     funes.thaw_record(fun.get_history()[-1]))
+    with self.assertRaises(TypeError):
+      history[0][3][0] = 99
+    with self.assertRaises(IndexError):
+      history[len(HISTORY_DATA)]
+
+  @patch('builtins.open', new_callable=mock_open, read_data=HISTORY_JSONL)
   @patch('datetime.date', FakeDateWeek4)
   def test_saves_history_new_date(self, m):
     fun = funes.funes()
@@ -167,11 +400,10 @@ class TestFunes(unittest.TestCase):
     blue_ids = [13, 16]
     minqlx_fake.run_game(PLAYER_ID_MAP, MAP_NAME, red_ids, blue_ids, 7, 15)
 
-    expected = copy.deepcopy(HISTORY_DATA)
-    expected.append(['2018-04', MAP_NAME, 'ad', [12, 15], [13, 16], 7, 15])
-    self.assertSavedJson(expected, m)
+    self.assertAppendedRecord(
+        ['2018-04', MAP_NAME, 'ad', [12, 15], [13, 16], 7, 15], m)
 
-  @patch('builtins.open', new_callable=mock_open, read_data=HISTORY_JSON)
+  @patch('builtins.open', new_callable=mock_open, read_data=HISTORY_JSONL)
   @patch('datetime.date', FakeDateWeek10)
   def test_saves_history_same_date(self, m):
     fun = funes.funes()
@@ -180,11 +412,10 @@ class TestFunes(unittest.TestCase):
     blue_ids = [13, 16]
     minqlx_fake.run_game(PLAYER_ID_MAP, MAP_NAME, red_ids, blue_ids, 15, 14)
 
-    expected = copy.deepcopy(HISTORY_DATA)
-    expected.append(['2018-10', MAP_NAME, 'ad', [12, 15], [13, 16], 15, 14])
-    self.assertSavedJson(expected, m)
+    self.assertAppendedRecord(
+        ['2018-10', MAP_NAME, 'ad', [12, 15], [13, 16], 15, 14], m)
 
-  @patch('builtins.open', mock_open(read_data=HISTORY_JSON))
+  @patch('builtins.open', mock_open(read_data=HISTORY_JSONL))
   @patch('datetime.date', FakeDateWeek10)
   def test_get_teams_history(self):
     fun = funes.funes()
@@ -197,7 +428,47 @@ class TestFunes(unittest.TestCase):
     self.assertEqual([0, 1], fun.get_teams_history('ad', teams))
     self.assertEqual([2, 5], fun.get_teams_history('ad', teams, aggregate=True))
 
-  @patch('builtins.open', mock_open(read_data=HISTORY_JSON))
+  @patch('builtins.open', mock_open(read_data=HISTORY_JSONL))
+  @patch('datetime.date', FakeDateWeek10)
+  def test_get_teams_history_map(self):
+    fun = funes.funes()
+    teams = ((10, 12, 15), (11, 13, 14))
+    self.assertEqual([4, 2], fun.get_teams_history('ad', teams))
+    self.assertEqual([2, 1], fun.get_teams_history('ad', teams, 'patio'))
+    self.assertEqual([5, 2], fun.get_teams_history('ad', teams,
+                                                   aggregate=True))
+    self.assertEqual([2, 1],
+                     fun.get_teams_history('ad', teams, 'patio',
+                                           aggregate=True))
+    self.assertEqual([0, 0], fun.get_teams_history('ca', teams,
+                                                   aggregate=True))
+    self.assertEqual([0, 0],
+                     fun.get_teams_history('ad', teams, 'nowhere',
+                                           aggregate=True))
+
+    # Another week.
+    with patch('datetime.date', FakeDateWeek4):
+      self.assertEqual([0, 0], fun.get_teams_history('ad', teams))
+      self.assertEqual([5, 2], fun.get_teams_history('ad', teams,
+                                                     aggregate=True))
+    self.assertEqual([4, 2], fun.get_teams_history('ad', teams))
+
+  @patch('builtins.open', mock_open(read_data=HISTORY_JSONL))
+  def test_get_funes_stats(self):
+    fun = funes.funes()
+    lobbies = [[10, 11, 12, 13, 14, 15], [16, 15, 14, 13, 12, 11, 10],
+               [10, 15, 11, 13], [10, 11, 12, 13, 14, 15, 16, 17], [10]]
+    for date in [FakeDateWeek10, FakeDateWeek4]:
+      with patch('datetime.date', date):
+        for players, map_name in itertools.product(lobbies,
+                                                   [None, 'patio']):
+          self.assertEqual(
+              get_funes_stats_by_partitions(fun, players, 'ad', map_name),
+              fun.get_funes_stats(players, 'ad', map_name))
+    self.assertEqual(([], [((10, 12), 0, 1, (15, 16))]),
+                     fun.get_funes_stats([10, 12, 15, 16], 'ctf'))
+
+  @patch('builtins.open', mock_open(read_data=HISTORY_JSONL))
   @patch('datetime.date', FakeDateWeek10)
   def test_handles_game_start(self):
     map_name = 'playa'
@@ -219,7 +490,7 @@ class TestFunes(unittest.TestCase):
     self.assertInMessages('coco, mandiok, toro 2 v 1 fundi, p-lu-k, renga')
     self.assertInMessages('                    3 v 1 (since 2018w10)')
 
-  @patch('builtins.open', mock_open(read_data=HISTORY_JSON))
+  @patch('builtins.open', mock_open(read_data=HISTORY_JSONL))
   @patch('datetime.date', FakeDateWeek10)
   def test_handles_game_start_new_player(self):
     fun = funes.funes()
@@ -232,7 +503,7 @@ class TestFunes(unittest.TestCase):
     self.assertInMessages('fundi, p-lu-k, renga 0 v 0 cthulhu, mandiok, toro')
     self.assertInMessages('fundi, p-lu-k, renga 0 v 0 cthulhu, mandiok, toro')
 
-  @patch('builtins.open', mock_open(read_data=HISTORY_JSON))
+  @patch('builtins.open', mock_open(read_data=HISTORY_JSONL))
   @patch('datetime.date', FakeDateWeek10)
   def test_handles_game_end_no_update(self):
     fun = funes.funes()
@@ -266,7 +537,7 @@ class TestFunes(unittest.TestCase):
     self.assertEqual([0, 0], fun.get_teams_history('ad', teams))
     self.assertEqual([0, 0], fun.get_teams_history('ad', teams, aggregate=True))
 
-  @patch('builtins.open', new_callable=fake_open, fake=FakeFile(HISTORY_JSON))
+  @patch('builtins.open', new_callable=fake_open, fake=FakeFile(HISTORY_JSONL))
   @patch('datetime.date', FakeDateWeek10)
   def test_handles_game_end(self, m):
     fun = funes.funes()
@@ -286,7 +557,7 @@ class TestFunes(unittest.TestCase):
     self.assertEqual([2, 1], fun.get_teams_history('ad', teams))
     self.assertEqual([6, 3], fun.get_teams_history('ad', teams, aggregate=True))
 
-  @patch('builtins.open', new_callable=fake_open, fake=FakeFile(HISTORY_JSON))
+  @patch('builtins.open', new_callable=fake_open, fake=FakeFile(HISTORY_JSONL))
   @patch('datetime.date', FakeDateWeek10)
   def test_handles_game_end_player_left(self, m):
     fun = funes.funes()
@@ -311,7 +582,7 @@ class TestFunes(unittest.TestCase):
     self.assertEqual([1, 1], fun.get_teams_history('ad', teams))
     self.assertEqual([5, 3], fun.get_teams_history('ad', teams, aggregate=True))
 
-  @patch('builtins.open', mock_open(read_data=HISTORY_JSON))
+  @patch('builtins.open', mock_open(read_data=HISTORY_JSONL))
   @patch('datetime.date', FakeDateWeek10)
   def test_funes(self):
     fun = funes.funes()
@@ -389,7 +660,7 @@ class TestFunes(unittest.TestCase):
     self.assertInMessages('This week: no history with these players.')
     self.assertInMessages('Since 2018w10: no history with these players.')
 
-  @patch('builtins.open', mock_open(read_data=HISTORY_JSON))
+  @patch('builtins.open', mock_open(read_data=HISTORY_JSONL))
   @patch('datetime.date', FakeDateWeek10)
   def test_funes_move_players(self):
     fun = funes.funes()
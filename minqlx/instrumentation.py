@@ -0,0 +1,150 @@
+import collections
+import functools
+import gc
+import sys
+import threading
+import time
+"""
+Latency instrumentation for plugin commands and hooks.
+
+Plugins mix Instrumented in before minqlx.Plugin:
+
+  class funes(instrumentation.Instrumented, minqlx.Plugin):
+
+and every handler given to add_command / add_hook is wrapped to record its
+wall time and the number of memory blocks it left allocated (net, from
+sys.getallocatedblocks(); counting every allocation would need tracemalloc,
+which slows the whole server down). Blocks freed by a garbage collection
+during the call aren't subtracted, and the count never goes below 0. The last
+WINDOW_SIZE calls of each handler are kept in REGISTRY, to report percentiles
+(see the perf plugin).
+
+Handlers decorated with minqlx.thread / minqlx.delay only hand work over, so
+only that part is measured.
+"""
+
+WINDOW_SIZE = 1024
+PERCENTILES = [50, 95, 99]
+
+
+def get_percentile(sorted_values, percentile):
+  """Nearest rank percentile of a sorted, non-empty list."""
+  rank = max(0, -(-len(sorted_values) * percentile // 100) - 1)
+  return sorted_values[rank]
+
+
+class HandlerStats(object):
+  """Rolling window of the calls to one handler."""
+
+  def __init__(self, window_size=WINDOW_SIZE):
+    self.count = 0
+    self.times = collections.deque(maxlen=window_size)
+    self.allocations = collections.deque(maxlen=window_size)
+
+  def add(self, seconds, allocations):
+    self.count += 1
+    self.times.append(seconds)
+    self.allocations.append(allocations)
+
+  def get_summary(self):
+    """{'count': calls, 'max': s, 'p50': s, ..., 'alloc_p50': blocks, ...}."""
+    summary = {'count': self.count}
+    if not self.times:
+      return summary
+    times = sorted(self.times)
+    allocations = sorted(self.allocations)
+    summary['max'] = times[-1]
+    for percentile in PERCENTILES:
+      summary['p%d' % percentile] = get_percentile(times, percentile)
+      summary['alloc_p%d' % percentile] = get_percentile(
+          allocations, percentile)
+    return summary
+
+
+class Registry(object):
+  """HandlerStats by 'plugin.command:name' / 'plugin.hook:event' key."""
+
+  def __init__(self, window_size=WINDOW_SIZE):
+    self.window_size = window_size
+    self.lock = threading.Lock()
+    self.handlers = {}
+
+  def add(self, key, seconds, allocations):
+    # Handlers may run on threads (minqlx.thread).
+    with self.lock:
+      if key not in self.handlers:
+        self.handlers[key] = HandlerStats(self.window_size)
+      self.handlers[key].add(seconds, allocations)
+
+  def get_summaries(self):
+    with self.lock:
+      return {
+          key: stats.get_summary() for key, stats in self.handlers.items()
+      }
+
+  def reset(self):
+    with self.lock:
+      self.handlers = {}
+
+
+REGISTRY = Registry()
+
+
+class CollectedBlocks(object):
+  """Counts the memory blocks freed by garbage collections (gc callback).
+
+  A collection in the middle of a handler frees the garbage of everything
+  that ran before it, which the handler shouldn't be credited for.
+  """
+
+  def __init__(self):
+    self.count = 0
+    self.blocks = 0
+
+  def __call__(self, phase, info):
+    if phase == 'start':
+      self.blocks = sys.getallocatedblocks()
+    else:
+      self.count += max(0, self.blocks - sys.getallocatedblocks())
+
+
+COLLECTED_BLOCKS = CollectedBlocks()
+gc.callbacks.append(COLLECTED_BLOCKS)
+
+
+def instrument(key, handler, registry=None):
+  """Returns handler, recording each call under key."""
+  registry = registry or REGISTRY
+
+  @functools.wraps(handler)
+  def instrumented(*args, **kwargs):
+    blocks = sys.getallocatedblocks()
+    collected = COLLECTED_BLOCKS.count
+    start = time.perf_counter()
+    try:
+      return handler(*args, **kwargs)
+    finally:
+      seconds = time.perf_counter() - start
+      allocations = (sys.getallocatedblocks() - blocks +
+                     COLLECTED_BLOCKS.count - collected)
+      registry.add(key, seconds, max(0, allocations))
+
+  return instrumented
+
+
+class Instrumented(object):
+  """Plugin mixin: instruments every registered command and hook."""
+
+  def get_instrumentation_key(self, kind, name):
+    if not isinstance(name, str):
+      # Commands can be registered under several names.
+      name = name[0]
+    return '%s.%s:%s' % (self.__class__.__name__, kind, name)
+
+  def add_command(self, name, handler, *args, **kwargs):
+    key = self.get_instrumentation_key('command', name)
+    return super().add_command(name, instrument(key, handler), *args, **kwargs)
+
+  def add_hook(self, event, handler, *args, **kwargs):
+    key = self.get_instrumentation_key('hook', event)
+    return super().add_hook(event, instrument(key, handler), *args, **kwargs)
@@ -0,0 +1,102 @@
+import gc
+import minqlx_fake
+import sys
+import unittest
+
+sys.modules['minqlx'] = minqlx_fake
+import instrumentation
+
+
+class Plugin(instrumentation.Instrumented, minqlx_fake.Plugin):
+
+  def __init__(self):
+    self.add_command('plugin', self.cmd_plugin, 1)
+    self.add_command(('plugin_a', 'plugin_b'), self.cmd_plugin)
+    self.add_hook('game_end', self.handle_game_end)
+
+  def cmd_plugin(self, player, msg, channel):
+    return len(msg)
+
+  def handle_game_end(self, data):
+    if data.get('ABORTED'):
+      raise ValueError('aborted')
+    if data.get('COLLECT'):
+      gc.collect()
+    self.garbage = [[index] for index in range(1000)]
+
+
+class TestInstrumentation(unittest.TestCase):
+
+  def setUp(self):
+    minqlx_fake.reset()
+    instrumentation.REGISTRY.reset()
+
+  def test_get_percentile(self):
+    values = list(range(1, 101))
+    self.assertEqual(50, instrumentation.get_percentile(values, 50))
+    self.assertEqual(95, instrumentation.get_percentile(values, 95))
+    self.assertEqual(99, instrumentation.get_percentile(values, 99))
+    self.assertEqual(100, instrumentation.get_percentile(values, 100))
+    self.assertEqual(7, instrumentation.get_percentile([7], 50))
+    self.assertEqual(2, instrumentation.get_percentile([1, 2, 3], 50))
+
+  def test_handler_stats(self):
+    stats = instrumentation.HandlerStats(window_size=4)
+    self.assertEqual({'count': 0}, stats.get_summary())
+    for index in range(10):
+      stats.add(index, index * 10)
+    # only the last 4 calls
+    self.assertEqual(
+        {
+            'count': 10,
+            'max': 9,
+            'p50': 7,
+            'p95': 9,
+            'p99': 9,
+            'alloc_p50': 70,
+            'alloc_p95': 90,
+            'alloc_p99': 90,
+        }, stats.get_summary())
+
+  def test_registers_commands_and_hooks(self):
+    plugin = Plugin()
+    self.assertEqual(['plugin', ('plugin_a', 'plugin_b')],
+                     [cmd[0] for cmd in minqlx_fake.Plugin.registered_commands])
+    self.assertEqual([1, 0],
+                     [cmd[2] for cmd in minqlx_fake.Plugin.registered_commands])
+    self.assertEqual(['game_end'],
+                     [hook[0] for hook in minqlx_fake.Plugin.registered_hooks])
+    self.assertEqual('cmd_plugin',
+                     minqlx_fake.Plugin.registered_commands[0][1].__name__)
+
+  def test_records_calls(self):
+    plugin = Plugin()
+    minqlx_fake.call_command('!plugin a b')
+    minqlx_fake.call_command('!plugin')
+    # garbage collected during the hook doesn't count as freed by it
+    garbage = [[index] for index in range(10000)]
+    garbage.append(garbage)
+    del garbage
+    minqlx_fake.run_game_hooks('game_end', data={'COLLECT': True})
+    self.assertEqual(3, minqlx_fake.Plugin.registered_commands[0][1](
+        None, [None, 'a', 'b'], None))
+
+    summaries = instrumentation.REGISTRY.get_summaries()
+    self.assertEqual(['Plugin.command:plugin', 'Plugin.hook:game_end'],
+                     sorted(summaries))
+    self.assertEqual(3, summaries['Plugin.command:plugin']['count'])
+    game_end = summaries['Plugin.hook:game_end']
+    self.assertEqual(1, game_end['count'])
+    self.assertGreaterEqual(game_end['p99'], 0)
+    self.assertGreater(game_end['alloc_p50'], 500)
+
+  def test_records_errors(self):
+    plugin = Plugin()
+    with self.assertRaises(ValueError):
+      minqlx_fake.run_game_hooks('game_end', data={'ABORTED': True})
+    summaries = instrumentation.REGISTRY.get_summaries()
+    self.assertEqual(1, summaries['Plugin.hook:game_end']['count'])
+
+
+if __name__ == '__main__':
+  unittest.main()
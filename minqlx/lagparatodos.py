@@ -1,6 +1,15 @@
 import minqlx
 import os
-import re
+
+if __package__:
+  # Loaded by minqlx, as <plugins_dir>.<name>.
+  from . import chat_output
+  from . import instrumentation
+  from . import player_names
+else:
+  import chat_output
+  import instrumentation
+  import player_names
 
 HEADER_COLOR_STRING = '^2'
 CONFIG_FILE_NAME = 'lag_para_todos.config'
@@ -8,7 +17,8 @@ ROOT_PATH = os.path.dirname(os.path.realpath(__file__))
 CONFIG_FILE_PATH = os.path.join(ROOT_PATH, CONFIG_FILE_NAME)
 
 
-class lagparatodos(minqlx.Plugin):
+class lagparatodos(chat_output.Buffered, instrumentation.Instrumented,
+                   minqlx.Plugin):
 
   def __init__(self):
     self.add_command('lagparatodos', self.cmd_lagparatodos, 1)
@@ -22,10 +32,6 @@ class lagparatodos(minqlx.Plugin):
   def print_log(self, msg):
     self.msg('%sLagParaTodos:^7 %s' % (HEADER_COLOR_STRING, msg))
 
-  def get_clean_name(self, name):
-    return re.sub(r'([\W]*\]v\[[\W]*|^\W+|\W+$|[^a-zA-Z0-9\ ]+.+\W$)', '',
-                  name).lower().strip()
-
   def parse_params(self, msg):
     is_ip = lambda s: len(
         [p for p in s.split('.') if p.isdigit() and int(p) <= 255]) == 4
@@ -80,7 +86,7 @@ class lagparatodos(minqlx.Plugin):
       max_ping = min(max_ping, latency_limit)
 
     entries = sorted([[
-        self.get_clean_name(p.clean_name),
+        player_names.DIRECTORY.add(p),
         p.ip,
         p.ping if p.ip not in whitelist else max_ping,
     ] for p in players],
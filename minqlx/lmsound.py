@@ -5,6 +5,14 @@ import os
 import re
 import time
 
+if __package__:
+  # Loaded by minqlx, as <plugins_dir>.<name>.
+  from . import chat_output
+  from . import instrumentation
+else:
+  import chat_output
+  import instrumentation
+
 HEADER_COLOR_STRING = '^2'
 
 JSON_FILE_NAME = 'lmsound_map.json'
@@ -12,7 +20,8 @@ ROOT_PATH = os.path.dirname(os.path.realpath(__file__))
 JSON_FILE_PATH = os.path.join(ROOT_PATH, JSON_FILE_NAME)
 
 
-class lmsound(minqlx.Plugin):
+class lmsound(chat_output.Buffered, instrumentation.Instrumented,
+              minqlx.Plugin):
 
   def __init__(self):
     super().__init__()
@@ -2,13 +2,24 @@ import minqlx
 import json
 import os
 
+if __package__:
+  # Loaded by minqlx, as <plugins_dir>.<name>.
+  from . import chat_output
+  from . import instrumentation
+  from . import persistence
+else:
+  import chat_output
+  import instrumentation
+  import persistence
+
 HEADER_COLOR_STRING = '^2'
 JSON_FILE_NAME = 'mapuche_aliases.json'
 ROOT_PATH = os.path.dirname(os.path.realpath(__file__))
 JSON_FILE_PATH = os.path.join(ROOT_PATH, JSON_FILE_NAME)
 
 
-class mapuche(minqlx.Plugin):
+class mapuche(chat_output.Buffered, instrumentation.Instrumented,
+              minqlx.Plugin):
 
   def __init__(self):
     self.load_aliases()
@@ -18,12 +29,14 @@ class mapuche(minqlx.Plugin):
     self.add_command('mapuche_set', self.cmd_mapuche_set, 2)
     self.add_command('mapuche_reload', self.cmd_mapuche_reload, 2)
     self.add_command('mapuche_remove', self.cmd_mapuche_remove, 2)
+    self.add_hook('unload', self.handle_unload)
 
   def print_log(self, msg):
     self.msg('%sMapuche:^7 %s' % (HEADER_COLOR_STRING, msg))
 
   def load_aliases(self):
     self.aliases = None
+    persistence.flush(JSON_FILE_PATH)
     try:
       self.aliases = json.loads(open(JSON_FILE_PATH).read())
       self.print_log('Loaded %d aliases.' % len(self.aliases.keys()))
@@ -37,8 +50,11 @@ class mapuche(minqlx.Plugin):
     self.msg('%s%s' % (HEADER_COLOR_STRING, '-' * 80))
 
   def save_aliases(self):
-    open(JSON_FILE_PATH, 'w+').write(
-        json.dumps(self.aliases, sort_keys=True, indent=2))
+    persistence.save(JSON_FILE_PATH,
+                     json.dumps(self.aliases, sort_keys=True, indent=2))
+
+  def handle_unload(self, plugin):
+    persistence.flush()
 
   def get_aliases(self):
     return self.aliases.copy()
@@ -3,11 +3,13 @@ import re
 import sys
 import unittest
 import minqlx_fake
+import persistence_fake
 
 from unittest.mock import mock_open
 from unittest.mock import patch
 
 sys.modules['minqlx'] = minqlx_fake
+sys.modules['persistence'] = persistence_fake
 import mapuche
 
 SINGLE_ALIAS_DATA = {
@@ -77,8 +77,10 @@ class Game(object):
                map_name=None,
                red_score=0,
                blue_score=0,
-               aborted=False):
+               aborted=False,
+               state='warmup'):
     self.type_short = type_short
+    self.state = state
     self.red_score = red_score
     self.blue_score = blue_score
     self.aborted = aborted
@@ -105,6 +107,7 @@ class Plugin(object):
   registered_commands = []
   registered_hooks = []
   messages = []
+  print_commands = 0
   is_dev_map = False
   current_factory = None
   game = Game('ad')
@@ -116,6 +119,7 @@ class Plugin(object):
     Plugin.registered_commands = []
     Plugin.registered_hooks = []
     Plugin.messages = []
+    Plugin.print_commands = 0
     Plugin.sounds_played = {}
     Plugin.is_dev_map = False
     Plugin.current_factory = None
@@ -155,9 +159,11 @@ class Plugin(object):
     return None
 
   def msg(self, message):
-    print_ansi(message)
-    clean_message = re.sub(r'\^[\d]', '', message)
-    Plugin.messages.append(clean_message)
+    Plugin.print_commands += 1
+    # Clients show each line on its own.
+    for line in message.split('\n'):
+      print_ansi(line)
+      Plugin.messages.append(re.sub(r'\^[\d]', '', line))
 
   def add_command(self, name, cmd, arg_count=0):
     Plugin.registered_commands.append([name, cmd, arg_count])
@@ -183,6 +189,9 @@ class Plugin(object):
   def set_cvar(self, cvar, value):
     Plugin.cvars[cvar] = value
 
+  def set_cvar_once(self, cvar, value):
+    Plugin.cvars.setdefault(cvar, value)
+
 
 def console_command(cmd_line):
   tokens = cmd_line.split(' ')
@@ -197,6 +206,10 @@ def delay(time):
   return lambda x: x
 
 
+def next_frame(func):
+  return func
+
+
 def reset():
   Plugin.reset()
 
@@ -205,6 +218,22 @@ def load_player(player):
   run_game_hooks('player_loaded', player=player)
 
 
+def switch_team(player, new_team):
+  old_team = player.team
+  player.team = new_team
+  run_game_hooks('team_switch',
+                 player=player,
+                 old_team=old_team,
+                 new_team=new_team)
+
+
+def disconnect_player(player):
+  for team in Plugin.players_by_team.values():
+    if player in team:
+      team.remove(player)
+  run_game_hooks('player_disconnect', player=player, reason='disconnected')
+
+
 def send_chat(player, msg):
   run_game_hooks('chat', player=player, msg=msg, channel='chat')
 
@@ -1,10 +1,26 @@
-import copy
-import itertools
-import json
+import collections
 import minqlx
 import os
-import re
-import trueskill
+import queue
+import threading
+
+if __package__:
+  # Loaded by minqlx, as <plugins_dir>.<name>.
+  from . import chat_output
+  from . import instrumentation
+  from . import oloraculo_daemon
+  from . import oloraculo_history
+  from . import oloraculo_ratings
+  from . import persistence
+  from . import player_names
+else:
+  import chat_output
+  import instrumentation
+  import oloraculo_daemon
+  import oloraculo_history
+  import oloraculo_ratings
+  import persistence
+  import player_names
 """
 Steam Ids, for reference
 76561197969594389 - goras
@@ -18,265 +34,331 @@ Steam Ids, for reference
 76561198280762419 - juanpi
 """
 """
-JSON data file for reference:
-{
-  "game_type": {
-    "steam_id": [rating_mu, rating_sigma, games_won, games_lost, kills, deaths],
-    ...
-  },
-  ...
-}
+Ratings, their storage and the match making are in oloraculo_ratings.
 """
 
 HEADER_COLOR_STRING = '^2'
 JSON_FILE_NAME = 'oloraculo_stats.json'
 ROOT_PATH = os.path.dirname(os.path.realpath(__file__))
 JSON_FILE_PATH = os.path.join(ROOT_PATH, JSON_FILE_NAME)
+LOG_FILE_NAME = 'oloraculo_stats.log'
+LOG_FILE_PATH = os.path.join(ROOT_PATH, LOG_FILE_NAME)
+SQLITE_FILE_NAME = 'oloraculo_stats.sqlite'
+SQLITE_FILE_PATH = os.path.join(ROOT_PATH, SQLITE_FILE_NAME)
+# Matches the daemon backend hasn't had rated by the daemon yet.
+JOURNAL_FILE_PATH = os.path.join(ROOT_PATH, 'oloraculo_journal.jsonl')
+# Where ratings are stored: 'json' (JSON file and log), 'sqlite' or 'daemon'
+# (an oloraculo_daemon, shared with other servers). Read when the plugin loads.
+BACKEND_CVAR = 'qlx_oloraculoBackend'
+# Unix socket of the oloraculo_daemon, for the 'daemon' backend.
+SOCKET_CVAR = 'qlx_oloraculoSocket'
+HISTORY_PATH = os.path.join(ROOT_PATH, 'oloraculo_history')
 INTERESTING_GAME_TYPES = ['ad', 'ctf', 'ca']
 IS_BOT_ID = lambda x: x > 90000000000000000
+PREDICTIONS_COUNT = 4
+# How to rank matches, one of oloraculo_ratings.ENGINES.
+ENGINE_CVAR = 'qlx_oloraculoEngine'
+# Pairs of players that must never be teammates, e.g. "1234:5678,1234:9987".
+DONT_MIX_CVAR = 'qlx_oloraculoDontMix'
+PREDICTIONS_CACHE_SIZE = 32
 
 
-class Db(object):
-
-  def __init__(self):
-    # {'game_type': {'player_id': trueskill.Rating, ...}, ...}
-    self._ratings_dict = {}
-
-    # {'game_type': {'player_id': [win, loss], ...}, ...}
-    self._winloss_dict = {}
-
-    # {'game_type': {'player_id': [kill, death], ...}, ...}
-    self._killdeath_dict = {}
-
-  def __eq__(self, other):
-    return (self._ratings_dict == other._ratings_dict) and (
-        self._winloss_dict
-        == other._winloss_dict) and (self._killdeath_dict
-                                     == other._killdeath_dict)
-
-  def _ratings(self, game_type):
-    return self._ratings_dict.setdefault(game_type, {})
-
-  def _winloss(self, game_type):
-    return self._winloss_dict.setdefault(game_type, {})
-
-  def _killdeath(self, game_type):
-    return self._killdeath_dict.setdefault(game_type, {})
-
-  def set_rating(self, game_type, player_id, rating):
-    self._ratings(game_type)[int(player_id)] = rating
-
-  def set_winloss(self, game_type, player_id, winloss):
-    self._winloss(game_type)[int(player_id)] = list(winloss)
-
-  def set_killdeath(self, game_type, player_id, killdeath):
-    self._killdeath(game_type)[int(player_id)] = list(killdeath)
-
-  def get_rating(self, game_type, player_id):
-    return self._ratings(game_type).setdefault(int(player_id),
-                                               trueskill.Rating())
-
-  def get_winloss(self, game_type, player_id):
-    return self._winloss(game_type).setdefault(int(player_id), [0, 0])
-
-  def get_killdeath(self, game_type, player_id):
-    return self._killdeath(game_type).setdefault(int(player_id), [0, 0])
-
-  def get_player_ids(self, game_type):
-    # using both dicts is probably unnecessary
-    return set(
-        list(self._winloss(game_type).keys()) +
-        list(self._ratings(game_type).keys()))
-
-  def new_player(self, game_type, player_id):
-    self.get_rating(game_type, player_id)
-    self.get_winloss(game_type, player_id)
-    self.get_killdeath(game_type, player_id)
-
-  def load(self, file_name):
-    # {'type': {'pid': [rating.mu, rating.sigma, win, loss, k, d], ...}, ...}
-    json_data = json.loads(open(file_name).read())
-    player_ids = set()
-
-    for game_type in json_data:
-      for player_id in json_data[game_type]:
-        player_ids.add(player_id)
-
-    for game_type in json_data:
-      for player_id in player_ids:
-        data = json_data[game_type][player_id]
-        self.set_rating(game_type, player_id,
-                        trueskill.Rating(data[0], data[1]))
-        self.set_winloss(game_type, player_id, [data[2], data[3]])
-        self.set_killdeath(game_type, player_id, [data[4], data[5]])
-
-  def save(self, file_name):
-    game_types = set(
-        list(self._ratings_dict.keys()) + list(self._winloss_dict.keys()))
-    player_ids = set()
-    for game_type in game_types:
-      player_ids.update(self._ratings(game_type).keys())
-      player_ids.update(self._winloss(game_type).keys())
-
-    json_data = {}
-    for game_type in game_types:
-      data = json_data.setdefault(game_type, {})
-      for player_id in player_ids:
-        rating = self.get_rating(game_type, player_id)
-        winloss = self.get_winloss(game_type, player_id)
-        killdeath = self.get_killdeath(game_type, player_id)
-        data[str(player_id)] = [
-            rating.mu, rating.sigma, winloss[0], winloss[1], killdeath[0],
-            killdeath[1]
-        ]
-
-    open(file_name, 'w+').write(json.dumps(json_data, sort_keys=True, indent=2))
-
-
-class oloraculo(minqlx.Plugin):
+class oloraculo(chat_output.Buffered, instrumentation.Instrumented,
+                minqlx.Plugin):
 
   def __init__(self):
     self.add_command('oloraculo', self.cmd_oloraculo, 1)
     self.add_command('oloraculo_stats', self.cmd_oloraculo_stats)
+    self.add_command('oloraculo_migrate', self.cmd_oloraculo_migrate, 5)
     self.add_hook('game_end', self.handle_game_end)
     self.add_hook('game_start', self.handle_game_start)
     self.add_hook("player_loaded", self.handle_player_loaded)
+    self.add_hook('team_switch', self.handle_team_switch)
+    self.add_hook('player_disconnect', self.handle_player_disconnect)
+    self.add_hook('unload', self.handle_unload)
+
+    self.set_cvar_once(ENGINE_CVAR, 'search')
+    self.set_cvar_once(BACKEND_CVAR, 'json')
+    self.set_cvar_once(SOCKET_CVAR, oloraculo_daemon.SOCKET_PATH)
+    self.set_cvar_once(DONT_MIX_CVAR, '')
+
+    self.stats = oloraculo_ratings.Db()
+    self.backend = self.get_backend()
+    # (call, on_done) for the daemon backend, see call_backend().
+    self.backend_calls = queue.Queue()
+    self.backend_thread = None
+    # Ratings of every player after each match.
+    self.rating_history = oloraculo_history.History(HISTORY_PATH)
+    # Bumped whenever ratings change, so cached predictions go stale.
+    self.ratings_generation = 0
+    # {(game_type, frozenset(player_ids), generation, dont_mix):
+    #     [[quality, teams], ...]}
+    self.predictions_cache = collections.OrderedDict()
+    # Guards predictions_cache, which precompute threads also write to.
+    self.predictions_lock = threading.Lock()
+    # DONT_MIX_CVAR, as last read and parsed.
+    self.dont_mix_value = ''
+    self.dont_mix = frozenset()
+    # {game_type: Leaderboard}, built on first use.
+    self.leaderboards = {}
+    self.load_stats()
 
-    self.stats = Db()
+  def get_backend(self):
+    backend = self.get_cvar(BACKEND_CVAR, str)
+    if backend == 'sqlite':
+      return oloraculo_ratings.SqliteBackend(SQLITE_FILE_PATH)
+    if backend == 'daemon':
+      return oloraculo_daemon.DaemonBackend(
+          oloraculo_daemon.RatingClient(self.get_cvar(SOCKET_CVAR, str)),
+          JOURNAL_FILE_PATH)
+    return oloraculo_ratings.JsonBackend(JSON_FILE_PATH, LOG_FILE_PATH)
+
+  def call_backend(self, call, on_done):
+    """Calls call(stats), then on_done(what it returned, what it raised).
+
+    The daemon backend may wait for the daemon, so it is called on
+    backend_thread, one call at a time in order, with a Db of its own. The
+    rows it sets are copied to self.stats, and on_done is called, on the next
+    frame.
+    """
+    if not isinstance(self.backend, oloraculo_daemon.DaemonBackend):
+      try:
+        result = call(self.stats)
+      except Exception as e:
+        on_done(None, e)
+        return
+      on_done(result, None)
+      return
 
-    # Maps steam player_id to name:
-    # {'player_id': 'name', ...}
-    self.player_id_map = {}
-    self.load_stats()
+    self.backend_calls.put((call, on_done))
+    if self.backend_thread is None:
+      self.backend_thread = threading.Thread(target=self.run_backend_calls,
+                                             daemon=True)
+      self.backend_thread.start()
+
+  def run_backend_calls(self):
+    while True:
+      call, on_done = self.backend_calls.get()
+      stats = oloraculo_ratings.Db()
+      try:
+        result, error = call(stats), None
+      except Exception as e:
+        result, error = None, e
+      minqlx.next_frame(self.finish_backend_call)(stats, result, error,
+                                                  on_done)
+      self.backend_calls.task_done()
+
+  def finish_backend_call(self, stats, result, error, on_done):
+    game_types = stats.get_game_types()
+    for game_type in game_types:
+      for player_id, row in stats.get_rows(game_type):
+        self.stats.set_row(game_type, player_id, row)
+    if game_types:
+      self.ratings_generation += 1
+      self.leaderboards = {}
+    on_done(result, error)
 
   def load_stats(self):
-    try:
-      self.stats.load(JSON_FILE_PATH)
-      self.print_log('Stats loaded.')
-    except Exception as e:
-      self.print_log('Could not load stats (%s)' % e)
+    game_type = self.game.type_short
 
-  def save_stats(self):
-    self.stats.save(JSON_FILE_PATH)
-    self.print_log('Stats saved.')
+    def loaded(changed, error):
+      if error is not None:
+        self.print_log('Could not load stats (%s)' % error)
+      elif changed:
+        self.ratings_generation += 1
+        self.leaderboards = {}
+        self.print_log('Stats loaded.')
 
-  def get_stats(self):
-    return copy.deepcopy(self.stats)
+    self.call_backend(lambda stats: self.backend.load(stats, game_type),
+                      loaded)
 
-  def get_clean_name(self, name):
-    return re.sub(r'([\W]*\]v\[[\W]*|^\W+|\W+$|[^a-zA-Z0-9\ ]+.+\W$)', '',
-                  name).lower().strip()
+  def save_stats(self, game_type, deltas, match, on_saved):
+    """Saves match, then calls on_saved(exposure deltas or None).
 
-  def name_by_id(self, id):
-    if id in self.player_id_map:
-      return self.get_clean_name(self.player_id_map[id])
-    else:
-      return '...%s' % str(id)[8:]
+    The exposure deltas are the backend's, if it rated match itself.
+    """
 
-  def get_player_ratings(self, player_id):
-    return self.stats.get_rating(self.game.type_short, player_id)
+    def saved(exposure_deltas, error):
+      if error is not None:
+        self.print_log('Could not save stats (%s)' % error)
+      else:
+        # The daemon backend may have changed the rows (see DaemonBackend).
+        self.update_leaderboard(game_type, deltas.keys())
+        self.print_log('Stats saved.')
+      on_saved(exposure_deltas)
 
-  def get_match_qualities(self, players_present):
-    players_per_team = int(len(players_present) / 2)
-    teams = list(itertools.combinations(players_present, players_per_team))
+    self.call_backend(
+        lambda stats: self.backend.save_match(stats, game_type, deltas, match),
+        saved)
 
-    seen_matches = set()
-    match_qualities = []
+  def get_stats(self):
+    return self.stats.snapshot()
 
-    # TODO(edgard): Instead of hardcoding IDs, we should support setting
-    # a cvar (e.g. "seta qlx_oloraculoDontMix 1234:5678,1234:9987"). This
-    # can be done in the client and doesn't require restarting.
-    # toro = 76561198282206581
-    # mandiok = 76561198257902041
+  def get_leaderboard(self, game_type):
+    if game_type not in self.leaderboards:
+      self.leaderboards[game_type] = oloraculo_ratings.Leaderboard(
+          self.backend.get_leaderboard(self.stats, game_type))
+    return self.leaderboards[game_type]
 
-    for team_a in teams:
-      for team_b in teams:
-        match_key = repr(sorted((sorted(team_a), sorted(team_b))))
+  def update_leaderboard(self, game_type, player_ids):
+    # Nothing to do until someone asks for it.
+    if game_type in self.leaderboards:
+      for player_id in player_ids:
+        self.leaderboards[game_type].update(
+            player_id, self.stats.get_row(game_type, player_id))
 
-        if list(set(team_a) & set(team_b)) or match_key in seen_matches:
-          continue
+  def name_by_id(self, id):
+    return player_names.DIRECTORY.get(id, '...%s' % str(id)[8:])
 
-        # if ((toro in team_a and mandiok in team_a) or
-        #     (toro in team_b and mandiok in team_b)):
-        #   continue
+  def get_player_ratings(self, player_id):
+    return self.stats.get_rating(self.game.type_short, player_id)
 
-        seen_matches.add(match_key)
+  def get_players_ratings(self, players_present):
+    return {
+        player_id: self.get_player_ratings(player_id)
+        for player_id in players_present
+    }
 
-        team_a_ratings = [
-            self.get_player_ratings(player_id) for player_id in team_a
-        ]
-        team_b_ratings = [
-            self.get_player_ratings(player_id) for player_id in team_b
-        ]
+  def get_players_present(self):
+    return [p.steam_id for p in self.players() if p.team in ['red', 'blue']]
+
+  def get_dont_mix(self):
+    # Only parsed again when the cvar changes.
+    value = self.get_cvar(DONT_MIX_CVAR, str) or ''
+    if value != self.dont_mix_value:
+      self.dont_mix_value = value
+      self.dont_mix = oloraculo_ratings.parse_dont_mix(value)
+    return self.dont_mix
+
+  def get_match_qualities(self, players_present, ratings=None, dont_mix=None):
+    if ratings is None:
+      ratings = self.get_players_ratings(players_present)
+    if dont_mix is None:
+      dont_mix = self.get_dont_mix()
+
+    return oloraculo_ratings.get_match_qualities(players_present, ratings,
+                                                 dont_mix)
+
+  def get_engine(self):
+    engine = self.get_cvar(ENGINE_CVAR, str)
+    if engine not in oloraculo_ratings.ENGINES or (
+        engine == 'numpy' and oloraculo_ratings.numpy is None):
+      return 'search'
+    return engine
+
+  def get_vectorized_match_qualities(self,
+                                     players_present,
+                                     ratings=None,
+                                     dont_mix=None):
+    if ratings is None:
+      ratings = self.get_players_ratings(players_present)
+    if dont_mix is None:
+      dont_mix = self.get_dont_mix()
+    return oloraculo_ratings.get_vectorized_match_qualities(
+        players_present, ratings, dont_mix)
+
+  def get_best_matches(self,
+                       players_present,
+                       count=PREDICTIONS_COUNT,
+                       ratings=None,
+                       engine=None,
+                       dont_mix=None):
+    """See oloraculo_ratings.get_best_matches()."""
+    if ratings is None:
+      ratings = self.get_players_ratings(players_present)
+    if engine is None:
+      engine = self.get_engine()
+    if dont_mix is None:
+      dont_mix = self.get_dont_mix()
+
+    return oloraculo_ratings.get_best_matches(players_present, ratings, count,
+                                              engine, dont_mix)
+
+  def get_predictions_key(self, players_present):
+    return (self.game.type_short, frozenset(players_present),
+            self.ratings_generation, self.get_dont_mix())
+
+  def cache_best_matches(self, key, match_qualities):
+    with self.predictions_lock:
+      self.predictions_cache[key] = match_qualities
+      self.predictions_cache.move_to_end(key)
+      while len(self.predictions_cache) > PREDICTIONS_CACHE_SIZE:
+        self.predictions_cache.popitem(last=False)
+
+  def get_cached_best_matches(self, players_present):
+    key = self.get_predictions_key(players_present)
+    with self.predictions_lock:
+      match_qualities = self.predictions_cache.get(key)
+      if match_qualities is not None:
+        self.predictions_cache.move_to_end(key)
+
+    if match_qualities is None:
+      match_qualities = self.get_best_matches(players_present)
+      self.cache_best_matches(key, match_qualities)
+
+    # Callers may reorder the teams, don't let that reach the cache.
+    return [[quality, list(teams)] for quality, teams in match_qualities]
+
+  def precompute_best_matches(self, key, players_present, ratings, engine,
+                              dont_mix):
+    # Runs on a worker thread: only uses the snapshot it was given.
+    self.cache_best_matches(
+        key,
+        self.get_best_matches(players_present,
+                              ratings=ratings,
+                              engine=engine,
+                              dont_mix=dont_mix))
+
+  # Runs on the next frame so that the roster reflects the switch or
+  # disconnect that triggered it.
+  @minqlx.next_frame
+  def schedule_precompute(self):
+    if not self.is_interesting_game_type() or self.game.state != 'warmup':
+      return
 
-        quality = trueskill.quality([team_a_ratings, team_b_ratings])
-        match_qualities.append([quality, [team_a, team_b]])
+    players_present = self.get_players_present()
+    if len(players_present) < 2:
+      return
 
-    return match_qualities
+    key = self.get_predictions_key(players_present)
+    with self.predictions_lock:
+      if key in self.predictions_cache:
+        return
 
-  def update_player_stats(self):
-    game_type = self.game.type_short
+    ratings = self.get_players_ratings(players_present)
+    threading.Thread(target=self.precompute_best_matches,
+                     args=(key, players_present, ratings, self.get_engine(),
+                           self.get_dont_mix()),
+                     daemon=True).start()
 
+  def get_match(self):
+    """The match that just ended, see oloraculo_ratings.rate_match()."""
     teams = self.teams()
-    red_ratings = []
-    blue_ratings = []
-
     if len(teams['red']) == 0 or len(teams['blue']) == 0:
-      return
+      return None
+
+    return {
+        'red': [p.steam_id for p in teams['red']],
+        'blue': [p.steam_id for p in teams['blue']],
+        'red_score': self.game.red_score,
+        'blue_score': self.game.blue_score,
+        'kills_deaths': {
+            p.steam_id: [p.stats.kills, p.stats.deaths]
+            for p in teams['red'] + teams['blue']
+        },
+    }
 
-    # Update win / loss
-    for player in teams['red']:
-      red_ratings.append(self.stats.get_rating(game_type, player.steam_id))
-      if self.game.red_score > self.game.blue_score:
-        self.stats.get_winloss(game_type, player.steam_id)[0] += 1
-      else:
-        self.stats.get_winloss(game_type, player.steam_id)[1] += 1
+  def update_player_stats(self, match):
+    game_type = self.game.type_short
+    exposure_deltas, deltas = oloraculo_ratings.rate_match(
+        self.stats, game_type, match)
+    self.ratings_generation += 1
 
-    for player in teams['blue']:
-      blue_ratings.append(self.stats.get_rating(game_type, player.steam_id))
-      if self.game.red_score < self.game.blue_score:
-        self.stats.get_winloss(game_type, player.steam_id)[0] += 1
-      else:
-        self.stats.get_winloss(game_type, player.steam_id)[1] += 1
-
-    # Update kill / death
-    for player in teams['blue'] + teams['red']:
-      steam_id = player.steam_id
-      self.stats.get_killdeath(game_type, steam_id)[0] += player.stats.kills
-      self.stats.get_killdeath(game_type, steam_id)[1] += player.stats.deaths
-
-    if self.game.red_score > self.game.blue_score:
-      ranks = [0, 1]
-    elif self.game.red_score < self.game.blue_score:
-      ranks = [1, 0]
-    else:
-      ranks = [0, 0]
-
-    new_ratings = trueskill.rate([red_ratings, blue_ratings], ranks=ranks)
-    deltas = {}
-
-    # Update red
-    for index, player in enumerate(teams['red']):
-      steam_id = player.steam_id
-      old_rating = self.stats.get_rating(game_type, steam_id)
-      new_rating = new_ratings[0][index]
-      deltas[steam_id] = new_rating.exposure - old_rating.exposure
-      self.stats.set_rating(game_type, steam_id, new_rating)
-
-    # Update blue
-    for index, player in enumerate(teams['blue']):
-      steam_id = player.steam_id
-      old_rating = self.stats.get_rating(game_type, steam_id)
-      new_rating = new_ratings[1][index]
-      deltas[steam_id] = new_rating.exposure - old_rating.exposure
-      self.stats.set_rating(game_type, steam_id, new_rating)
-
-    self.print_match_rating_deltas(deltas)
+    self.update_leaderboard(game_type, deltas.keys())
     self.print_log('Stats updated.')
 
-  def populate_player_id_map(self):
-    for p in self.players():
-      self.player_id_map[p.steam_id] = self.get_clean_name(p.clean_name)
+    # Changes to every stat, for the log.
+    return exposure_deltas, deltas
 
   def is_interesting_game_type(self):
     return self.game.type_short in INTERESTING_GAME_TYPES
@@ -311,7 +393,7 @@ class oloraculo(minqlx.Plugin):
     if not self.is_interesting_game_type():
       return
 
-    self.populate_player_id_map()
+    player_names.DIRECTORY.add_players(self.players())
     self.load_stats()
 
   def handle_game_end(self, data):
@@ -376,15 +458,41 @@ class oloraculo(minqlx.Plugin):
       self.print_log('Not updating ratings: no team won.')
       return
 
-    self.update_player_stats()
-    self.save_stats()
+    match = self.get_match()
+    if match is None:
+      return
+    exposure_deltas, deltas = self.update_player_stats(match)
+
+    def saved(saved_exposure_deltas):
+      self.rating_history.append(
+          game_type, {
+              player_id: self.stats.get_row(game_type, player_id)
+              for player_id in deltas
+          })
+      # The daemon backend rates the match again, with the latest ratings.
+      self.print_match_rating_deltas(saved_exposure_deltas or exposure_deltas)
+
+    self.save_stats(game_type, deltas, match, saved)
 
   def handle_player_loaded(self, player):
     player_id = player.steam_id
     game_type = self.game.type_short
-    # Update name map, initialize ratings and winloss for new player.
-    self.player_id_map[player_id] = self.get_clean_name(player.clean_name)
-    self.stats.new_player(game_type, player_id)
+    # Update names, initialize ratings and winloss for new player.
+    player_names.DIRECTORY.add(player)
+    if player_id not in self.stats.get_player_ids(game_type):
+      self.stats.new_player(game_type, player_id)
+      self.backend.add_player(self.stats, game_type, player_id)
+      self.update_leaderboard(game_type, [player_id])
+    self.schedule_precompute()
+
+  def handle_unload(self, plugin):
+    persistence.flush()
+
+  def handle_team_switch(self, player, old_team, new_team):
+    self.schedule_precompute()
+
+  def handle_player_disconnect(self, player, reason):
+    self.schedule_precompute()
 
   def print_header(self, message):
     self.msg('%s%s' % (HEADER_COLOR_STRING, '=' * 80))
@@ -408,29 +516,13 @@ class oloraculo(minqlx.Plugin):
 
     game_type = self.game.type_short
     self.print_header('player ratings (%s)' % game_type)
-    player_ids = self.stats.get_player_ids(game_type)
 
-    line_data = []
-    max_kd = 0
-    max_wl = 0
-    for player_id in player_ids:
-      name = self.name_by_id(player_id)
-      rating = self.stats.get_rating(game_type, player_id)
-      winloss = self.stats.get_winloss(game_type, player_id)
-      killdeath = self.stats.get_killdeath(game_type, player_id)
-      max_kd = max(max_kd, max(killdeath))
-      max_wl = max(max_wl, max(winloss))
-      line_data.append([
-          name, rating.exposure, winloss[0], winloss[1], killdeath[0],
-          killdeath[1]
-      ])
-
-    for player_name, exposure, win, loss, kill, death in sorted(
-        line_data, key=lambda x: x[1], reverse=True):
-      wl_str = get_ratio_string('wl', max_wl, win, loss)
-      kd_str = get_ratio_string('kd', max_kd, kill, death)
+    leaderboard = self.get_leaderboard(game_type)
+    for player_id, exposure, (_, _, win, loss, kill, death) in leaderboard:
+      wl_str = get_ratio_string('wl', leaderboard.max_wl, win, loss)
+      kd_str = get_ratio_string('kd', leaderboard.max_kd, kill, death)
       self.msg('^5%12s^7: ^3%5.2f^7 · %s · %s' %
-               (player_name, exposure, wl_str, kd_str))
+               (self.name_by_id(player_id), exposure, wl_str, kd_str))
     self.msg(' ')
 
   def print_log(self, msg):
@@ -441,27 +533,41 @@ class oloraculo(minqlx.Plugin):
       self.print_log('This game type is not interesting. No ratings.')
       return
 
-    self.populate_player_id_map()
+    player_names.DIRECTORY.add_players(self.players())
     self.print_player_stats()
 
+  def cmd_oloraculo_migrate(self, player, msg, channel):
+    stats = oloraculo_ratings.Db()
+    try:
+      oloraculo_ratings.JsonBackend(JSON_FILE_PATH,
+                                    LOG_FILE_PATH).load(stats, None)
+      sqlite_backend = oloraculo_ratings.SqliteBackend(SQLITE_FILE_PATH)
+      count = sqlite_backend.import_stats(stats)
+      sqlite_backend.close()
+    except Exception as e:
+      self.print_log('Could not migrate stats (%s)' % e)
+      return
+
+    self.print_log('Migrated %d ratings to %s.' % (count, SQLITE_FILE_NAME))
+    self.load_stats()
+
   def cmd_oloraculo(self, player, msg, channel):
     if not self.is_interesting_game_type():
       self.print_log('This game type is not interesting. No predictions.')
       return
 
-    game_type = self.game.type_short
-    self.populate_player_id_map()
-    players_present = [
-        p.steam_id for p in self.players() if p.team in ['red', 'blue']
-    ]
+    player_names.DIRECTORY.add_players(self.players())
+    players_present = self.get_players_present()
 
     if len(players_present) < 2:
       self.print_log('Cannot predict with less than 2 players.')
       return
 
-    # Only take the first 4 matches.
-    match_qualities = sorted(self.get_match_qualities(players_present),
-                             reverse=True)[:4]
+    # Only take the first few matches.
+    match_qualities = self.get_cached_best_matches(players_present)
+    if not match_qualities:
+      self.print_log('No teams keep the %s pairs apart.' % DONT_MIX_CVAR)
+      return
 
     for match in match_qualities:
       # BluesyQuaker on blue:
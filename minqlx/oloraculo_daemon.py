@@ -0,0 +1,426 @@
+#!/usr/bin/python3
+"""
+Rating service for oloraculo, so several QL servers share the same ratings.
+
+The daemon owns one in-memory oloraculo_ratings.Db, stored with the json or
+sqlite backend, and serves it over a Unix socket. Servers use the 'daemon'
+backend of the plugin (qlx_oloraculoBackend), which keeps a local copy of the
+ratings as a read cache and sends matches to the daemon to be rated (see
+DaemonBackend).
+
+  oloraculo_daemon.py --socket /tmp/oloraculo.sock --backend sqlite
+
+Protocol: one JSON object per line, in both directions. Every response has
+"ok" and, when ok, the "generation" of the game type: a counter bumped
+whenever its ratings change, so clients can tell when their copy is stale.
+Rows are [mu, sigma, win, loss, kill, death], keyed by steam_id.
+
+  {"op": "ratings", "type": "ad", "ids": [steam_id, ...]}
+    -> {"ok": true, "generation": 3, "rows": {"steam_id": row, ...}}
+  {"op": "table", "type": "ad", "generation": 2}
+    -> {"ok": true, "generation": 3, "rows": {"steam_id": row, ...}}
+       (every player; "rows" is null if generation is still the current one)
+  {"op": "rate", "type": "ad", "match": {"red": [...], "blue": [...],
+                                          "red_score": 8, "blue_score": 3,
+                                          "kills_deaths": {"steam_id": [k, d]}},
+   "id": "unique match id"}
+    -> {"ok": true, "generation": 4, "deltas": {"steam_id": exposure_delta},
+        "rows": {"steam_id": row, ...}}
+       (a match with the id of one of the last RATED_IDS_KEPT isn't rated
+       again, "id" is optional)
+  {"op": "predict", "type": "ad", "ids": [...], "count": 4,
+   "engine": "search", "dont_mix": [[steam_id, steam_id], ...]}
+    -> {"ok": true, "generation": 4, "matches": [[quality, [[...], [...]]]]}
+
+  Errors: {"ok": false, "error": "message"}
+"""
+
+import argparse
+import collections
+import json
+import os
+import socket
+import socketserver
+import stat
+import sys
+import threading
+import trueskill
+import uuid
+
+if __package__:
+  # Loaded by minqlx, as <plugins_dir>.<name>.
+  from . import oloraculo_ratings
+  from . import persistence
+else:
+  import oloraculo_ratings
+  import persistence
+
+ROOT_PATH = os.path.dirname(os.path.realpath(__file__))
+SOCKET_PATH = os.path.join(ROOT_PATH, 'oloraculo.sock')
+JSON_FILE_PATH = os.path.join(ROOT_PATH, 'oloraculo_stats.json')
+LOG_FILE_PATH = os.path.join(ROOT_PATH, 'oloraculo_stats.log')
+SQLITE_FILE_PATH = os.path.join(ROOT_PATH, 'oloraculo_stats.sqlite')
+# Seconds to wait for the daemon before giving up on a request.
+TIMEOUT = 5
+OPS = ['ratings', 'table', 'rate', 'predict']
+# Ids of rated matches remembered, so matches sent again aren't rated twice.
+RATED_IDS_KEPT = 1024
+
+
+def log(msg):
+  sys.stderr.write('%s\n' % msg)
+
+
+def encode(message):
+  return (json.dumps(message, separators=(',', ':')) + '\n').encode()
+
+
+def is_stale_socket(socket_path):
+  """True for a socket nobody listens on, e.g. left behind by a crash."""
+  try:
+    if not stat.S_ISSOCK(os.stat(socket_path).st_mode):
+      return False
+  except FileNotFoundError:
+    return False
+  connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  try:
+    connection.connect(socket_path)
+  except OSError:
+    return True
+  finally:
+    connection.close()
+  return False
+
+
+class RatingServiceError(Exception):
+  """The daemon answered a request with an error."""
+
+
+class RatingService(object):
+  """Answers requests (dicts, see above) against one Db."""
+
+  def __init__(self, backend):
+    self.backend = backend
+    self.stats = oloraculo_ratings.Db()
+    # Requests come from one thread per connection.
+    self.lock = threading.Lock()
+    # {game_type: generation}
+    self.generations = {}
+    # {match id: response}, oldest first.
+    self.rated = collections.OrderedDict()
+
+  def get_rows(self, game_type, player_ids):
+    return {
+        str(player_id): list(self.stats.get_row(game_type, player_id))
+        for player_id in player_ids
+    }
+
+  def load(self, game_type):
+    # Cheap when nothing changed. Picks up files replaced by hand, e.g. by
+    # oloraculo_rebuild.
+    loaded = self.backend.load(self.stats, game_type)
+    if loaded or game_type not in self.generations:
+      self.generations[game_type] = self.generations.get(game_type, 0) + 1
+
+  def handle(self, request):
+    try:
+      op = request['op']
+      game_type = request['type']
+      if op not in OPS:
+        raise ValueError('unknown op %s' % op)
+      with self.lock:
+        self.load(game_type)
+        response = getattr(self, 'handle_%s' % op)(game_type, request)
+        response['generation'] = self.generations[game_type]
+    except Exception as e:
+      return {'ok': False, 'error': '%s: %s' % (e.__class__.__name__, e)}
+    response['ok'] = True
+    return response
+
+  def handle_ratings(self, game_type, request):
+    return {'rows': self.get_rows(game_type, request['ids'])}
+
+  def handle_table(self, game_type, request):
+    if request.get('generation') == self.generations[game_type]:
+      return {'rows': None}
+    return {
+        'rows': {
+            str(player_id): list(row)
+            for player_id, row in self.stats.get_rows(game_type)
+        }
+    }
+
+  def handle_rate(self, game_type, request):
+    match_id = request.get('id')
+    if match_id in self.rated:
+      # Sent again by a client that didn't get the response.
+      return dict(self.rated[match_id])
+    match = request['match']
+    exposure_deltas, deltas = oloraculo_ratings.rate_match(
+        self.stats, game_type, match)
+    self.backend.save_match(self.stats, game_type, deltas, match)
+    self.generations[game_type] += 1
+    response = {
+        'deltas': {str(k): v for k, v in exposure_deltas.items()},
+        'rows': self.get_rows(game_type, deltas)
+    }
+    if match_id is not None:
+      self.rated[match_id] = dict(response)
+      if len(self.rated) > RATED_IDS_KEPT:
+        self.rated.popitem(last=False)
+    return response
+
+  def handle_predict(self, game_type, request):
+    player_ids = [int(player_id) for player_id in request['ids']]
+    ratings = {
+        player_id: self.stats.get_rating(game_type, player_id)
+        for player_id in player_ids
+    }
+    dont_mix = frozenset(
+        frozenset(int(player_id)
+                  for player_id in pair)
+        for pair in request.get('dont_mix', ()))
+    matches = oloraculo_ratings.get_best_matches(
+        player_ids, ratings, request.get('count', 4),
+        request.get('engine', 'search'), dont_mix)
+    return {
+        'matches': [[quality, [list(team_a), list(team_b)]]
+                    for quality, (team_a, team_b) in matches]
+    }
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+  """Serves the requests of one connection, until the client closes it."""
+
+  def handle(self):
+    for line in self.rfile:
+      try:
+        request = json.loads(line)
+      except ValueError:
+        response = {'ok': False, 'error': 'Not JSON.'}
+      else:
+        response = self.server.service.handle(request)
+      self.wfile.write(encode(response))
+
+
+class RatingServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+  daemon_threads = True
+
+  def __init__(self, socket_path, service):
+    # Binding fails if another daemon is still serving socket_path.
+    if is_stale_socket(socket_path):
+      os.remove(socket_path)
+    super().__init__(socket_path, RequestHandler)
+    self.service = service
+
+
+class RatingClient(object):
+  """Talks to the daemon over one connection, opened on first use and kept.
+
+  Thread safe. If the connection was dropped (e.g. the daemon restarted)
+  requests are sent again once over a new one, unless retry is False: 'rate'
+  without an id isn't safe to repeat.
+  """
+
+  def __init__(self, socket_path, timeout=TIMEOUT):
+    self.socket_path = socket_path
+    self.timeout = timeout
+    self.lock = threading.Lock()
+    self.connection = None
+    self.reader = None
+
+  def connect(self):
+    if self.connection is None:
+      connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+      connection.settimeout(self.timeout)
+      try:
+        connection.connect(self.socket_path)
+      except OSError:
+        connection.close()
+        raise
+      self.connection = connection
+      self.reader = connection.makefile('rb')
+    return self.connection
+
+  def close(self):
+    if self.connection is not None:
+      self.reader.close()
+      self.connection.close()
+      self.connection = None
+      self.reader = None
+
+  def send(self, data):
+    self.connect().sendall(data)
+    line = self.reader.readline()
+    if not line:
+      raise ConnectionError('Connection closed by the rating daemon.')
+    return line
+
+  def request(self, op, game_type, retry=True, **fields):
+    data = encode(dict(fields, op=op, type=game_type))
+    with self.lock:
+      try:
+        line = self.send(data)
+      except OSError:
+        self.close()
+        if not retry:
+          raise
+        try:
+          line = self.send(data)
+        except OSError:
+          self.close()
+          raise
+    response = json.loads(line)
+    if not response.get('ok'):
+      raise RatingServiceError(response.get('error'))
+    return response
+
+
+class DaemonBackend(object):
+  """Keeps ratings in the rating daemon; stats is a local read cache.
+
+  Matches go to a journal file before they are sent, and stay there until the
+  daemon rated them: when it can't be reached, they are sent again in order on
+  the next load() or save_match(), even after a restart. Each has an id, so
+  the daemon doesn't rate it twice if only its response was lost.
+
+  Every call may wait for the daemon (up to the client's timeout): the plugin
+  makes them off the game thread.
+  """
+
+  def __init__(self, client, journal_file_name=None):
+    self.client = client
+    # {game_type: daemon generation of the rows in stats}
+    self.generations = {}
+    self.journal_file_name = journal_file_name
+    # [{'id': match id, 'type': game_type, 'match': match}, ...], oldest
+    # first.
+    self.journal = self.read_journal()
+
+  def read_journal(self):
+    if not self.journal_file_name:
+      return []
+    try:
+      journal_file = open(self.journal_file_name)
+    except FileNotFoundError:
+      return []
+    with journal_file:
+      return [json.loads(line) for line in journal_file]
+
+  def write_journal(self):
+    if not self.journal_file_name:
+      return
+    # Written right away: only matches that made it to disk are acknowledged.
+    persistence.write_atomically(
+        self.journal_file_name, ''.join(
+            json.dumps(entry, separators=(',', ':')) + '\n'
+            for entry in self.journal))
+
+  def send_journal(self, stats):
+    """Has the daemon rate the journaled matches, oldest first.
+
+    Returns the exposure deltas of the last one, None if there were none.
+    Raises if the daemon can't be reached, keeping the matches not rated.
+    """
+    exposure_deltas = None
+    while self.journal:
+      entry = self.journal[0]
+      try:
+        response = self.client.request('rate',
+                                       entry['type'],
+                                       match=entry['match'],
+                                       id=entry['id'])
+      except RatingServiceError:
+        # Rejected, sending it again wouldn't help.
+        self.journal.pop(0)
+        self.write_journal()
+        raise
+      self.journal.pop(0)
+      self.write_journal()
+      exposure_deltas = self.set_rated(stats, entry['type'], response)
+    return exposure_deltas
+
+  def set_rated(self, stats, game_type, response):
+    for player_id, row in response['rows'].items():
+      stats.set_row(game_type, int(player_id), row)
+    # Only this match happened since the last load, stats is still current.
+    if response['generation'] == self.generations.get(game_type, 0) + 1:
+      self.generations[game_type] = response['generation']
+    return {
+        int(player_id): delta
+        for player_id, delta in response['deltas'].items()
+    }
+
+  def load(self, stats, game_type):
+    # Matches still in the journal first, so the table has them.
+    rated = self.send_journal(stats) is not None
+    response = self.client.request('table',
+                                   game_type,
+                                   generation=self.generations.get(game_type))
+    if response['rows'] is None:
+      return rated
+    for player_id, row in response['rows'].items():
+      stats.set_row(game_type, int(player_id), row)
+    self.generations[game_type] = response['generation']
+    return True
+
+  def add_player(self, stats, game_type, player_id):
+    # The daemon adds players when they are first rated.
+    pass
+
+  def save_match(self, stats, game_type, deltas, match=None):
+    """Has the daemon rate match, and returns its exposure deltas.
+
+    stats was rated locally already. The daemon's rows and deltas win: they
+    include matches from the other servers. If the daemon can't be reached,
+    match stays in the journal and this raises.
+    """
+    self.journal.append({
+        'id': uuid.uuid4().hex,
+        'type': game_type,
+        'match': match
+    })
+    self.write_journal()
+    return self.send_journal(stats)
+
+  def get_leaderboard(self, stats, game_type):
+    return sorted(stats.get_rows(game_type),
+                  key=lambda row: trueskill.Rating(*row[1][:2]).exposure,
+                  reverse=True)
+
+  def close(self):
+    self.client.close()
+
+
+def get_backend(args):
+  if args.backend == 'sqlite':
+    return oloraculo_ratings.SqliteBackend(args.sqlite_file)
+  return oloraculo_ratings.JsonBackend(args.stats_file, args.log_file)
+
+
+def main(args):
+  server = RatingServer(args.socket, RatingService(get_backend(args)))
+  log('Serving oloraculo ratings on %s.' % args.socket)
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    pass
+  finally:
+    server.server_close()
+    os.remove(args.socket)
+    persistence.flush()
+
+
+arg_parser = argparse.ArgumentParser(
+    description='Serves oloraculo ratings to several servers.')
+arg_parser.add_argument('--socket', type=str, default=SOCKET_PATH)
+arg_parser.add_argument('--backend',
+                        type=str,
+                        choices=['json', 'sqlite'],
+                        default='json')
+arg_parser.add_argument('--stats_file', type=str, default=JSON_FILE_PATH)
+arg_parser.add_argument('--log_file', type=str, default=LOG_FILE_PATH)
+arg_parser.add_argument('--sqlite_file', type=str, default=SQLITE_FILE_PATH)
+
+if __name__ == '__main__':
+  main(arg_parser.parse_args())
@@ -0,0 +1,247 @@
+import json
+import os
+import socket
+import sys
+import tempfile
+import threading
+import persistence_fake
+import trueskill_fake
+import unittest
+
+sys.modules['persistence'] = persistence_fake
+sys.modules['trueskill'] = trueskill_fake
+import oloraculo_daemon
+import oloraculo_ratings
+
+# {type:{id:[mu,sigma,w,l,k,d],...},...}
+STATS = {
+    'ad': {
+        '12': [1, 0, 2, 1, 200, 100],
+        '34': [2, 0, 1, 4, 100, 900],
+        '56': [3, 0, 3, 2, 300, 200],
+        '78': [4, 0, 1, 8, 100, 900],
+    },
+}
+
+MATCH = {
+    'red': [12, 34],
+    'blue': [56, 78],
+    'red_score': 8,
+    'blue_score': 3,
+    'kills_deaths': {
+        '12': [10, 5],
+        '34': [4, 6],
+        '56': [1, 2],
+        '78': [3, 4]
+    },
+}
+
+
+class TestOloraculoDaemon(unittest.TestCase):
+
+  def setUp(self):
+    directory = tempfile.TemporaryDirectory()
+    self.addCleanup(directory.cleanup)
+    self.stats_file = os.path.join(directory.name, 'stats.json')
+    self.log_file = os.path.join(directory.name, 'stats.log')
+    with open(self.stats_file, 'w') as stats_file:
+      stats_file.write(json.dumps(STATS))
+
+    self.socket_path = os.path.join(directory.name, 'oloraculo.sock')
+    self.service = oloraculo_daemon.RatingService(
+        oloraculo_ratings.JsonBackend(self.stats_file, self.log_file))
+    self.server = oloraculo_daemon.RatingServer(self.socket_path, self.service)
+    thread = threading.Thread(target=self.server.serve_forever,
+                              args=(0.01,),
+                              daemon=True)
+    thread.start()
+    self.addCleanup(self.server.server_close)
+    self.addCleanup(self.server.shutdown)
+
+    self.client = oloraculo_daemon.RatingClient(self.socket_path)
+    self.addCleanup(self.client.close)
+
+  def test_ratings(self):
+    response = self.client.request('ratings', 'ad', ids=[12, 90])
+    self.assertEqual({
+        '12': [1, 0, 2, 1, 200, 100],
+        '90': [25, 0, 0, 0, 0, 0]
+    }, response['rows'])
+    # Asking doesn't add players.
+    self.assertNotIn(90, self.service.stats.get_player_ids('ad'))
+
+  def test_table(self):
+    response = self.client.request('table', 'ad', generation=None)
+    self.assertEqual(STATS['ad'], response['rows'])
+
+    generation = response['generation']
+    response = self.client.request('table', 'ad', generation=generation)
+    self.assertIsNone(response['rows'])
+    self.assertEqual(generation, response['generation'])
+
+  def test_rate(self):
+    generation = self.client.request('table', 'ad')['generation']
+    response = self.client.request('rate', 'ad', match=MATCH)
+
+    self.assertEqual(generation + 1, response['generation'])
+    self.assertEqual({'12', '34', '56', '78'}, set(response['deltas']))
+    self.assertEqual([2, 0, 3, 1, 210, 105], response['rows']['12'])
+    self.assertEqual([3, 0, 1, 9, 103, 904], response['rows']['78'])
+
+    # Logged by the backend.
+    record = json.loads(open(self.log_file).read())
+    self.assertEqual([1, 0, 1, 0, 10, 5], record['deltas']['12'])
+
+    rows = self.client.request('table', 'ad', generation=generation)['rows']
+    self.assertEqual(response['rows']['12'], rows['12'])
+
+  def test_predict(self):
+    response = self.client.request('predict',
+                                   'ad',
+                                   ids=[12, 34, 56, 78],
+                                   count=2,
+                                   dont_mix=[[12, 78]])
+    ratings = {
+        player_id: trueskill_fake.Rating(STATS['ad'][str(player_id)][0])
+        for player_id in [12, 34, 56, 78]
+    }
+    expected = oloraculo_ratings.get_best_matches(
+        [12, 34, 56, 78], ratings, 2, dont_mix=frozenset([frozenset([12,
+                                                                      78])]))
+    self.assertEqual([[q, [list(a), list(b)]] for q, (a, b) in expected],
+                     response['matches'])
+    self.assertEqual([[[12, 56], [34, 78]], [[12, 34], [56, 78]]],
+                     [teams for _, teams in response['matches']])
+
+  def test_errors(self):
+    with self.assertRaisesRegex(oloraculo_daemon.RatingServiceError,
+                                'unknown op'):
+      self.client.request('drop', 'ad')
+    with self.assertRaisesRegex(oloraculo_daemon.RatingServiceError,
+                                'KeyError'):
+      self.client.request('rate', 'ad')
+    # The connection is still good.
+    self.assertTrue(self.client.request('ratings', 'ad', ids=[])['ok'])
+
+  def test_connection_reuse(self):
+    self.client.request('ratings', 'ad', ids=[12])
+    connection = self.client.connection
+    self.client.request('ratings', 'ad', ids=[34])
+    self.assertIs(connection, self.client.connection)
+
+    # Dropped connections are opened again, but matches aren't rated twice.
+    connection.shutdown(socket.SHUT_RDWR)
+    self.assertTrue(self.client.request('ratings', 'ad', ids=[12])['ok'])
+    self.assertIsNot(connection, self.client.connection)
+    self.client.connection.shutdown(socket.SHUT_RDWR)
+    with self.assertRaises(OSError):
+      self.client.request('rate', 'ad', retry=False, match=MATCH)
+    self.assertEqual([2, 1], self.service.stats.get_winloss('ad', 12))
+
+  def test_daemon_backend(self):
+    # Two servers, sharing the daemon.
+    backend_a = oloraculo_daemon.DaemonBackend(self.client)
+    client_b = oloraculo_daemon.RatingClient(self.socket_path)
+    self.addCleanup(client_b.close)
+    backend_b = oloraculo_daemon.DaemonBackend(client_b)
+    stats_a = oloraculo_ratings.Db()
+    stats_b = oloraculo_ratings.Db()
+    self.assertTrue(backend_a.load(stats_a, 'ad'))
+    self.assertTrue(backend_b.load(stats_b, 'ad'))
+    self.assertFalse(backend_a.load(stats_a, 'ad'))
+
+    exposure_deltas, deltas = oloraculo_ratings.rate_match(
+        stats_a, 'ad', MATCH)
+    self.assertEqual(exposure_deltas,
+                     backend_a.save_match(stats_a, 'ad', deltas, MATCH))
+    self.assertEqual(self.service.stats, stats_a)
+    # Nothing else changed, no need to load again.
+    self.assertFalse(backend_a.load(stats_a, 'ad'))
+
+    self.assertTrue(backend_b.load(stats_b, 'ad'))
+    self.assertEqual(stats_a, stats_b)
+    self.assertEqual([34, 78, 12, 56], [
+        player_id
+        for player_id, _ in backend_b.get_leaderboard(stats_b, 'ad')
+    ])
+
+  def test_rate_again(self):
+    response = self.client.request('rate', 'ad', match=MATCH, id='abc')
+    # The response was lost, the client sends it again.
+    self.assertEqual(response,
+                     self.client.request('rate', 'ad', match=MATCH, id='abc'))
+    self.assertEqual([3, 1], self.service.stats.get_winloss('ad', 12))
+    self.client.request('rate', 'ad', match=MATCH, id='def')
+    self.assertEqual([4, 1], self.service.stats.get_winloss('ad', 12))
+
+  def test_daemon_backend_journal(self):
+    journal_file = os.path.join(os.path.dirname(self.log_file), 'journal')
+    backend = oloraculo_daemon.DaemonBackend(
+        oloraculo_daemon.RatingClient(self.socket_path + '.off'),
+        journal_file)
+    stats = oloraculo_ratings.Db()
+    for _ in range(2):
+      with self.assertRaises(OSError):
+        backend.save_match(stats, 'ad', {}, MATCH)
+    self.assertEqual(2, len(open(journal_file).readlines()))
+
+    # Sent in order once the daemon is there, also after a restart.
+    backend = oloraculo_daemon.DaemonBackend(self.client, journal_file)
+    self.assertTrue(backend.load(stats, 'ad'))
+    self.assertEqual([4, 1], self.service.stats.get_winloss('ad', 12))
+    self.assertEqual(self.service.stats, stats)
+    self.assertEqual('', open(journal_file).read())
+    self.assertFalse(backend.load(stats, 'ad'))
+
+    # Rejected matches aren't sent again.
+    with self.assertRaises(oloraculo_daemon.RatingServiceError):
+      backend.save_match(stats, 'ad', {}, {})
+    self.assertEqual([], backend.journal)
+
+  def test_socket_in_use(self):
+    with self.assertRaises(OSError):
+      oloraculo_daemon.RatingServer(self.socket_path, self.service)
+    # still serving
+    self.assertTrue(self.client.request('ratings', 'ad', ids=[])['ok'])
+
+  def test_stale_socket(self):
+    self.server.shutdown()
+    self.server.server_close()
+    # left behind, as after a crash
+    self.assertTrue(os.path.exists(self.socket_path))
+    self.assertTrue(oloraculo_daemon.is_stale_socket(self.socket_path))
+    self.server = oloraculo_daemon.RatingServer(self.socket_path, self.service)
+    threading.Thread(target=self.server.serve_forever,
+                     args=(0.01,),
+                     daemon=True).start()
+    self.addCleanup(self.server.server_close)
+    self.addCleanup(self.server.shutdown)
+    self.client.close()
+    self.assertTrue(self.client.request('ratings', 'ad', ids=[])['ok'])
+
+    # not a socket
+    self.assertFalse(oloraculo_daemon.is_stale_socket(self.stats_file))
+
+  def test_no_stats_file(self):
+    os.remove(self.stats_file)
+    response = self.client.request('rate', 'ctf', match=MATCH)
+    self.assertEqual([26, 0, 1, 0, 10, 5], response['rows']['12'])
+
+
+  def test_no_stats_file_restart(self):
+    os.remove(self.stats_file)
+    self.client.request('rate', 'ctf', match=MATCH)
+    self.client.request('rate', 'ctf', match=MATCH)
+
+    # Only the log has the matches.
+    self.assertFalse(os.path.exists(self.stats_file))
+    service = oloraculo_daemon.RatingService(
+        oloraculo_ratings.JsonBackend(self.stats_file, self.log_file))
+    response = service.handle({'op': 'ratings', 'type': 'ctf', 'ids': [12]})
+    self.assertEqual([27, 0, 2, 0, 20, 10], response['rows']['12'])
+    service.handle({'op': 'rate', 'type': 'ctf', 'match': MATCH})
+    seqs = [json.loads(line)['seq'] for line in open(self.log_file)]
+    self.assertEqual([1, 2, 3], seqs)
+
+if __name__ == '__main__':
+  unittest.main()
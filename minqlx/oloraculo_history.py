@@ -1,51 +1,204 @@
-#!/usr/bin/python3.5
+#!/usr/bin/python3
+"""
+Rating history for oloraculo: one fixed-width record per player and match,
+for every game type.
 
+Records are appended to chunk files, one per game type and month:
+
+  <path>/<game_type>-<yyyy>-<mm>.bin
+
+Each record is RECORD_FORMAT (little endian, RECORD_SIZE bytes):
+
+  timestamp (int64, seconds), steam_id (int64), mu (double), sigma (double),
+  win, loss, kill, death (int32)
+
+Records in a chunk are in the order they were appended, which is time order,
+so a date range is found by bisecting. Queries memory-map the chunks and only
+read the ones overlapping the range.
+
+Usage, to print the curve of a player as TSV:
+
+  oloraculo_history.py --steam_id 76561198014448247 --game_type ad \
+      --start 2020-01-01 --end 2020-12-31
+"""
+
+import argparse
 import datetime
-import json
+import mmap
 import os
-import trueskill
-
-WORKING_PAHT = '/home/qadmin/steamcmd/steamapps/common/qlds/minqlx-plugins/'
-HISTORY_FILE_BASE = os.path.join(WORKING_PAHT, 'oloraculo_history')
-OLORACULO_STATS_FILE = os.path.join(WORKING_PAHT, 'oloraculo_stats.json')
-GAME_TYPE = 'ad'
-FIELDS = ['mu', 'sigma', 'winloss', 'killdeath']
-
-PLAYERS_BY_ID = {
-    '76561198014448247': 'BluesyQuaker',
-    '76561198261371023': 'CocoCrue',
-    '76561198257902041': 'MandioK',
-    '76561198282206581': 'Toro',
-    '76561198045070268': ']v[ - Fundiar',
-    '76561198257667410': 'cfernan77',
-    '76561198280762419': 'juanpi.diazv',
-    '76561198015775820': 'renga73',
-    '76561197969594389': 'goras',
-}
-
-
-def update_history_file(stat, data, player_ids):
-  file_name = '%s_%s.tsv' % (HISTORY_FILE_BASE, stat)
-  date = datetime.date.isoformat(datetime.date.today())
-  history_file = open(file_name, 'a+')
-  lines = ['\t'.join([date] + [str(d) for d in data])]
-  if os.stat(file_name).st_size == 0:
-    header = '\t'.join(['date'] + [PLAYERS_BY_ID[id] for id in player_ids])
-    lines = [header] + lines
-  history_file.write('\n'.join(lines) + '\n')
-
-
-stats = json.loads(open(OLORACULO_STATS_FILE).read())[GAME_TYPE]
-
-player_ids = sorted([id for id in PLAYERS_BY_ID.keys() if id in stats])
-
-names = [PLAYERS_BY_ID[id] for id in player_ids]
-ratings = [
-    trueskill.Rating(stats[id][0], stats[id][1]).exposure for id in player_ids
-]
-winloss = [stats[id][2] / float(stats[id][3]) for id in player_ids]
-killdeath = [stats[id][4] / float(stats[id][5]) for id in player_ids]
-
-update_history_file('ratings', ratings, player_ids)
-update_history_file('winloss', winloss, player_ids)
-update_history_file('killdeath', killdeath, player_ids)
+import re
+import struct
+import sys
+import time
+
+if __package__:
+  # Loaded by minqlx, as <plugins_dir>.<name>.
+  from . import persistence
+else:
+  import persistence
+
+ROOT_PATH = os.path.dirname(os.path.realpath(__file__))
+HISTORY_PATH = os.path.join(ROOT_PATH, 'oloraculo_history')
+RECORD_FORMAT = '<qqdd4i'
+RECORD = struct.Struct(RECORD_FORMAT)
+RECORD_SIZE = RECORD.size
+# Timestamp or steam_id alone, at offset 0 and 8 of a record.
+INT64 = struct.Struct('<q')
+CHUNK_FILE_REGEX = re.compile(r'^(\w+)-(\d{4})-(\d{2})\.bin$')
+
+
+def get_timestamp(value):
+  """Seconds since the epoch for a date, datetime or number (or None)."""
+  if value is None or isinstance(value, (int, float)):
+    return value
+  if not isinstance(value, datetime.datetime):
+    value = datetime.datetime(value.year, value.month, value.day)
+  return int(time.mktime(value.timetuple()))
+
+
+def get_month(timestamp):
+  date = datetime.date.fromtimestamp(timestamp)
+  return (date.year, date.month)
+
+
+def get_month_range(month):
+  """[start, end) timestamps of a (year, month)."""
+  year, month_number = month
+  next_month = (year + 1, 1) if month_number == 12 else (year, month_number + 1)
+  return (get_timestamp(datetime.date(year, month_number, 1)),
+          get_timestamp(datetime.date(next_month[0], next_month[1], 1)))
+
+
+def bisect_records(data, count, timestamp, after=False):
+  """Index of the first record at (or after, if after) timestamp."""
+  low, high = 0, count
+  while low < high:
+    middle = (low + high) // 2
+    record_time = INT64.unpack_from(data, middle * RECORD_SIZE)[0]
+    if record_time < timestamp or (after and record_time == timestamp):
+      low = middle + 1
+    else:
+      high = middle
+  return low
+
+
+class History(object):
+
+  def __init__(self, path=HISTORY_PATH):
+    self.path = path
+    self.path_created = False
+    # Chunks already cut to whole records.
+    self.trimmed_file_names = set()
+
+  def get_chunk_file_name(self, game_type, month):
+    return os.path.join(self.path,
+                        '%s-%04d-%02d.bin' % (game_type, month[0], month[1]))
+
+  def get_chunk_file_names(self, game_type, start=None, end=None):
+    """Chunks of game_type that may have records in [start, end], in order."""
+    if not os.path.isdir(self.path):
+      return []
+    chunks = []
+    for file_name in os.listdir(self.path):
+      match = CHUNK_FILE_REGEX.match(file_name)
+      if not match or match.group(1) != game_type:
+        continue
+      month = (int(match.group(2)), int(match.group(3)))
+      month_start, month_end = get_month_range(month)
+      if end is not None and month_start > end:
+        continue
+      if start is not None and month_end <= start:
+        continue
+      chunks.append((month, os.path.join(self.path, file_name)))
+    return [file_name for _, file_name in sorted(chunks)]
+
+  def append(self, game_type, rows, timestamp=None):
+    """Records rows ({steam_id: (mu, sigma, w, l, k, d)}) of a match."""
+    if not rows:
+      return
+    timestamp = int(time.time() if timestamp is None else timestamp)
+    if not self.path_created:
+      os.makedirs(self.path, exist_ok=True)
+      self.path_created = True
+    data = b''.join(
+        RECORD.pack(timestamp, steam_id, mu, sigma, w, l, k, d)
+        for steam_id, (mu, sigma, w, l, k, d) in sorted(rows.items()))
+    file_name = self.get_chunk_file_name(game_type, get_month(timestamp))
+    if file_name not in self.trimmed_file_names:
+      self.trim_chunk(file_name)
+      self.trimmed_file_names.add(file_name)
+    persistence.append(file_name, data)
+
+  def trim_chunk(self, file_name):
+    """Drops a partially written record at the end of a chunk.
+
+    Left by a crash in the middle of an append, it would shift every record
+    appended after it.
+    """
+    persistence.flush(file_name)
+    try:
+      size = os.path.getsize(file_name)
+    except FileNotFoundError:
+      return
+    if size % RECORD_SIZE:
+      os.truncate(file_name, size - size % RECORD_SIZE)
+
+  def get_curve(self, steam_id, game_type, start=None, end=None):
+    """Returns the records of a player between start and end, inclusive.
+
+    start and end are dates, datetimes or timestamps. Records are
+    (timestamp, mu, sigma, w, l, k, d) tuples, oldest first.
+    """
+    start = get_timestamp(start)
+    end = get_timestamp(end)
+    curve = []
+    for file_name in self.get_chunk_file_names(game_type, start, end):
+      persistence.flush(file_name)
+      with open(file_name, 'rb') as chunk_file:
+        size = os.fstat(chunk_file.fileno()).st_size
+        # Skips empty chunks (can't be mapped) and a partially written record.
+        count = size // RECORD_SIZE
+        if count == 0:
+          continue
+        with mmap.mmap(chunk_file.fileno(), count * RECORD_SIZE,
+                       access=mmap.ACCESS_READ) as data:
+          curve += self.read_chunk(data, count, steam_id, start, end)
+    return curve
+
+  def read_chunk(self, data, count, steam_id, start, end):
+    first = 0 if start is None else bisect_records(data, count, start)
+    last = count if end is None else bisect_records(data, count, end, True)
+    records = []
+    for offset in range(first * RECORD_SIZE, last * RECORD_SIZE, RECORD_SIZE):
+      if INT64.unpack_from(data, offset + 8)[0] == steam_id:
+        record = RECORD.unpack_from(data, offset)
+        records.append((record[0],) + record[2:])
+    return records
+
+
+def parse_date(value):
+  return datetime.datetime.strptime(value, '%Y-%m-%d').date()
+
+
+arg_parser = argparse.ArgumentParser(
+    description='Prints the oloraculo rating curve of a player.')
+arg_parser.add_argument('--steam_id', type=int, required=True)
+arg_parser.add_argument('--game_type', type=str, default='ad')
+arg_parser.add_argument('--start', type=parse_date, default=None)
+arg_parser.add_argument('--end',
+                        type=parse_date,
+                        default=None,
+                        help='Last day, included.')
+arg_parser.add_argument('--path', type=str, default=HISTORY_PATH)
+
+if __name__ == '__main__':
+  args = arg_parser.parse_args()
+  end = None
+  if args.end:
+    end = get_timestamp(args.end + datetime.timedelta(days=1)) - 1
+  curve = History(args.path).get_curve(args.steam_id, args.game_type,
+                                       args.start, end)
+  sys.stdout.write('date\tmu\tsigma\twin\tloss\tkill\tdeath\n')
+  for record in curve:
+    date = datetime.datetime.fromtimestamp(record[0]).isoformat()
+    sys.stdout.write('\t'.join([date] + [str(v) for v in record[1:]]) + '\n')
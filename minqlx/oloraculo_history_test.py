@@ -0,0 +1,108 @@
+import datetime
+import os
+import sys
+import tempfile
+import persistence_fake
+import unittest
+
+sys.modules['persistence'] = persistence_fake
+import oloraculo_history
+
+
+def get_time(year, month, day, hour=0):
+  return oloraculo_history.get_timestamp(
+      datetime.datetime(year, month, day, hour))
+
+
+# [(timestamp, {steam_id: (mu, sigma, w, l, k, d)}), ...]
+MATCHES = [
+    (get_time(2020, 1, 30), {
+        12: (26, 8, 1, 0, 10, 5),
+        34: (24, 8, 0, 1, 5, 10)
+    }),
+    (get_time(2020, 1, 31), {
+        12: (27, 7, 2, 0, 20, 10),
+        56: (23, 8, 0, 1, 3, 10)
+    }),
+    (get_time(2020, 2, 1), {
+        12: (26, 7, 2, 1, 25, 20),
+        34: (25, 7, 1, 1, 15, 15)
+    }),
+    (get_time(2020, 2, 3, 12), {
+        12: (28, 6, 3, 1, 40, 25)
+    }),
+]
+
+
+class TestOloraculoHistory(unittest.TestCase):
+
+  def setUp(self):
+    self.directory = tempfile.TemporaryDirectory()
+    self.path = os.path.join(self.directory.name, 'history')
+    self.history = oloraculo_history.History(self.path)
+    for timestamp, rows in MATCHES:
+      self.history.append('ad', rows, timestamp)
+    self.history.append('ca', {12: (1, 2, 3, 4, 5, 6)}, MATCHES[0][0])
+
+  def tearDown(self):
+    self.directory.cleanup()
+
+  def get_curve(self, steam_id, game_type='ad', start=None, end=None):
+    return self.history.get_curve(steam_id, game_type, start, end)
+
+  def test_chunks(self):
+    self.assertEqual(['ad-2020-01.bin', 'ad-2020-02.bin', 'ca-2020-01.bin'],
+                     sorted(os.listdir(self.path)))
+    self.assertEqual(
+        3 * oloraculo_history.RECORD_SIZE,
+        os.path.getsize(os.path.join(self.path, 'ad-2020-02.bin')))
+    self.assertEqual([os.path.join(self.path, 'ad-2020-02.bin')],
+                     self.history.get_chunk_file_names(
+                         'ad', get_time(2020, 2, 2), get_time(2020, 3, 1)))
+
+  def test_get_curve(self):
+    self.assertEqual([(timestamp,) + rows[12] for timestamp, rows in MATCHES],
+                     self.get_curve(12))
+    self.assertEqual([(MATCHES[1][0],) + MATCHES[1][1][56]],
+                     self.get_curve(56))
+    self.assertEqual([(MATCHES[0][0], 1, 2, 3, 4, 5, 6)],
+                     self.get_curve(12, 'ca'))
+    self.assertEqual([], self.get_curve(78))
+    self.assertEqual([], self.get_curve(12, 'ctf'))
+
+  def test_get_curve_range(self):
+    # Dates are midnight, so 2020-02-03 leaves the last match out.
+    curve = self.get_curve(12, start=datetime.date(2020, 1, 31),
+                           end=datetime.date(2020, 2, 3))
+    self.assertEqual([MATCHES[1][0], MATCHES[2][0]], [r[0] for r in curve])
+
+    # Inclusive on both ends.
+    curve = self.get_curve(34, start=MATCHES[0][0], end=MATCHES[2][0])
+    self.assertEqual([MATCHES[0][0], MATCHES[2][0]], [r[0] for r in curve])
+
+    self.assertEqual([], self.get_curve(12, start=datetime.date(2021, 1, 1)))
+    self.assertEqual([], self.get_curve(12, end=datetime.date(2019, 1, 1)))
+
+  def test_partial_record(self):
+    with open(os.path.join(self.path, 'ad-2020-02.bin'), 'ab') as chunk_file:
+      chunk_file.write(b'\x00' * (oloraculo_history.RECORD_SIZE // 2))
+    self.assertEqual(len(MATCHES), len(self.get_curve(12)))
+
+    # after a restart, appending drops it rather than writing after it
+    self.history = oloraculo_history.History(self.path)
+    self.history.append('ad', {12: (29, 5, 4, 1, 50, 30)}, get_time(2020, 2, 4))
+    self.assertEqual(
+        4 * oloraculo_history.RECORD_SIZE,
+        os.path.getsize(os.path.join(self.path, 'ad-2020-02.bin')))
+    self.assertEqual((get_time(2020, 2, 4), 29, 5, 4, 1, 50, 30),
+                     self.get_curve(12)[-1])
+
+  def test_empty(self):
+    open(os.path.join(self.path, 'ad-2020-03.bin'), 'wb').close()
+    self.assertEqual(len(MATCHES), len(self.get_curve(12)))
+    history = oloraculo_history.History(os.path.join(self.path, 'nope'))
+    self.assertEqual([], history.get_curve(12, 'ad'))
+
+
+if __name__ == '__main__':
+  unittest.main()
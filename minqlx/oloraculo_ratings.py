@@ -0,0 +1,1086 @@
+import array
+import bisect
+import heapq
+import itertools
+import json
+import os
+import sqlite3
+import trueskill
+
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
+if __package__:
+  # Loaded by minqlx, as <plugins_dir>.<name>.
+  from . import persistence
+else:
+  import persistence
+"""
+oloraculo ratings without the plugin: the in-memory Db, the storage backends,
+rating a match and ranking the possible teams. Used by the oloraculo plugin
+and by oloraculo_daemon, which runs outside of minqlx.
+"""
+"""
+JSON data file for reference, with a game type per line so that loading one
+doesn't parse the others (files without the line per game type are parsed at
+once):
+{
+"_seq": last_log_record_included,
+"game_type": {"steam_id": [mu, sigma, games_won, games_lost, kills, deaths]},
+...
+}
+
+Log file for reference, one record (of changes) per rated match. Records
+newer than "_seq" are applied on top of the JSON data file:
+{"seq": 1, "type": "game_type", "deltas": {"steam_id": [mu, sigma, w, l, k, d]}}
+"""
+
+# Fold the log into the JSON data file once it has this many records.
+LOG_COMPACTION_RECORDS = 50
+SEQ_KEY = '_seq'
+# How to rank matches: 'search' (branch and bound), 'exhaustive' (score every
+# partition with trueskill.quality) or 'numpy' (score chunks of partitions
+# with numpy).
+ENGINES = ['search', 'exhaustive', 'numpy']
+# Slack for float rounding when comparing bounds with actual differences.
+BOUND_EPSILON = 1e-9
+# Splits scored at once by the numpy engine.
+VECTORIZED_CHUNK_SIZE = 65536
+
+
+def split_game_types(lines):
+  """{'game_type': 'its JSON text', ...} of a file written by Db.save.
+
+  lines are those after the opening '{'. Only the keys are parsed.
+  """
+  json_data = {}
+  decoder = json.JSONDecoder()
+  for line in lines:
+    line = line.strip()
+    if line == '}':
+      break
+    key, end = decoder.raw_decode(line)
+    value = line[end:].lstrip()
+    if not value.startswith(':'):
+      raise ValueError('Expected ":" after %s' % key)
+    json_data[key] = value[1:].rstrip(',').strip()
+  return json_data
+
+
+class Table(object):
+  """Ratings and stats of one game type, stored column by column.
+
+  Each player has a row: index maps its id to the row, and row N of every
+  column array belongs to the same player.
+  """
+
+  def __init__(self):
+    # {player_id: row, ...}
+    self.index = {}
+    self.player_ids = array.array('q')
+    self.mus = array.array('d')
+    self.sigmas = array.array('d')
+    self.wins = array.array('q')
+    self.losses = array.array('q')
+    self.kills = array.array('q')
+    self.deaths = array.array('q')
+
+  def __eq__(self, other):
+    return dict(self.rows()) == dict(other.rows())
+
+  def __len__(self):
+    return len(self.index)
+
+  def get_row(self, player_id):
+    row = self.index.get(player_id)
+    if row is None:
+      row = len(self.player_ids)
+      rating = trueskill.Rating()
+      self.index[player_id] = row
+      self.player_ids.append(player_id)
+      self.mus.append(rating.mu)
+      self.sigmas.append(rating.sigma)
+      for column in [self.wins, self.losses, self.kills, self.deaths]:
+        column.append(0)
+    return row
+
+  def copy(self):
+    table = Table()
+    table.index = dict(self.index)
+    for name in [
+        'player_ids', 'mus', 'sigmas', 'wins', 'losses', 'kills', 'deaths'
+    ]:
+      setattr(table, name, getattr(self, name)[:])
+    return table
+
+  def rows(self):
+    # [(player_id, (mu, sigma, win, loss, kill, death)), ...]
+    return zip(
+        self.player_ids,
+        zip(self.mus, self.sigmas, self.wins, self.losses, self.kills,
+            self.deaths))
+
+
+class Db(object):
+
+  def __init__(self):
+    # {'game_type': Table, ...}
+    self._tables = {}
+
+    # Game types whose Table is shared with a snapshot: copied before the
+    # first write.
+    self._shared = set()
+
+    # Loaded but not yet materialized game types, as read from the file:
+    # {'game_type': {'player_id': [mu, sigma, win, loss, k, d], ...}, ...},
+    # or the JSON text of that, not yet parsed.
+    self._pending = {}
+
+    # (mtime, size) of the file last loaded or saved.
+    self._file_signature = None
+
+    # Sequence number of the last log record applied.
+    self._seq = 0
+    # Records in the log file and its (mtime, size) when last read or written.
+    self._log_records = 0
+    self._log_signature = None
+    # Whether the log ends with a partially written record, which the next
+    # one mustn't be appended to.
+    self._log_partial = False
+
+  def __eq__(self, other):
+    tables = {k: self._get_table(k) for k in self.get_game_types()}
+    other_tables = {k: other._get_table(k) for k in other.get_game_types()}
+    return ({k: v for k, v in tables.items() if len(v)} ==
+            {k: v for k, v in other_tables.items() if len(v)})
+
+  def _materialize(self, game_type):
+    data = self._pending.pop(game_type, None)
+    if data is None:
+      return
+    if isinstance(data, str):
+      data = json.loads(data)
+    for player_id, datum in data.items():
+      self.set_row(game_type, player_id, datum)
+
+  def _get_table(self, game_type):
+    self._materialize(game_type)
+    return self._tables.get(game_type)
+
+  def _table(self, game_type):
+    # Write access.
+    self._materialize(game_type)
+    if game_type in self._shared:
+      self._shared.discard(game_type)
+      self._tables[game_type] = self._tables[game_type].copy()
+    return self._tables.setdefault(game_type, Table())
+
+  def snapshot(self):
+    """Returns a copy of the ratings, without copying them.
+
+    Both Dbs share their tables until one of them writes to a game type,
+    which then gets its own copy of that table only.
+    """
+    snapshot = Db()
+    snapshot._tables = dict(self._tables)
+    snapshot._pending = dict(self._pending)
+    snapshot._shared = set(self._tables)
+    self._shared = set(self._tables)
+    return snapshot
+
+  def _row(self, game_type, player_id):
+    # Read-only lookup: doesn't add missing players.
+    table = self._get_table(game_type)
+    if table is None:
+      return None, None
+    return table, table.index.get(int(player_id))
+
+  def set_rating(self, game_type, player_id, rating):
+    table = self._table(game_type)
+    row = table.get_row(int(player_id))
+    table.mus[row] = rating.mu
+    table.sigmas[row] = rating.sigma
+
+  def set_winloss(self, game_type, player_id, winloss):
+    table = self._table(game_type)
+    row = table.get_row(int(player_id))
+    table.wins[row], table.losses[row] = winloss
+
+  def set_killdeath(self, game_type, player_id, killdeath):
+    table = self._table(game_type)
+    row = table.get_row(int(player_id))
+    table.kills[row], table.deaths[row] = killdeath
+
+  def add_winloss(self, game_type, player_id, wins, losses):
+    table = self._table(game_type)
+    row = table.get_row(int(player_id))
+    table.wins[row] += wins
+    table.losses[row] += losses
+
+  def add_killdeath(self, game_type, player_id, kills, deaths):
+    table = self._table(game_type)
+    row = table.get_row(int(player_id))
+    table.kills[row] += kills
+    table.deaths[row] += deaths
+
+  def get_rating(self, game_type, player_id):
+    table, row = self._row(game_type, player_id)
+    if row is None:
+      return trueskill.Rating()
+    return trueskill.Rating(table.mus[row], table.sigmas[row])
+
+  def get_winloss(self, game_type, player_id):
+    table, row = self._row(game_type, player_id)
+    if row is None:
+      return [0, 0]
+    return [table.wins[row], table.losses[row]]
+
+  def get_killdeath(self, game_type, player_id):
+    table, row = self._row(game_type, player_id)
+    if row is None:
+      return [0, 0]
+    return [table.kills[row], table.deaths[row]]
+
+  def get_player_ids(self, game_type):
+    table = self._get_table(game_type)
+    return set(table.index) if table else set()
+
+  def get_game_types(self):
+    return set(self._tables) | set(self._pending)
+
+  def get_rows(self, game_type):
+    """Yields (player_id, (mu, sigma, win, loss, kill, death)) per player."""
+    table = self._get_table(game_type)
+    return table.rows() if table else iter([])
+
+  def get_row(self, game_type, player_id):
+    """Returns (mu, sigma, win, loss, kill, death) for player_id."""
+    table, row = self._row(game_type, player_id)
+    if row is None:
+      rating = trueskill.Rating()
+      return (rating.mu, rating.sigma, 0, 0, 0, 0)
+    return (table.mus[row], table.sigmas[row], table.wins[row],
+            table.losses[row], table.kills[row], table.deaths[row])
+
+  def set_row(self, game_type, player_id, values):
+    """Sets (mu, sigma, win, loss, kill, death) for player_id."""
+    table = self._table(game_type)
+    row = table.get_row(int(player_id))
+    (table.mus[row], table.sigmas[row], table.wins[row], table.losses[row],
+     table.kills[row], table.deaths[row]) = values
+
+  def apply_deltas(self, game_type, deltas):
+    # deltas: {'player_id': [d_mu, d_sigma, d_w, d_l, d_k, d_d], ...}
+    table = self._table(game_type)
+    for player_id, delta in deltas.items():
+      row = table.get_row(int(player_id))
+      table.mus[row] += delta[0]
+      table.sigmas[row] += delta[1]
+      table.wins[row] += delta[2]
+      table.losses[row] += delta[3]
+      table.kills[row] += delta[4]
+      table.deaths[row] += delta[5]
+
+  def new_player(self, game_type, player_id):
+    self._table(game_type).get_row(int(player_id))
+
+  def _set_file_signature(self, file_name):
+    self._file_signature = self._get_file_signature(file_name)
+
+  def _set_log_signature(self, log_file_name):
+    self._log_signature = self._get_file_signature(log_file_name)
+
+  def _get_file_signature(self, file_name):
+    try:
+      stat = os.stat(file_name)
+    except OSError:
+      return None
+    return (stat.st_mtime_ns, stat.st_size)
+
+  def load(self, file_name, game_type=None):
+    """Loads file_name, unless it didn't change since the last load or save.
+
+    Game types are only turned into tables when first used, or right away
+    for game_type. A missing file_name isn't read: nothing was folded into it
+    yet, so everything is still in the log, see replay_log(). Returns whether
+    the file was read.
+    """
+    persistence.flush(file_name)
+    signature = self._get_file_signature(file_name)
+    if signature is not None and signature == self._file_signature:
+      return False
+
+    try:
+      stats_file = open(file_name)
+    except FileNotFoundError:
+      return False
+    # {'type': {'pid': [rating.mu, rating.sigma, win, loss, k, d], ...}, ...}
+    with stats_file:
+      first_line = stats_file.readline()
+      if first_line == '{\n':
+        json_data = split_game_types(stats_file)
+        self._seq = json.loads(json_data.pop(SEQ_KEY, '0'))
+      else:
+        json_data = json.loads(first_line + stats_file.read())
+        self._seq = json_data.pop(SEQ_KEY, 0)
+    self._pending.update(json_data)
+    self._file_signature = signature
+    # Log records after _seq have to be applied again.
+    self._log_signature = None
+    if game_type:
+      self._materialize(game_type)
+    return True
+
+  def save(self, file_name, on_written=None):
+    game_types = self.get_game_types()
+    player_ids = set()
+    for game_type in game_types:
+      player_ids.update(self.get_player_ids(game_type))
+
+    json_data = {}
+    for game_type in game_types:
+      data = json_data.setdefault(game_type, {})
+      for player_id in player_ids:
+        rating = self.get_rating(game_type, player_id)
+        winloss = self.get_winloss(game_type, player_id)
+        killdeath = self.get_killdeath(game_type, player_id)
+        data[str(player_id)] = [
+            rating.mu, rating.sigma, winloss[0], winloss[1], killdeath[0],
+            killdeath[1]
+        ]
+
+    json_data[SEQ_KEY] = self._seq
+
+    lines = [
+        '%s: %s' % (json.dumps(key), json.dumps(json_data[key], sort_keys=True))
+        for key in sorted(json_data)
+    ]
+
+    def written():
+      self._set_file_signature(file_name)
+      if on_written:
+        on_written()
+
+    persistence.save(file_name, '{\n%s\n}\n' % ',\n'.join(lines), written)
+
+  def replay_log(self, log_file_name):
+    """Applies the log records newer than the loaded data.
+
+    Returns the number of records applied.
+    """
+    persistence.flush(log_file_name)
+    signature = self._get_file_signature(log_file_name)
+    if signature is None or signature == self._log_signature:
+      return 0
+
+    applied = 0
+    self._log_records = 0
+    self._log_partial = False
+    for line in open(log_file_name):
+      self._log_partial = not line.endswith('\n')
+      try:
+        record = json.loads(line)
+        seq, game_type, deltas = record['seq'], record['type'], record['deltas']
+      except (ValueError, KeyError, TypeError):
+        # Partially written last record, most likely.
+        continue
+      self._log_records += 1
+      if seq > self._seq:
+        self.apply_deltas(game_type, deltas)
+        self._seq = seq
+        applied += 1
+
+    self._log_signature = signature
+    return applied
+
+  def append_log(self, log_file_name, game_type, deltas):
+    """Appends a record with deltas, already applied in memory, to the log."""
+    self._seq += 1
+    record = {
+        'seq': self._seq,
+        'type': game_type,
+        'deltas': {str(k): v for k, v in deltas.items()}
+    }
+    data = json.dumps(record, separators=(',', ':')) + '\n'
+    if self._log_partial:
+      # Ends the partial record (skipped on replay) instead of joining it.
+      data = '\n' + data
+      self._log_partial = False
+    persistence.append(log_file_name, data,
+                       lambda: self._set_log_signature(log_file_name))
+    self._log_records += 1
+
+  def get_log_records(self):
+    return self._log_records
+
+  def compact(self, file_name, log_file_name):
+    """Folds the log into file_name and empties the log."""
+
+    def empty_log():
+      # Runs on the writer thread right after the snapshot is written: every
+      # record in the log is folded into it, and the records queued since are
+      # only written after this. A truncate queued on its own could overtake
+      # the snapshot when a later save of file_name replaces it.
+      persistence.write_atomically(log_file_name, '')
+      self._set_log_signature(log_file_name)
+
+    self.save(file_name, empty_log)
+    self._log_records = 0
+    self._log_partial = False
+
+
+class JsonBackend(object):
+  """Keeps ratings in a JSON file plus a log of changes, see Db."""
+
+  def __init__(self, file_name, log_file_name):
+    self.file_name = file_name
+    self.log_file_name = log_file_name
+
+  def load(self, stats, game_type):
+    loaded = stats.load(self.file_name, game_type)
+    replayed = stats.replay_log(self.log_file_name)
+    return loaded or replayed
+
+  def add_player(self, stats, game_type, player_id):
+    # Only written once the player plays.
+    pass
+
+  def save_match(self, stats, game_type, deltas, match=None):
+    stats.append_log(self.log_file_name, game_type, deltas)
+    if stats.get_log_records() >= LOG_COMPACTION_RECORDS:
+      stats.compact(self.file_name, self.log_file_name)
+
+  def get_leaderboard(self, stats, game_type):
+    return sorted(stats.get_rows(game_type),
+                  key=lambda row: trueskill.Rating(*row[1][:2]).exposure,
+                  reverse=True)
+
+
+class SqliteBackend(object):
+  """Keeps ratings in an SQLite database, one row per game type and player."""
+
+  SCHEMA = [
+      """
+      CREATE TABLE IF NOT EXISTS ratings (
+        game_type TEXT NOT NULL,
+        steam_id INTEGER NOT NULL,
+        mu REAL NOT NULL,
+        sigma REAL NOT NULL,
+        w INTEGER NOT NULL DEFAULT 0,
+        l INTEGER NOT NULL DEFAULT 0,
+        k INTEGER NOT NULL DEFAULT 0,
+        d INTEGER NOT NULL DEFAULT 0,
+        exposure REAL NOT NULL,
+        PRIMARY KEY (game_type, steam_id)
+      )
+      """,
+      """
+      CREATE INDEX IF NOT EXISTS ratings_by_exposure
+        ON ratings (game_type, exposure DESC)
+      """,
+  ]
+
+  UPSERT = """
+      INSERT INTO ratings (game_type, steam_id, mu, sigma, w, l, k, d, exposure)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT (game_type, steam_id) DO UPDATE SET
+          mu = excluded.mu, sigma = excluded.sigma, w = excluded.w,
+          l = excluded.l, k = excluded.k, d = excluded.d,
+          exposure = excluded.exposure
+      """
+
+  def __init__(self, file_name):
+    self.file_name = file_name
+    self.connection = None
+    # {'game_type': data_version when loaded, ...}
+    self.loaded_versions = {}
+
+  def connect(self):
+    if self.connection is None:
+      # oloraculo_daemon uses it from its request threads, one at a time.
+      self.connection = sqlite3.connect(self.file_name,
+                                        check_same_thread=False)
+      self.connection.execute('PRAGMA journal_mode=WAL')
+      with self.connection:
+        for statement in SqliteBackend.SCHEMA:
+          self.connection.execute(statement)
+    return self.connection
+
+  def close(self):
+    if self.connection is not None:
+      self.connection.close()
+      self.connection = None
+
+  def get_values(self, stats, game_type, player_id):
+    values = stats.get_row(game_type, player_id)
+    exposure = trueskill.Rating(values[0], values[1]).exposure
+    return (game_type, int(player_id)) + tuple(values) + (exposure,)
+
+  def load(self, stats, game_type):
+    connection = self.connect()
+    # Changes whenever another connection commits.
+    version = connection.execute('PRAGMA data_version').fetchone()[0]
+    if self.loaded_versions.get(game_type) == version:
+      return False
+
+    rows = connection.execute(
+        'SELECT steam_id, mu, sigma, w, l, k, d FROM ratings '
+        'WHERE game_type = ?', (game_type,))
+    for row in rows:
+      stats.set_row(game_type, row[0], row[1:])
+    self.loaded_versions[game_type] = version
+    return True
+
+  def add_player(self, stats, game_type, player_id):
+    with self.connect() as connection:
+      connection.execute(
+          'INSERT OR IGNORE INTO ratings VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+          self.get_values(stats, game_type, player_id))
+
+  def save_match(self, stats, game_type, deltas, match=None):
+    self.save_players(stats, game_type, deltas.keys())
+
+  def save_players(self, stats, game_type, player_ids):
+    # One transaction for all the players.
+    with self.connect() as connection:
+      connection.executemany(SqliteBackend.UPSERT, [
+          self.get_values(stats, game_type, player_id)
+          for player_id in player_ids
+      ])
+
+  def import_stats(self, stats):
+    """Copies every player of every game type in stats. Returns the count."""
+    count = 0
+    for game_type in stats.get_game_types():
+      player_ids = stats.get_player_ids(game_type)
+      self.save_players(stats, game_type, player_ids)
+      count += len(player_ids)
+    return count
+
+  def get_leaderboard(self, stats, game_type):
+    rows = self.connect().execute(
+        'SELECT steam_id, mu, sigma, w, l, k, d FROM ratings '
+        'WHERE game_type = ? ORDER BY exposure DESC', (game_type,))
+    return [(row[0], row[1:]) for row in rows]
+
+
+class Leaderboard(object):
+  """The players of one game type, kept sorted by exposure.
+
+  Built once from the backend, then updated one player at a time, so printing
+  it never sorts. Also keeps the largest win / loss and kill / death counts,
+  used to align the ratio columns. Counts only grow, so a running max is
+  enough.
+  """
+
+  def __init__(self, leaderboard=()):
+    # Sorted [(-exposure, player_id), ...], best player first.
+    self.keys = []
+    # {player_id: (-exposure, (mu, sigma, w, l, k, d))}
+    self.rows = {}
+    self.max_wl = 0
+    self.max_kd = 0
+    for player_id, row in leaderboard:
+      self.rows[player_id] = (self.get_key(player_id, row)[0], tuple(row))
+      self.update_maxes(row)
+    self.keys = sorted(
+        (sort_key, player_id) for player_id, (sort_key, _) in self.rows.items())
+
+  def __iter__(self):
+    """Yields (player_id, exposure, (mu, sigma, w, l, k, d)), best first."""
+    for sort_key, player_id in self.keys:
+      yield player_id, -sort_key, self.rows[player_id][1]
+
+  def __len__(self):
+    return len(self.keys)
+
+  def get_key(self, player_id, row):
+    return (-trueskill.Rating(row[0], row[1]).exposure, player_id)
+
+  def update_maxes(self, row):
+    self.max_wl = max(self.max_wl, row[2], row[3])
+    self.max_kd = max(self.max_kd, row[4], row[5])
+
+  def update(self, player_id, row):
+    if player_id in self.rows:
+      old_key = (self.rows[player_id][0], player_id)
+      del self.keys[bisect.bisect_left(self.keys, old_key)]
+    key = self.get_key(player_id, row)
+    bisect.insort(self.keys, key)
+    self.rows[player_id] = (key[0], tuple(row))
+    self.update_maxes(row)
+
+
+def parse_dont_mix(value):
+  """Parses "id:id,id:id" into a frozenset of frozenset({id, id}) pairs.
+
+  Entries that aren't two different numeric ids are ignored.
+  """
+  pairs = set()
+  for entry in (value or '').split(','):
+    ids = entry.strip().split(':')
+    if len(ids) != 2 or not all(id.strip().isdigit() for id in ids):
+      continue
+    pair = frozenset(int(id) for id in ids)
+    if len(pair) == 2:
+      pairs.add(pair)
+  return frozenset(pairs)
+
+
+def get_conflicts(player_ids, dont_mix):
+  """{player_id: set(ids it can't play with)}, for player_ids only."""
+  present = set(player_ids)
+  conflicts = {}
+  for pair in dont_mix or ():
+    if pair <= present:
+      player_a, player_b = pair
+      conflicts.setdefault(player_a, set()).add(player_b)
+      conflicts.setdefault(player_b, set()).add(player_a)
+  return conflicts
+
+
+def get_team_partitions(player_ids, dont_mix=None):
+  """Yields every (team_a, team_b) split of player_ids exactly once.
+
+  Teams have len(player_ids) / 2 players each. With an odd number of players
+  one of them sits out of each split. The first playing player is pinned to
+  team_a, so (a, b) and (b, a) are never both generated. Teams keep the order
+  of player_ids.
+
+  Splits putting a dont_mix pair (see parse_dont_mix()) in the same team are
+  pruned while the teams are built, so they are never generated.
+  """
+  player_ids = list(player_ids)
+  players_per_team = int(len(player_ids) / 2)
+
+  if len(player_ids) % 2:
+    for index in range(len(player_ids)):
+      yield from get_team_partitions(
+          player_ids[:index] + player_ids[index + 1:], dont_mix)
+    return
+
+  if players_per_team == 0:
+    return
+
+  conflicts = get_conflicts(player_ids, dont_mix)
+  if conflicts:
+    yield from get_constrained_partitions(player_ids, conflicts)
+    return
+
+  first = player_ids[0]
+  rest = player_ids[1:]
+  for combination in itertools.combinations(range(len(rest)),
+                                            players_per_team - 1):
+    team_a = (first,) + tuple(rest[i] for i in combination)
+    chosen = set(combination)
+    team_b = tuple(rest[i] for i in range(len(rest)) if i not in chosen)
+    yield team_a, team_b
+
+
+def get_constrained_partitions(player_ids, conflicts):
+  # Same splits and order as get_team_partitions(), minus the ones where a
+  # player joins a team with someone in conflicts[player].
+  players_per_team = int(len(player_ids) / 2)
+  no_conflicts = set()
+  team_a = [player_ids[0]]
+  team_b = []
+
+  def split(index):
+    if index == len(player_ids):
+      yield tuple(team_a), tuple(team_b)
+      return
+    player_id = player_ids[index]
+    partners = conflicts.get(player_id, no_conflicts)
+    for team in (team_a, team_b):
+      if len(team) == players_per_team or not partners.isdisjoint(team):
+        continue
+      team.append(player_id)
+      yield from split(index + 1)
+      team.pop()
+
+  yield from split(1)
+
+
+def get_best_partitions(player_ids, mus, count, dont_mix=None):
+  """Returns the splits of player_ids with the smallest skill difference.
+
+  mus maps each player id to its rating mu. The result is a list of
+  (team_a, team_b) tuples like the ones from get_team_partitions(), in the
+  same order. It holds the count splits with the smallest
+  |sum(mu_a) - sum(mu_b)|, the first ones in that order among equal
+  differences: with an odd number of players, up to count splits for each
+  player sitting out, since those aren't comparable by mu alone.
+
+  TrueSkill's two-team match quality strictly decreases as that difference
+  grows (for a fixed set of players), so the best matches are among these.
+  The search is a branch and bound: partial teams are dropped as soon as
+  they can't beat the count-th best complete split found so far, by
+  difference or, when they can only tie it, by order. Teams with a dont_mix
+  pair are dropped right away.
+  """
+  player_ids = list(player_ids)
+  if len(player_ids) % 2:
+    partitions = []
+    for index in range(len(player_ids)):
+      partitions += get_best_partitions(
+          player_ids[:index] + player_ids[index + 1:], mus, count, dont_mix)
+    return partitions
+
+  player_count = len(player_ids)
+  players_per_team = int(player_count / 2)
+  if players_per_team == 0 or count < 1:
+    return []
+
+  # Strongest players first: good splits are found early, which tightens the
+  # bound for the rest of the search.
+  order = sorted(player_ids, key=lambda player_id: -mus[player_id])
+  values = [mus[player_id] for player_id in order]
+  prefix = [0.0]
+  for value in values:
+    prefix.append(prefix[-1] + value)
+  position = {player_id: index for index, player_id in enumerate(player_ids)}
+  # Splits are ordered by the positions of the team with player_ids[0]: as a
+  # bitmask with the first position as the highest bit, earlier splits have
+  # bigger keys.
+  bits = [1 << (player_count - 1 - position[player_id]) for player_id in order]
+  first_bit = 1 << (player_count - 1)
+  conflicts = get_conflicts(player_ids, dont_mix)
+  no_conflicts = set()
+
+  # Min-heap of (-difference, key, (team_a, team_b)): the root is the worst
+  # kept.
+  heap = []
+  team_a = [order[0]]
+  team_b = []
+
+  def push(difference, mask_a, mask_b):
+    # Same orientation and player order as get_team_partitions().
+    teams = [
+        tuple(sorted(team_a, key=position.get)),
+        tuple(sorted(team_b, key=position.get))
+    ]
+    if position[teams[1][0]] < position[teams[0][0]]:
+      teams.reverse()
+    entry = (-difference, mask_a if mask_a & first_bit else mask_b,
+             tuple(teams))
+    if len(heap) < count:
+      heapq.heappush(heap, entry)
+    elif entry > heap[0]:
+      heapq.heapreplace(heap, entry)
+
+  def get_best_key(mask_a, mask_b):
+    """Biggest key of the splits completing mask_a and mask_b, or -1."""
+    missing = [
+        players_per_team - bin(mask).count('1') for mask in [mask_a, mask_b]
+    ]
+    if min(missing) < 0:
+      return -1
+    best_key = -1
+    free = ~(mask_a | mask_b) & (2 * first_bit - 1)
+    for mask, missing_players in zip([mask_a, mask_b], missing):
+      # The first free positions join mask.
+      mask_free = free
+      for _ in range(missing_players):
+        top = 1 << (mask_free.bit_length() - 1)
+        mask |= top
+        mask_free ^= top
+      if mask & first_bit:
+        best_key = max(best_key, mask)
+    return best_key
+
+  def search(index, sum_a, sum_b, mask_a, mask_b):
+    if index == player_count:
+      push(abs(sum_a - sum_b), mask_a, mask_b)
+      return
+
+    # Smallest |difference| reachable: team_a takes missing_a of the remaining
+    # players, so its final sum is between the weakest and strongest choice.
+    missing_a = players_per_team - len(team_a)
+    remaining = prefix[player_count] - prefix[index]
+    difference = sum_a - sum_b - remaining
+    low = difference + 2 * (prefix[player_count] -
+                            prefix[player_count - missing_a])
+    high = difference + 2 * (prefix[index + missing_a] - prefix[index])
+    bound = low if low > 0 else (-high if high < 0 else 0.0)
+    tie = False
+    if len(heap) == count:
+      worst = -heap[0][0]
+      if bound > worst + BOUND_EPSILON:
+        return
+      # At best a tie: only splits earlier than the worst kept one help.
+      # Without this, lobbies of equal ratings visit every split.
+      tie = bound >= worst - BOUND_EPSILON
+      if tie and get_best_key(mask_a, mask_b) <= heap[0][1]:
+        return
+
+    player_id = order[index]
+    value = values[index]
+    bit = bits[index]
+    partners = conflicts.get(player_id, no_conflicts)
+    sides = [(team_a, True), (team_b, False)]
+    # The side with the best splits first, as they prune the most: the most
+    # balanced one, or when only ties are left the one with earlier splits.
+    if tie:
+      if (get_best_key(mask_a, mask_b | bit) > get_best_key(
+          mask_a | bit, mask_b)):
+        sides.reverse()
+    elif sum_a > sum_b:
+      sides.reverse()
+    for team, is_team_a in sides:
+      if len(team) == players_per_team or not partners.isdisjoint(team):
+        continue
+      team.append(player_id)
+      if is_team_a:
+        search(index + 1, sum_a + value, sum_b, mask_a | bit, mask_b)
+      else:
+        search(index + 1, sum_a, sum_b + value, mask_a, mask_b | bit)
+      team.pop()
+
+  search(1, values[0], 0.0, bits[0], 0)
+  return [teams for _, _, teams in sorted(heap, key=lambda entry: -entry[1])]
+
+
+def get_membership_chunks(player_ids, dont_mix=None):
+  """Yields the splits of get_team_partitions() as int8 matrices.
+
+  Each matrix has a row for each of up to VECTORIZED_CHUNK_SIZE splits, in
+  order, and a column for each player: 1 on team_a, -1 on team_b, 0 sitting
+  out. Only one chunk of splits is in memory at a time.
+  """
+  player_ids = list(player_ids)
+  player_count = len(player_ids)
+  players_per_team = int(player_count / 2)
+
+  if player_count % 2:
+    for index in range(player_count):
+      for chunk in get_membership_chunks(
+          player_ids[:index] + player_ids[index + 1:], dont_mix):
+        yield numpy.insert(chunk, index, 0, axis=1)
+    return
+
+  if players_per_team == 0:
+    return
+
+  # Positions of the rest of team_a: player_ids[0] is always on it.
+  conflicts = get_conflicts(player_ids, dont_mix)
+  if conflicts:
+    position = {player_id: index for index, player_id in enumerate(player_ids)}
+    teams_a = (tuple(position[player_id]
+                     for player_id in team_a[1:])
+               for team_a, _ in get_constrained_partitions(
+                   player_ids, conflicts))
+  else:
+    teams_a = itertools.combinations(range(1, player_count),
+                                     players_per_team - 1)
+
+  while True:
+    rows = list(itertools.islice(teams_a, VECTORIZED_CHUNK_SIZE))
+    if not rows:
+      return
+    positions = numpy.array(rows, dtype=numpy.intp).reshape(
+        len(rows), players_per_team - 1)
+    chunk = numpy.full((len(rows), player_count), -1, dtype=numpy.int8)
+    chunk[:, 0] = 1
+    numpy.put_along_axis(chunk, positions, 1, axis=1)
+    yield chunk
+
+
+def get_membership_teams(player_ids, row):
+  """The (team_a, team_b) split of a get_membership_chunks() row."""
+  return (tuple(player_ids[index] for index in numpy.flatnonzero(row == 1)),
+          tuple(player_ids[index] for index in numpy.flatnonzero(row == -1)))
+
+
+def get_vectorized_qualities(membership, mus, sigmas, beta):
+  """Two-team TrueSkill match quality for every row of membership.
+
+  Closed form of trueskill.quality() for two teams with unit weights:
+    sqrt(n * beta^2 / c) * exp(-(mu_a - mu_b)^2 / (2 * c))
+  with n players taking part and c = n * beta^2 + sum(sigma^2).
+  """
+  mus = numpy.asarray(mus, dtype=float)
+  variances = numpy.asarray(sigmas, dtype=float)**2
+  playing = membership != 0
+  mu_differences = membership @ mus
+  player_counts = playing.sum(axis=1)
+  variance_sums = playing @ variances
+  betas = player_counts * beta**2
+  denominators = betas + variance_sums
+  return numpy.sqrt(betas / denominators) * numpy.exp(
+      -mu_differences**2 / (2 * denominators))
+
+
+def get_top_indices(values, count):
+  """Indices of the count biggest values, biggest first, ties by index."""
+  if len(values) > count:
+    threshold = values[numpy.argpartition(-values, count - 1)[count - 1]]
+    candidates = numpy.flatnonzero(values >= threshold)
+  else:
+    candidates = numpy.arange(len(values))
+  order = numpy.lexsort((candidates, -values[candidates]))
+  return candidates[order[:count]]
+
+
+def rate_match(stats, game_type, match):
+  """Rates match in stats, updating ratings, wins / losses and kills / deaths.
+
+  match is {'red': [ids], 'blue': [ids], 'red_score': score, 'blue_score':
+  score, 'kills_deaths': {id: [kills, deaths], ...}}. Returns
+  (exposure deltas, row deltas): {id: change in exposure} and
+  {id: [d_mu, d_sigma, d_w, d_l, d_k, d_d]}, as logged by JsonBackend.
+  """
+  red_ids = [int(player_id) for player_id in match['red']]
+  blue_ids = [int(player_id) for player_id in match['blue']]
+  red_score = match['red_score']
+  blue_score = match['blue_score']
+  kills_deaths = {
+      int(player_id): kill_death
+      for player_id, kill_death in match.get('kills_deaths', {}).items()
+  }
+
+  player_ids = red_ids + blue_ids
+  old_rows = {
+      player_id: stats.get_row(game_type, player_id)
+      for player_id in player_ids
+  }
+  red_ratings = [stats.get_rating(game_type, id) for id in red_ids]
+  blue_ratings = [stats.get_rating(game_type, id) for id in blue_ids]
+
+  # Update win / loss
+  for player_id in red_ids:
+    if red_score > blue_score:
+      stats.add_winloss(game_type, player_id, 1, 0)
+    else:
+      stats.add_winloss(game_type, player_id, 0, 1)
+
+  for player_id in blue_ids:
+    if red_score < blue_score:
+      stats.add_winloss(game_type, player_id, 1, 0)
+    else:
+      stats.add_winloss(game_type, player_id, 0, 1)
+
+  # Update kill / death
+  for player_id in blue_ids + red_ids:
+    kills, deaths = kills_deaths.get(player_id, (0, 0))
+    stats.add_killdeath(game_type, player_id, kills, deaths)
+
+  if red_score > blue_score:
+    ranks = [0, 1]
+  elif red_score < blue_score:
+    ranks = [1, 0]
+  else:
+    ranks = [0, 0]
+
+  new_ratings = trueskill.rate([red_ratings, blue_ratings], ranks=ranks)
+  exposure_deltas = {}
+  for team_ids, team_ratings in zip([red_ids, blue_ids], new_ratings):
+    for player_id, new_rating in zip(team_ids, team_ratings):
+      old_rating = stats.get_rating(game_type, player_id)
+      exposure_deltas[player_id] = new_rating.exposure - old_rating.exposure
+      stats.set_rating(game_type, player_id, new_rating)
+
+  deltas = {
+      player_id: [
+          new - old for new, old in zip(stats.get_row(game_type, player_id),
+                                        old_rows[player_id])
+      ] for player_id in player_ids
+  }
+  return exposure_deltas, deltas
+
+
+def get_match_qualities(player_ids, ratings, dont_mix=None):
+  """[[quality, [team_a, team_b]], ...] for every split of player_ids.
+
+  ratings maps each player id to its trueskill.Rating.
+  """
+  match_qualities = []
+  for team_a, team_b in get_team_partitions(player_ids, dont_mix):
+    team_a_ratings = [ratings[player_id] for player_id in team_a]
+    team_b_ratings = [ratings[player_id] for player_id in team_b]
+
+    quality = trueskill.quality([team_a_ratings, team_b_ratings])
+    match_qualities.append([quality, [team_a, team_b]])
+
+  return match_qualities
+
+
+def get_vectorized_match_qualities(player_ids, ratings, dont_mix=None):
+  """Same as get_match_qualities(), scoring the splits with numpy."""
+  player_ids = list(player_ids)
+  mus, sigmas = get_mus_sigmas(player_ids, ratings)
+  beta = trueskill.global_env().beta
+  match_qualities = []
+  for chunk in get_membership_chunks(player_ids, dont_mix):
+    qualities = get_vectorized_qualities(chunk, mus, sigmas, beta)
+    for quality, row in zip(qualities, chunk):
+      match_qualities.append(
+          [float(quality),
+           list(get_membership_teams(player_ids, row))])
+  return match_qualities
+
+
+def get_vectorized_best_matches(player_ids, ratings, count, dont_mix=None):
+  """Same as get_best_matches(..., engine='numpy').
+
+  The splits are scored a chunk at a time and only the count best so far are
+  kept, so memory doesn't grow with the number of splits.
+  """
+  player_ids = list(player_ids)
+  if count < 1:
+    return []
+  mus, sigmas = get_mus_sigmas(player_ids, ratings)
+  beta = trueskill.global_env().beta
+  best_qualities = numpy.empty(0)
+  best_rows = numpy.empty((0, len(player_ids)), dtype=numpy.int8)
+  for chunk in get_membership_chunks(player_ids, dont_mix):
+    # The best so far go first: they come earlier in the order of splits.
+    qualities = numpy.concatenate(
+        [best_qualities,
+         get_vectorized_qualities(chunk, mus, sigmas, beta)])
+    rows = numpy.concatenate([best_rows, chunk])
+    keep = get_top_indices(qualities, count)
+    best_qualities = qualities[keep]
+    best_rows = rows[keep]
+  return [[float(quality),
+           list(get_membership_teams(player_ids, row))]
+          for quality, row in zip(best_qualities, best_rows)]
+
+
+def get_mus_sigmas(player_ids, ratings):
+  ratings = [ratings[player_id] for player_id in player_ids]
+  return ([rating.mu for rating in ratings],
+          [rating.sigma for rating in ratings])
+
+
+def sort_match_qualities(match_qualities):
+  """Best first; stable, so ties keep their order."""
+  return sorted(match_qualities, key=lambda match: match[0], reverse=True)
+
+
+def get_best_matches(player_ids,
+                     ratings,
+                     count,
+                     engine='search',
+                     dont_mix=None):
+  """The count best of get_match_qualities(...), best first.
+
+  Matches of equal quality keep the order of get_team_partitions().
+  """
+  if engine == 'exhaustive':
+    match_qualities = get_match_qualities(player_ids, ratings, dont_mix)
+    return sort_match_qualities(match_qualities)[:count]
+  if engine == 'numpy':
+    return get_vectorized_best_matches(player_ids, ratings, count, dont_mix)
+
+  mus = {player_id: ratings[player_id].mu for player_id in ratings}
+
+  match_qualities = []
+  for team_a, team_b in get_best_partitions(player_ids, mus, count, dont_mix):
+    team_a_ratings = [ratings[player_id] for player_id in team_a]
+    team_b_ratings = [ratings[player_id] for player_id in team_b]
+    quality = trueskill.quality([team_a_ratings, team_b_ratings])
+    match_qualities.append([quality, [team_a, team_b]])
+
+  return sort_match_qualities(match_qualities)[:count]
@@ -0,0 +1,345 @@
+#!/usr/bin/python3
+"""
+Recomputes every oloraculo rating from scratch, replaying the matches recorded
+by funes (funes_history.jsonl) in order through TrueSkill, and writes a new
+oloraculo stats file.
+
+Matches share players, so they have to be rated one after the other. To keep
+that fast the two team TrueSkill update is done in closed form (it's exact for
+two teams, no factor graph needed) over plain lists, with the constants of the
+chosen environment computed once per batch of matches. TrueSkill parameters
+can be changed to tune ratings, e.g.:
+
+  oloraculo_rebuild.py --beta 5 --tau 0.1 --draw_probability 0.05 \
+      --output_file /tmp/oloraculo_stats.json
+
+Kills / deaths are not in the funes history, so they are carried over from
+the current stats file (and its log), if given, along with the players and
+game types that aren't rebuilt.
+"""
+
+import argparse
+import itertools
+import json
+import math
+import os
+import random
+import statistics
+import sys
+import time
+import trueskill
+
+ROOT_PATH = os.path.dirname(os.path.realpath(__file__))
+HISTORY_FILE_PATH = os.path.join(ROOT_PATH, 'funes_history.jsonl')
+STATS_FILE_PATH = os.path.join(ROOT_PATH, 'oloraculo_stats.json')
+LOG_FILE_PATH = os.path.join(ROOT_PATH, 'oloraculo_stats.log')
+SEQ_KEY = '_seq'
+GAME_TYPES = ['ad', 'ctf', 'ca']
+BATCH_SIZE = 10000
+# Below this, the normal cdf is treated as 0.
+MIN_DENOMINATOR = 2.222758749e-162
+
+NORMAL = statistics.NormalDist()
+
+
+def log(msg):
+  sys.stderr.write('%s\n' % msg)
+
+
+def pdf(x):
+  return math.exp(-x * x / 2.0) / math.sqrt(2.0 * math.pi)
+
+
+def cdf(x):
+  return 0.5 * math.erfc(-x / math.sqrt(2.0))
+
+
+def v_win(diff, draw_margin):
+  x = diff - draw_margin
+  denominator = cdf(x)
+  return pdf(x) / denominator if denominator > MIN_DENOMINATOR else -x
+
+
+def w_win(diff, draw_margin):
+  x = diff - draw_margin
+  v = v_win(diff, draw_margin)
+  return v * (v + x)
+
+
+def v_draw(diff, draw_margin):
+  abs_diff = abs(diff)
+  a = draw_margin - abs_diff
+  b = -draw_margin - abs_diff
+  denominator = cdf(a) - cdf(b)
+  numerator = pdf(b) - pdf(a)
+  v = numerator / denominator if denominator > MIN_DENOMINATOR else a
+  return -v if diff < 0 else v
+
+
+def w_draw(diff, draw_margin):
+  abs_diff = abs(diff)
+  a = draw_margin - abs_diff
+  b = -draw_margin - abs_diff
+  denominator = cdf(a) - cdf(b)
+  if denominator <= MIN_DENOMINATOR:
+    return 1.0
+  v = v_draw(abs_diff, draw_margin)
+  return v**2 + (a * pdf(a) - b * pdf(b)) / denominator
+
+
+class Environment(object):
+  """TrueSkill parameters, and the constants derived from them."""
+
+  def __init__(self,
+               mu=trueskill.MU,
+               sigma=trueskill.SIGMA,
+               beta=trueskill.BETA,
+               tau=trueskill.TAU,
+               draw_probability=trueskill.DRAW_PROBABILITY):
+    self.mu = mu
+    self.sigma = sigma
+    self.beta = beta
+    self.tau = tau
+    self.draw_probability = draw_probability
+    # {players in the match: draw margin}
+    self.draw_margins = {}
+
+  def get_draw_margin(self, size):
+    if size not in self.draw_margins:
+      self.draw_margins[size] = (
+          NORMAL.inv_cdf((self.draw_probability + 1) / 2.0) *
+          math.sqrt(size) * self.beta)
+    return self.draw_margins[size]
+
+
+def load_history(file_name):
+  """Returns [[week, map, game type, red ids, blue ids, red, blue], ...].
+
+  Reads funes_history.jsonl (a match per line), or the funes_history.json it
+  replaced (a single list, maybe with legacy entries).
+  """
+  with open(file_name) as history_file:
+    first_line = history_file.readline()
+    # Lines of the new file start with the week, '["yyyy-ww"'.
+    if first_line.startswith('["') or not first_line:
+      history = []
+      for line in itertools.chain([first_line], history_file):
+        try:
+          history.append(json.loads(line))
+        except ValueError:
+          # Partially written last match, most likely.
+          continue
+      return history
+    history = json.loads(first_line + history_file.read())
+
+  # fix "legacy" entries (i.e. those without mapname in 2nd index)
+  for datum in history:
+    if len(datum) == 6:
+      datum.insert(1, '')
+  return history
+
+
+def load_stats(file_name, log_file_name=None):
+  """Returns the current stats, with the log applied, and its last seq."""
+  try:
+    stats = json.loads(open(file_name).read())
+  except FileNotFoundError:
+    # Nothing folded into it yet: all of it is in the log.
+    stats = {}
+  seq = stats.pop(SEQ_KEY, 0)
+  if not log_file_name or not os.path.exists(log_file_name):
+    return stats, seq
+
+  for line in open(log_file_name):
+    try:
+      record = json.loads(line)
+    except ValueError:
+      continue
+    if record['seq'] <= seq:
+      continue
+    seq = record['seq']
+    game_stats = stats.setdefault(record['type'], {})
+    for player_id, deltas in record['deltas'].items():
+      data = game_stats.get(player_id,
+                            [trueskill.MU, trueskill.SIGMA, 0, 0, 0, 0])
+      game_stats[player_id] = [
+          value + delta for value, delta in zip(data, deltas)
+      ]
+  return stats, seq
+
+
+def rate_matches(ratings, matches, env):
+  """Rates matches in order, updating ratings in place.
+
+  ratings are {game_type: {player_id: [mu, sigma, win, loss]}}, matches are
+  funes history entries. Returns how many matches were rated.
+  """
+  beta_squared = env.beta**2
+  tau_squared = env.tau**2
+  default = [env.mu, env.sigma, 0, 0]
+  count = 0
+  for _, _, game_type, red_ids, blue_ids, red_score, blue_score in matches:
+    if not red_ids or not blue_ids:
+      continue
+    game_ratings = ratings.setdefault(game_type, {})
+    if red_score >= blue_score:
+      winners, losers = red_ids, blue_ids
+    else:
+      winners, losers = blue_ids, red_ids
+    is_draw = red_score == blue_score
+
+    winner_rows = []
+    winner_mu = 0.0
+    variance = 0.0
+    for player_id in winners:
+      row = game_ratings.get(player_id) or game_ratings.setdefault(
+          player_id, list(default))
+      winner_rows.append(row)
+      winner_mu += row[0]
+      variance += row[1] * row[1]
+    loser_rows = []
+    loser_mu = 0.0
+    for player_id in losers:
+      row = game_ratings.get(player_id) or game_ratings.setdefault(
+          player_id, list(default))
+      loser_rows.append(row)
+      loser_mu += row[0]
+      variance += row[1] * row[1]
+
+    size = len(winners) + len(losers)
+    c_squared = variance + size * (tau_squared + beta_squared)
+    c = math.sqrt(c_squared)
+    diff = (winner_mu - loser_mu) / c
+    draw_margin = env.get_draw_margin(size) / c
+    if is_draw:
+      v = v_draw(diff, draw_margin)
+      w = w_draw(diff, draw_margin)
+    else:
+      v = v_win(diff, draw_margin)
+      w = w_win(diff, draw_margin)
+
+    for rows, sign in ((winner_rows, 1), (loser_rows, -1)):
+      for row in rows:
+        sigma_squared = row[1]**2 + tau_squared
+        row[0] += sign * sigma_squared / c * v
+        row[1] = math.sqrt(sigma_squared *
+                           max(1 - sigma_squared / c_squared * w, 0))
+        # Like the plugin, a draw is a loss for both teams.
+        row[2 if sign > 0 and not is_draw else 3] += 1
+    count += 1
+  return count
+
+
+def rebuild(history, env, game_types=GAME_TYPES, batch_size=BATCH_SIZE):
+  """Returns {game_type: {player_id: [mu, sigma, win, loss]}} for history."""
+  matches = [match for match in history if match[2] in game_types]
+  ratings = {}
+  start = time.time()
+  for index in range(0, len(matches), batch_size):
+    rate_matches(ratings, matches[index:index + batch_size], env)
+    log('rated %d / %d matches (%.2fs)' %
+        (min(index + batch_size, len(matches)), len(matches),
+         time.time() - start))
+  return ratings
+
+
+def get_stats(ratings, old_stats=None, seq=0):
+  """Stats in the oloraculo file format: old_stats with ratings on top.
+
+  Only mu, sigma, wins and losses of the players in ratings change. Kills /
+  deaths, and the players and game types that weren't rebuilt, are carried
+  over from old_stats: with _seq at seq, the log records up to it won't be
+  applied again.
+  """
+  stats = {
+      game_type: {
+          player_id: list(data) for player_id, data in game_stats.items()
+      } for game_type, game_stats in (old_stats or {}).items()
+  }
+  stats[SEQ_KEY] = seq
+  for game_type, game_ratings in ratings.items():
+    game_stats = stats.setdefault(game_type, {})
+    for player_id, (mu, sigma, win, loss) in game_ratings.items():
+      old_data = game_stats.get(str(player_id), [0] * 6)
+      game_stats[str(player_id)] = [mu, sigma, win, loss] + old_data[4:]
+  return stats
+
+
+def get_synthetic_history(match_count, player_count=32, team_size=4, seed=0):
+  """Random matches between players of hidden, fixed skill."""
+  generator = random.Random(seed)
+  player_ids = [76561198000000000 + index for index in range(player_count)]
+  skills = {player_id: generator.gauss(0, 1) for player_id in player_ids}
+  history = []
+  for index in range(match_count):
+    players = generator.sample(player_ids, team_size * 2)
+    red_ids = sorted(players[:team_size])
+    blue_ids = sorted(players[team_size:])
+    red_skill = sum(skills[player_id] for player_id in red_ids)
+    blue_skill = sum(skills[player_id] for player_id in blue_ids)
+    red_wins = red_skill + generator.gauss(0, 1) > blue_skill
+    week = '2020-%02d' % (1 + index * 52 // match_count)
+    history.append([
+        week, 'campgrounds', 'ad', red_ids, blue_ids, 10 if red_wins else 5,
+        5 if red_wins else 10
+    ])
+  return history
+
+
+def main(args):
+  env = Environment(beta=args.beta,
+                    tau=args.tau,
+                    draw_probability=args.draw_probability)
+  if args.synthetic:
+    history = get_synthetic_history(args.synthetic)
+  else:
+    history = load_history(args.history_file)
+  log('replaying %d matches' % len(history))
+
+  old_stats = {}
+  seq = 0
+  if args.stats_file:
+    # Keeps log records already in the new ratings from being applied again.
+    old_stats, seq = load_stats(args.stats_file, args.log_file)
+
+  ratings = rebuild(history, env, args.game_types.split(','))
+  stats = get_stats(ratings, old_stats, seq)
+  open(args.output_file, 'w').write(json.dumps(stats, sort_keys=True,
+                                               indent=2))
+  log('wrote %s' % args.output_file)
+
+
+arg_parser = argparse.ArgumentParser(
+    description='Rebuilds oloraculo ratings from the funes history.')
+arg_parser.add_argument('--history_file',
+                        type=str,
+                        default=HISTORY_FILE_PATH,
+                        help='The funes history to replay.')
+arg_parser.add_argument('--stats_file',
+                        type=str,
+                        default=STATS_FILE_PATH,
+                        help='Current stats, carried over where not rebuilt.')
+arg_parser.add_argument('--log_file',
+                        type=str,
+                        default=LOG_FILE_PATH,
+                        help='Log of the current stats file.')
+arg_parser.add_argument('--output_file',
+                        type=str,
+                        required=True,
+                        help='Where to write the new stats.')
+arg_parser.add_argument('--game_types',
+                        type=str,
+                        default=','.join(GAME_TYPES),
+                        help='Comma separated game types to rate.')
+arg_parser.add_argument('--beta', type=float, default=trueskill.BETA)
+arg_parser.add_argument('--tau', type=float, default=trueskill.TAU)
+arg_parser.add_argument('--draw_probability',
+                        type=float,
+                        default=trueskill.DRAW_PROBABILITY)
+arg_parser.add_argument('--synthetic',
+                        type=int,
+                        default=0,
+                        help='Replay this many random matches instead.')
+
+if __name__ == '__main__':
+  main(arg_parser.parse_args())
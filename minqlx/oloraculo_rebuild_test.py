@@ -0,0 +1,216 @@
+import json
+import os
+import sys
+import tempfile
+import trueskill_fake
+import unittest
+
+sys.modules['trueskill'] = trueskill_fake
+import oloraculo_rebuild
+
+from unittest.mock import patch
+
+# [['yyyy-ww', 'map', 'gt', [r_ids], [b_ids], r_score, b_score], ...]
+HISTORY = [
+    ['2020-01', 'campgrounds', 'ad', [12, 34], [56, 78], 15, 7],
+    ['2020-01', 'ad', [12, 56], [34, 78], 3, 3],
+    ['2020-02', 'overkill', 'ca', [12], [34], 1, 8],
+    ['2020-02', 'overkill', 'ffa', [12], [34], 1, 8],
+]
+
+# {type:{id:[mu,sigma,w,l,k,d],...},...}
+STATS = {
+    '_seq': 1,
+    'ad': {
+        '12': [30, 1, 2, 1, 200, 100],
+        '34': [20, 1, 1, 4, 100, 900],
+    },
+}
+
+LOG = [
+    {
+        'seq': 1,
+        'type': 'ad',
+        'deltas': {
+            '12': [1, 0, 1, 0, 10, 10]
+        }
+    },
+    {
+        'seq': 2,
+        'type': 'ad',
+        'deltas': {
+            '34': [1, 0, 1, 0, 10, 20]
+        }
+    },
+]
+
+
+@patch('oloraculo_rebuild.log', lambda msg: None)
+class TestOloraculoRebuild(unittest.TestCase):
+
+  def setUp(self):
+    self.directory = tempfile.TemporaryDirectory()
+
+  def tearDown(self):
+    self.directory.cleanup()
+
+  def write(self, file_name, data):
+    file_path = os.path.join(self.directory.name, file_name)
+    open(file_path, 'w').write(data)
+    return file_path
+
+  def test_load_history(self):
+    history = oloraculo_rebuild.load_history(
+        self.write('history.json', json.dumps(HISTORY)))
+    self.assertEqual(['2020-01', '', 'ad', [12, 56], [34, 78], 3, 3],
+                     history[1])
+    self.assertTrue(all(len(match) == 7 for match in history))
+
+    lines = ''.join(json.dumps(match) + '\n' for match in history)
+    self.assertEqual(
+        history,
+        oloraculo_rebuild.load_history(
+            self.write('history.jsonl', lines + '["2020-03", "ov')))
+    self.assertEqual([],
+                     oloraculo_rebuild.load_history(
+                         self.write('empty.jsonl', '')))
+
+  def test_load_stats(self):
+    stats, seq = oloraculo_rebuild.load_stats(
+        self.write('stats.json', json.dumps(STATS)),
+        self.write('stats.log', '\n'.join(json.dumps(r) for r in LOG)))
+    self.assertEqual(2, seq)
+    self.assertEqual([30, 1, 2, 1, 200, 100], stats['ad']['12'])
+    self.assertEqual([21, 1, 2, 4, 110, 920], stats['ad']['34'])
+
+  def test_rate_matches(self):
+    env = oloraculo_rebuild.Environment()
+    ratings = {}
+    self.assertEqual(
+        1, oloraculo_rebuild.rate_matches(ratings, HISTORY[:1], env))
+    red = ratings['ad'][12]
+    blue = ratings['ad'][56]
+    self.assertGreater(red[0], env.mu)
+    self.assertAlmostEqual(env.mu - red[0], blue[0] - env.mu)
+    self.assertLess(red[1], env.sigma)
+    self.assertEqual([1, 0], red[2:])
+    self.assertEqual([0, 1], blue[2:])
+    self.assertEqual(ratings['ad'][12], ratings['ad'][34])
+
+    # A draw between equals moves nobody.
+    ratings = {}
+    oloraculo_rebuild.rate_matches(
+        ratings, [['2020-01', '', 'ad', [12, 56], [34, 78], 3, 3]], env)
+    self.assertAlmostEqual(env.mu, ratings['ad'][12][0])
+    self.assertLess(ratings['ad'][12][1], env.sigma)
+    # and is a loss for both teams, as in the plugin
+    self.assertEqual([0, 1], ratings['ad'][12][2:])
+    self.assertEqual([0, 1], ratings['ad'][34][2:])
+
+    # Empty teams are skipped.
+    self.assertEqual(
+        0,
+        oloraculo_rebuild.rate_matches(
+            ratings, [['2020-01', '', 'ad', [], [34], 0, 1]], env))
+
+  def test_rate_matches_parameters(self):
+    ratings = {}
+    oloraculo_rebuild.rate_matches(ratings, HISTORY[:1],
+                                   oloraculo_rebuild.Environment(beta=1))
+    other_ratings = {}
+    oloraculo_rebuild.rate_matches(other_ratings, HISTORY[:1],
+                                   oloraculo_rebuild.Environment(beta=20))
+    self.assertNotEqual(ratings['ad'][12][0], other_ratings['ad'][12][0])
+
+  def test_rebuild(self):
+    history = oloraculo_rebuild.load_history(
+        self.write('history.json', json.dumps(HISTORY)))
+    ratings = oloraculo_rebuild.rebuild(history,
+                                        oloraculo_rebuild.Environment(),
+                                        batch_size=1)
+    self.assertEqual(['ad', 'ca'], sorted(ratings))
+    # won the first match, drew the second
+    self.assertEqual([1, 1], ratings['ad'][34][2:])
+    self.assertEqual([0, 1], ratings['ca'][12][2:])
+
+    # Batches don't change the result.
+    self.assertEqual(
+        ratings,
+        oloraculo_rebuild.rebuild(history, oloraculo_rebuild.Environment()))
+
+  def test_rebuild_synthetic(self):
+    history = oloraculo_rebuild.get_synthetic_history(1000, player_count=8)
+    self.assertEqual(1000, len(history))
+    ratings = oloraculo_rebuild.rebuild(history,
+                                        oloraculo_rebuild.Environment())
+    self.assertEqual(8, len(ratings['ad']))
+    self.assertEqual(1000 * 4,
+                     sum(row[2] for row in ratings['ad'].values()))
+
+  def test_main(self):
+    output_file = os.path.join(self.directory.name, 'new_stats.json')
+    oloraculo_rebuild.main(
+        oloraculo_rebuild.arg_parser.parse_args([
+            '--history_file',
+            self.write('history.json', json.dumps(HISTORY)),
+            '--stats_file',
+            self.write('stats.json', json.dumps(STATS)),
+            '--log_file',
+            self.write('stats.log', '\n'.join(json.dumps(r) for r in LOG)),
+            '--output_file',
+            output_file,
+            '--game_types',
+            'ad',
+        ]))
+    stats = json.loads(open(output_file).read())
+    self.assertEqual(['_seq', 'ad'], sorted(stats))
+    # Already part of the new ratings, the log must not be applied again.
+    self.assertEqual(2, stats['_seq'])
+    self.assertEqual(['12', '34', '56', '78'], sorted(stats['ad']))
+    # Kills / deaths come from the old stats.
+    self.assertEqual([110, 920], stats['ad']['34'][4:])
+    self.assertEqual([0, 0], stats['ad']['56'][4:])
+
+
+  def test_main_carries_over(self):
+    stats = dict(STATS, ctf={'12': [40, 2, 5, 5, 50, 50]})
+    log = LOG + [{
+        'seq': 3,
+        'type': 'ad',
+        'deltas': {
+            '90': [1, 0, 0, 1, 7, 8]
+        }
+    }]
+    output_file = os.path.join(self.directory.name, 'new_stats.json')
+    for stats_file in [self.write('stats.json', json.dumps(stats)), 'none']:
+      oloraculo_rebuild.main(
+          oloraculo_rebuild.arg_parser.parse_args([
+              '--history_file',
+              self.write('history.json', json.dumps(HISTORY)),
+              '--stats_file',
+              os.path.join(self.directory.name, stats_file),
+              '--log_file',
+              self.write('stats.log', '\n'.join(json.dumps(r) for r in log)),
+              '--output_file',
+              output_file,
+              '--game_types',
+              'ad',
+          ]))
+      new_stats = json.loads(open(output_file).read())
+      self.assertEqual(3, new_stats['_seq'])
+      # Only in the log: not rated again, nor dropped.
+      self.assertEqual(
+          [trueskill_fake.MU + 1, trueskill_fake.SIGMA, 0, 1, 7, 8],
+          new_stats['ad']['90'])
+      self.assertEqual(['12', '34', '56', '78', '90'], sorted(new_stats['ad']))
+      if stats_file == 'none':
+        # Nothing compacted yet: the log is all there is.
+        self.assertEqual(['_seq', 'ad'], sorted(new_stats))
+        self.assertEqual([10, 10], new_stats['ad']['12'][4:])
+      else:
+        # Left out by --game_types.
+        self.assertEqual(stats['ctf'], new_stats['ctf'])
+        self.assertEqual([200, 100], new_stats['ad']['12'][4:])
+
+if __name__ == '__main__':
+  unittest.main()
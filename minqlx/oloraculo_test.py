@@ -1,7 +1,16 @@
+import importlib
+import itertools
 import json
+import os
+import random
 import re
 import sys
+import tempfile
+import threading
+import time
 import minqlx_fake
+import persistence_fake
+import player_names
 import trueskill_fake
 import unittest
 
@@ -9,8 +18,26 @@ from unittest.mock import mock_open
 from unittest.mock import patch
 
 sys.modules['minqlx'] = minqlx_fake
+sys.modules['persistence'] = persistence_fake
 sys.modules['trueskill'] = trueskill_fake
 import oloraculo
+import oloraculo_daemon
+import oloraculo_ratings
+
+
+def import_real(module_name):
+  """The real module, if installed, without replacing the fake."""
+  fake = sys.modules.pop(module_name)
+  try:
+    return importlib.import_module(module_name)
+  except ImportError:
+    return None
+  finally:
+    sys.modules[module_name] = fake
+
+
+REAL_PERSISTENCE = import_real('persistence')
+REAL_TRUESKILL = import_real('trueskill')
 
 # {type:{id:[mu,sigma,w,l,k,d],...},...}
 RATINGS = {
@@ -34,28 +61,57 @@ PLAYER_ID_MAP = {
 }
 
 
+class FakeThread(object):
+  started = 0
+
+  def __init__(self, target, args=(), daemon=None):
+    self.target = target
+    self.args = args
+
+  def start(self):
+    FakeThread.started += 1
+    self.target(*self.args)
+
+
 class TestOloraculo(unittest.TestCase):
 
   def setUp(self):
     minqlx_fake.reset()
+    player_names.DIRECTORY.clear()
+    # Keeps rating history chunks out of the source tree.
+    history_directory = tempfile.TemporaryDirectory()
+    self.addCleanup(history_directory.cleanup)
+    history_path = patch('oloraculo.HISTORY_PATH', history_directory.name)
+    history_path.start()
+    self.addCleanup(history_path.stop)
+
+  def assertInMessages(self, txt):
+    self.assertTrue(
+        [line for line in minqlx_fake.Plugin.messages if txt in line],
+        '"%s" not in messages:\n%s' %
+        (txt, '\n'.join(minqlx_fake.Plugin.messages)))
 
   def assertSavedJson(self, expected, mocked_open):
     file_handle = mocked_open.return_value.__enter__.return_value
-    first_write = file_handle.write.call_args_list[0]
-    write_arguments = first_write[0]
-    saved_json = write_arguments[0]
+    # The first text write, rating history chunks are binary.
+    saved_json = [
+        write[0][0]
+        for write in file_handle.write.call_args_list
+        if isinstance(write[0][0], str)
+    ][0]
     self.assertEqual(expected, json.loads(saved_json))
 
   @patch('builtins.open', mock_open(read_data=json.dumps({})))
   def test_registers_commands_and_hooks(self):
     olor = oloraculo.oloraculo()
     self.assertEqual(
-        ['oloraculo', 'oloraculo_stats'],
+        ['oloraculo', 'oloraculo_migrate', 'oloraculo_stats'],
         sorted([cmd[0] for cmd in minqlx_fake.Plugin.registered_commands]))
 
-    self.assertEqual(
-        ['game_end', 'game_start', 'player_loaded'],
-        sorted([hook[0] for hook in minqlx_fake.Plugin.registered_hooks]))
+    self.assertEqual([
+        'game_end', 'game_start', 'player_disconnect', 'player_loaded',
+        'team_switch', 'unload'
+    ], sorted([hook[0] for hook in minqlx_fake.Plugin.registered_hooks]))
 
   @patch('builtins.open', mock_open(read_data=json.dumps({})))
   def test_get_stats_copy(self):
@@ -67,6 +123,22 @@ class TestOloraculo(unittest.TestCase):
     self.assertEqual(0, len(olor.get_stats().get_player_ids('ad')))
     self.assertEqual(1, len(stats.get_player_ids('ad')))
 
+  @patch('builtins.open', mock_open(read_data=RATINGS_JSON))
+  def test_get_stats_snapshot(self):
+    olor = oloraculo.oloraculo()
+    olor.load_stats = lambda: None
+    stats = olor.get_stats()
+    # Shared until written.
+    self.assertIs(olor.stats._tables['ad'], stats._tables['ad'])
+
+    minqlx_fake.run_game(PLAYER_ID_MAP, '', [56, 78], [12, 34], 7, 15)
+    self.assertEqual([2, 1], stats.get_winloss('ad', 12))
+    self.assertEqual([3, 1], olor.get_stats().get_winloss('ad', 12))
+
+    stats = olor.get_stats()
+    stats.set_winloss('ad', 12, [9, 9])
+    self.assertEqual([3, 1], olor.get_stats().get_winloss('ad', 12))
+
   @patch('builtins.open', mock_open(read_data=RATINGS_JSON))
   def test_loads_stats(self):
     olor = oloraculo.oloraculo()
@@ -96,15 +168,357 @@ class TestOloraculo(unittest.TestCase):
     olor = oloraculo.oloraculo()
     # red_team_ids, blue_team_ids, red_score, blue_score
     minqlx_fake.run_game(PLAYER_ID_MAP, '', [56, 78], [12, 34], 7, 15)
-    expected_data = {
-        'ad': {
-            '12': [2, 0, 3, 1, 200, 100],
-            '34': [3, 0, 2, 4, 100, 900],
-            '56': [2, 0, 3, 3, 300, 200],
-            '78': [3, 0, 1, 9, 100, 900],
+    expected_record = {
+        'seq': 1,
+        'type': 'ad',
+        'deltas': {
+            '12': [1, 0, 1, 0, 0, 0],
+            '34': [1, 0, 1, 0, 0, 0],
+            '56': [-1, 0, 0, 1, 0, 0],
+            '78': [-1, 0, 0, 1, 0, 0],
         },
     }
-    self.assertSavedJson(expected_data, m)
+    self.assertSavedJson(expected_record, m)
+    m.assert_any_call(oloraculo.LOG_FILE_PATH, 'a')
+
+  def test_saves_stats_compaction(self):
+    with tempfile.TemporaryDirectory() as directory:
+      json_file_path = os.path.join(directory, 'stats.json')
+      log_file_path = os.path.join(directory, 'stats.log')
+      with open(json_file_path, 'w') as stats_file:
+        stats_file.write(RATINGS_JSON)
+
+      with patch('oloraculo.JSON_FILE_PATH', json_file_path), \
+          patch('oloraculo.LOG_FILE_PATH', log_file_path), \
+          patch('oloraculo_ratings.LOG_COMPACTION_RECORDS', 2):
+        olor = oloraculo.oloraculo()
+        minqlx_fake.run_game(PLAYER_ID_MAP, '', [56, 78], [12, 34], 7, 15)
+        self.assertEqual(RATINGS_JSON, open(json_file_path).read())
+        self.assertEqual(1, len(open(log_file_path).readlines()))
+
+        # startup is the JSON file plus the log
+        stats = oloraculo_ratings.Db()
+        stats.load(json_file_path)
+        self.assertEqual(1, stats.replay_log(log_file_path))
+        self.assertEqual(olor.get_stats(), stats)
+
+        # compacted
+        minqlx_fake.run_game(PLAYER_ID_MAP, '', [56, 78], [12, 34], 7, 15)
+        self.assertEqual('', open(log_file_path).read())
+        expected_data = {
+            'ad': {
+                '12': [3, 0, 4, 1, 200, 100],
+                '34': [4, 0, 3, 4, 100, 900],
+                '56': [1, 0, 3, 4, 300, 200],
+                '78': [2, 0, 1, 10, 100, 900],
+            },
+            '_seq': 2,
+        }
+        self.assertEqual(expected_data,
+                         json.loads(open(json_file_path).read()))
+
+        stats = oloraculo_ratings.Db()
+        stats.load(json_file_path)
+        self.assertEqual(0, stats.replay_log(log_file_path))
+        self.assertEqual(olor.get_stats(), stats)
+
+  def test_db(self):
+    stats = oloraculo_ratings.Db()
+    # reading doesn't add players
+    self.assertEqual(trueskill_fake.Rating(), stats.get_rating('ad', 12))
+    self.assertEqual([0, 0], stats.get_winloss('ad', 12))
+    self.assertEqual([0, 0], stats.get_killdeath('ad', 12))
+    self.assertEqual(set(), stats.get_player_ids('ad'))
+    self.assertEqual(oloraculo_ratings.Db(), stats)
+
+    stats.set_rating('ad', 12, trueskill_fake.Rating(10))
+    stats.add_winloss('ad', '12', 1, 0)
+    stats.add_winloss('ad', 12, 0, 2)
+    stats.set_killdeath('ad', 34, [5, 6])
+    stats.add_killdeath('ad', 34, 1, 1)
+    self.assertEqual({12, 34}, stats.get_player_ids('ad'))
+    self.assertEqual(set(), stats.get_player_ids('ctf'))
+    self.assertEqual(trueskill_fake.Rating(10), stats.get_rating('ad', 12))
+    self.assertEqual([1, 2], stats.get_winloss('ad', 12))
+    self.assertEqual([6, 7], stats.get_killdeath('ad', 34))
+    self.assertEqual({
+        12: (10, 0, 1, 2, 0, 0),
+        34: (trueskill_fake.MU, 0, 0, 0, 6, 7)
+    }, dict(stats.get_rows('ad')))
+    self.assertNotEqual(oloraculo_ratings.Db(), stats)
+
+  def test_db_lazy_load(self):
+    with tempfile.TemporaryDirectory() as directory:
+      file_name = os.path.join(directory, 'stats.json')
+      log_file_name = os.path.join(directory, 'stats.log')
+      with open(file_name, 'w') as stats_file:
+        stats_file.write(
+            json.dumps(dict(RATINGS, ctf={'90': [9, 0, 1, 2, 3, 4]})))
+      backend = oloraculo_ratings.JsonBackend(file_name, log_file_name)
+
+      stats = oloraculo_ratings.Db()
+      self.assertTrue(backend.load(stats, 'ad'))
+      self.assertEqual({'ad'}, set(stats._tables))
+      self.assertEqual({'ad', 'ctf'}, stats.get_game_types())
+      self.assertEqual([1, 2], stats.get_winloss('ctf', 90))
+      self.assertEqual({'ad', 'ctf'}, set(stats._tables))
+
+      # unchanged files aren't parsed again
+      with patch('json.loads') as loads:
+        self.assertFalse(backend.load(stats, 'ad'))
+        self.assertFalse(loads.called)
+
+      # nor after writing them ourselves
+      stats.apply_deltas('ad', {12: [0, 0, 1, 0, 0, 0]})
+      backend.save_match(stats, 'ad', {12: [0, 0, 1, 0, 0, 0]})
+      self.assertFalse(backend.load(stats, 'ad'))
+      self.assertEqual([3, 1], stats.get_winloss('ad', 12))
+      stats.set_winloss('ad', 12, [7, 7])
+      stats.compact(file_name, log_file_name)
+      self.assertFalse(backend.load(stats, 'ad'))
+      self.assertEqual([7, 7], stats.get_winloss('ad', 12))
+
+      # the snapshot plus the log
+      stats.apply_deltas('ctf', {90: [0, 0, 1, 0, 0, 0]})
+      stats.append_log(log_file_name, 'ctf', {90: [0, 0, 1, 0, 0, 0]})
+      other_stats = oloraculo_ratings.Db()
+      self.assertTrue(backend.load(other_stats, None))
+      # only the game type in the log, the others aren't even parsed
+      self.assertEqual({'ctf'}, set(other_stats._tables))
+      self.assertIsInstance(other_stats._pending['ad'], str)
+      # still a JSON document
+      self.assertEqual({'_seq', 'ad', 'ctf'},
+                       set(json.loads(open(file_name).read())))
+      self.assertEqual([7, 7], other_stats.get_winloss('ad', 12))
+      self.assertEqual([2, 2], other_stats.get_winloss('ctf', 90))
+
+  def test_replay_log(self):
+    with tempfile.TemporaryDirectory() as directory:
+      json_file_path = os.path.join(directory, 'stats.json')
+      log_file_path = os.path.join(directory, 'stats.log')
+
+      stats = oloraculo_ratings.Db()
+      stats.set_winloss('ad', 12, [1, 1])
+      stats.save(json_file_path)
+      for seq in range(3):
+        stats.apply_deltas('ad', {12: [0, 0, 1, 0, 0, 0]})
+        stats.append_log(log_file_path, 'ad', {12: [0, 0, 1, 0, 0, 0]})
+      # a crash in the middle of a write
+      with open(log_file_path, 'a') as log_file:
+        log_file.write('{"seq":4,"ty')
+
+      loaded_stats = oloraculo_ratings.Db()
+      loaded_stats.load(json_file_path)
+      self.assertEqual(3, loaded_stats.replay_log(log_file_path))
+      self.assertEqual([4, 1], loaded_stats.get_winloss('ad', 12))
+      # unchanged log isn't applied twice
+      self.assertEqual(0, loaded_stats.replay_log(log_file_path))
+
+      # appending after the partial record doesn't join it
+      loaded_stats.apply_deltas('ad', {12: [0, 0, 0, 1, 0, 0]})
+      loaded_stats.append_log(log_file_path, 'ad', {12: [0, 0, 0, 1, 0, 0]})
+      replayed_stats = oloraculo_ratings.Db()
+      replayed_stats.load(json_file_path)
+      self.assertEqual(4, replayed_stats.replay_log(log_file_path))
+      self.assertEqual([4, 2], replayed_stats.get_winloss('ad', 12))
+
+      # a crash after saving but before emptying the log
+      loaded_stats.save(json_file_path)
+      loaded_stats = oloraculo_ratings.Db()
+      loaded_stats.load(json_file_path)
+      self.assertEqual(0, loaded_stats.replay_log(log_file_path))
+      self.assertEqual([4, 2], loaded_stats.get_winloss('ad', 12))
+
+  def test_replay_log_without_snapshot(self):
+    with tempfile.TemporaryDirectory() as directory:
+      json_file_path = os.path.join(directory, 'stats.json')
+      log_file_path = os.path.join(directory, 'stats.log')
+      backend = oloraculo_ratings.JsonBackend(json_file_path, log_file_path)
+
+      # restarted before the first compaction: only the log exists
+      stats = oloraculo_ratings.Db()
+      for seq in range(3):
+        stats.apply_deltas('ad', {12: [0, 0, 1, 0, 0, 0]})
+        backend.save_match(stats, 'ad', {12: [0, 0, 1, 0, 0, 0]})
+      self.assertFalse(os.path.exists(json_file_path))
+
+      restarted_stats = oloraculo_ratings.Db()
+      self.assertTrue(backend.load(restarted_stats, 'ad'))
+      self.assertEqual([3, 0], restarted_stats.get_winloss('ad', 12))
+      self.assertEqual(3, restarted_stats.get_log_records())
+
+      # the log goes on where it was, and compacting keeps every match
+      restarted_stats.apply_deltas('ad', {12: [0, 0, 0, 1, 0, 0]})
+      backend.save_match(restarted_stats, 'ad', {12: [0, 0, 0, 1, 0, 0]})
+      seqs = [json.loads(line)['seq'] for line in open(log_file_path)]
+      self.assertEqual([1, 2, 3, 4], seqs)
+      restarted_stats.compact(json_file_path, log_file_path)
+      compacted_stats = oloraculo_ratings.Db()
+      self.assertTrue(backend.load(compacted_stats, 'ad'))
+      self.assertEqual([3, 1], compacted_stats.get_winloss('ad', 12))
+
+  def test_compact_keeps_order(self):
+    with tempfile.TemporaryDirectory() as directory:
+      json_file_path = os.path.join(directory, 'stats.json')
+      log_file_path = os.path.join(directory, 'stats.log')
+      writer = REAL_PERSISTENCE.Writer()
+      writing = threading.Event()
+      release = threading.Event()
+      written = []
+      real_write = REAL_PERSISTENCE.write_atomically
+
+      def slow_write(file_name, data):
+        writing.set()
+        release.wait(5)
+        written.append(os.path.basename(file_name))
+        real_write(file_name, data)
+
+      stats = oloraculo_ratings.Db()
+      stats.set_winloss('ad', 12, [1, 1])
+      with patch.object(oloraculo_ratings, 'persistence', REAL_PERSISTENCE), \
+          patch.object(REAL_PERSISTENCE, 'WRITER', writer), \
+          patch.object(REAL_PERSISTENCE, 'write_atomically', slow_write):
+        # the writer is busy while two compactions are queued
+        stats.save(json_file_path)
+        self.assertTrue(writing.wait(5))
+        for seq in range(3):
+          stats.apply_deltas('ad', {12: [0, 0, 1, 0, 0, 0]})
+          stats.append_log(log_file_path, 'ad', {12: [0, 0, 1, 0, 0, 0]})
+          if seq < 2:
+            stats.compact(json_file_path, log_file_path)
+        release.set()
+        writer.flush()
+
+      # the second snapshot replaced the first one, and the log is only
+      # emptied after it
+      self.assertEqual(
+          ['stats.json', 'stats.json', 'stats.log', 'stats.log'], written)
+      self.assertEqual(1, len(open(log_file_path).readlines()))
+      loaded_stats = oloraculo_ratings.Db()
+      loaded_stats.load(json_file_path)
+      self.assertEqual(1, loaded_stats.replay_log(log_file_path))
+      self.assertEqual([4, 1], loaded_stats.get_winloss('ad', 12))
+
+  def test_sqlite_backend(self):
+    with tempfile.TemporaryDirectory() as directory:
+      json_file_path = os.path.join(directory, 'stats.json')
+      sqlite_file_path = os.path.join(directory, 'stats.sqlite')
+      with open(json_file_path, 'w') as stats_file:
+        stats_file.write(RATINGS_JSON)
+
+      with patch('oloraculo.JSON_FILE_PATH', json_file_path), \
+          patch('oloraculo.LOG_FILE_PATH', json_file_path + '.log'), \
+          patch('oloraculo.SQLITE_FILE_PATH', sqlite_file_path):
+        minqlx_fake.Plugin.cvars['qlx_oloraculoBackend'] = 'sqlite'
+        olor = oloraculo.oloraculo()
+        self.assertIsInstance(olor.backend, oloraculo_ratings.SqliteBackend)
+        self.assertEqual(set(), olor.get_stats().get_player_ids('ad'))
+
+        minqlx_fake.call_command('!oloraculo_migrate')
+        self.assertInMessages('Migrated 4 ratings')
+        self.assertEqual(RATINGS['ad'].keys(),
+                         olor.get_stats().get_player_ids('ad'))
+
+        minqlx_fake.run_game(PLAYER_ID_MAP, '', [56, 78], [12, 34], 7, 15)
+        minqlx_fake.load_player(minqlx_fake.Player(123456, 'sarge'))
+        olor.backend.close()
+
+        stats = oloraculo_ratings.Db()
+        backend = oloraculo_ratings.SqliteBackend(sqlite_file_path)
+        self.assertTrue(backend.load(stats, 'ad'))
+        self.assertFalse(backend.load(stats, 'ad'))
+        self.assertEqual(olor.get_stats(), stats)
+        self.assertEqual([3, 1], stats.get_winloss('ad', 12))
+        self.assertEqual([3, 3], stats.get_winloss('ad', 56))
+
+        # sorted by exposure (mu * 2 with the fake)
+        leaderboard = backend.get_leaderboard(stats, 'ad')
+        self.assertEqual([25, 3, 3, 2, 2], [row[0] for _, row in leaderboard])
+        self.assertEqual(123456, leaderboard[0][0])
+        backend.close()
+
+  def test_daemon_backend(self):
+    with tempfile.TemporaryDirectory() as directory:
+      json_file_path = os.path.join(directory, 'stats.json')
+      socket_path = os.path.join(directory, 'oloraculo.sock')
+      journal_file_path = os.path.join(directory, 'journal.jsonl')
+      with open(json_file_path, 'w') as stats_file:
+        stats_file.write(RATINGS_JSON)
+      service = oloraculo_daemon.RatingService(
+          oloraculo_ratings.JsonBackend(json_file_path,
+                                        json_file_path + '.log'))
+
+      def serve():
+        server = oloraculo_daemon.RatingServer(socket_path, service)
+        threading.Thread(target=server.serve_forever,
+                         args=(0.01,),
+                         daemon=True).start()
+        return server
+
+      server = serve()
+      minqlx_fake.Plugin.cvars['qlx_oloraculoBackend'] = 'daemon'
+      minqlx_fake.Plugin.cvars['qlx_oloraculoSocket'] = socket_path
+      with patch('oloraculo.JOURNAL_FILE_PATH', journal_file_path):
+        olor = oloraculo.oloraculo()
+      self.assertIsInstance(olor.backend, oloraculo_daemon.DaemonBackend)
+      olor.backend_calls.join()
+      self.assertEqual(RATINGS['ad'].keys(),
+                       olor.get_stats().get_player_ids('ad'))
+
+      # the game doesn't wait for the daemon, and the chat then shows the
+      # deltas of the daemon, not the local ones
+      handle_rate = service.handle_rate
+      rating = threading.Event()
+
+      def handle_rate_elsewhere(game_type, request):
+        self.assertTrue(rating.wait(5))
+        response = handle_rate(game_type, request)
+        response['deltas'] = dict.fromkeys(response['deltas'], 9.5)
+        return response
+
+      with patch.object(service, 'handle_rate', handle_rate_elsewhere):
+        minqlx_fake.run_game(PLAYER_ID_MAP, '', [56, 78], [12, 34], 7, 15)
+        self.assertFalse(
+            [line for line in minqlx_fake.Plugin.messages if '9.50' in line])
+        rating.set()
+        olor.backend_calls.join()
+      self.assertInMessages('Stats saved.')
+      self.assertInMessages('%12s:  9.50' % PLAYER_ID_MAP[12].name)
+      self.assertFalse(
+          [line for line in minqlx_fake.Plugin.messages if ':  2.00' in line])
+      self.assertEqual([3, 1], service.stats.get_winloss('ad', 12))
+      self.assertEqual(service.stats, olor.get_stats())
+      self.assertEqual('', open(journal_file_path).read())
+
+      # the daemon is down: the match is kept until it's back
+      server.shutdown()
+      server.server_close()
+      olor.backend.close()
+      minqlx_fake.run_game(PLAYER_ID_MAP, '', [56, 78], [12, 34], 7, 15)
+      olor.backend_calls.join()
+      self.assertInMessages('Could not save stats')
+      self.assertEqual([3, 1], service.stats.get_winloss('ad', 12))
+      self.assertEqual([4, 1], olor.get_stats().get_winloss('ad', 12))
+      self.assertEqual(1, len(open(journal_file_path).readlines()))
+
+      # even over a restart of the plugin
+      with patch('oloraculo.JOURNAL_FILE_PATH', journal_file_path):
+        minqlx_fake.reset()
+        minqlx_fake.Plugin.cvars['qlx_oloraculoBackend'] = 'daemon'
+        minqlx_fake.Plugin.cvars['qlx_oloraculoSocket'] = socket_path
+        olor = oloraculo.oloraculo()
+      olor.backend_calls.join()
+      self.assertInMessages('Could not load stats')
+      os.remove(socket_path)
+      server = serve()
+      self.addCleanup(server.server_close)
+      self.addCleanup(server.shutdown)
+      self.addCleanup(olor.backend.close)
+      olor.load_stats()
+      olor.backend_calls.join()
+      self.assertEqual([4, 1], service.stats.get_winloss('ad', 12))
+      self.assertEqual(service.stats, olor.get_stats())
+      self.assertEqual('', open(journal_file_path).read())
 
   @patch('builtins.open', mock_open(read_data=json.dumps({})))
   def test_handles_player_loaded(self):
@@ -116,20 +530,6 @@ class TestOloraculo(unittest.TestCase):
     self.assertEqual([0, 0], olor.get_stats().get_winloss('ad', 123456))
     self.assertEqual([0, 0], olor.get_stats().get_killdeath('ad', 123456))
 
-  @patch('builtins.open', mock_open(read_data=json.dumps({})))
-  def test_get_clean_name(self):
-    olor = oloraculo.oloraculo()
-    self.assertEqual('bluesyquaker', olor.get_clean_name('--bluesyquaker--'))
-    self.assertEqual('bluesy quaker', olor.get_clean_name('==bluesy quaker=='))
-    self.assertEqual('renga73', olor.get_clean_name(']v[renga73'))
-    self.assertEqual('fundiar', olor.get_clean_name(']v[ - fundiar'))
-    self.assertEqual('p-lu-k', olor.get_clean_name(']v[ p-lu-k'))
-    self.assertEqual('mandiok', olor.get_clean_name('mandiok -- ]v[ --'))
-    self.assertEqual('cococrue', olor.get_clean_name('coco]v[crue'))
-    self.assertEqual('toro', olor.get_clean_name('toro'))
-    self.assertEqual('jaunpi.diazv', olor.get_clean_name('jaunpi.diazv'))
-    self.assertEqual('jaunpi', olor.get_clean_name('jaunpi [[KoK]]'))
-
   @patch('builtins.open', mock_open(read_data=RATINGS_JSON))
   def test_oloraculo_stats(self):
     olor = oloraculo.oloraculo()
@@ -169,6 +569,43 @@ class TestOloraculo(unittest.TestCase):
     for player_name in player_names:
       self.assertTrue(player_name in ''.join(minqlx_fake.Plugin.messages))
 
+  @patch('builtins.open', mock_open(read_data=RATINGS_JSON))
+  def test_leaderboard(self):
+    olor = oloraculo.oloraculo()
+
+    def get_expected(stats):
+      rows = sorted(stats.get_rows('ad'),
+                    key=lambda row: (-row[1][0] * 2, row[0]))
+      return [(player_id, row[0] * 2, tuple(row)) for player_id, row in rows]
+
+    leaderboard = olor.get_leaderboard('ad')
+    self.assertEqual(get_expected(olor.get_stats()), list(leaderboard))
+    self.assertEqual(8, leaderboard.max_wl)
+    self.assertEqual(900, leaderboard.max_kd)
+
+    # The stats file can't change here, keep the leaderboard across games.
+    olor.load_stats = lambda: None
+    minqlx_fake.run_game(PLAYER_ID_MAP, '', [56, 78], [12, 34], 7, 15)
+    # Updated in place, not rebuilt.
+    self.assertIs(leaderboard, olor.get_leaderboard('ad'))
+    self.assertEqual(get_expected(olor.get_stats()), list(leaderboard))
+    self.assertEqual(9, leaderboard.max_wl)
+
+    minqlx_fake.load_player(minqlx_fake.Player(99, 'newbie'))
+    self.assertEqual(get_expected(olor.get_stats()), list(leaderboard))
+
+  @patch('builtins.open', mock_open(read_data=RATINGS_JSON))
+  def test_records_rating_history(self):
+    olor = oloraculo.oloraculo()
+    with patch.object(olor.rating_history, 'append') as append:
+      minqlx_fake.run_game(PLAYER_ID_MAP, '', [56, 78], [12, 34], 7, 15)
+    stats = olor.get_stats()
+    append.assert_called_once_with(
+        'ad', {
+            player_id: stats.get_row('ad', player_id)
+            for player_id in [12, 34, 56, 78]
+        })
+
   @patch('builtins.open', mock_open(read_data=RATINGS_JSON))
   def test_handles_game_end(self):
     olor = oloraculo.oloraculo()
@@ -207,6 +644,265 @@ class TestOloraculo(unittest.TestCase):
     minqlx_fake.run_game(PLAYER_ID_MAP, '', [56, 78], [12, 34], 7, 16)
     self.assertNotEqual(original_stats, olor.get_stats())
 
+  def test_get_team_partitions(self):
+
+    def brute_force(player_ids):
+      teams = list(itertools.combinations(player_ids, len(player_ids) // 2))
+      matches = set()
+      for team_a in teams:
+        for team_b in teams:
+          if not set(team_a) & set(team_b):
+            matches.add(frozenset([frozenset(team_a), frozenset(team_b)]))
+      return matches
+
+    self.assertEqual([], list(oloraculo_ratings.get_team_partitions([])))
+    self.assertEqual([], list(oloraculo_ratings.get_team_partitions([12])))
+    self.assertEqual([((12,), (34,))],
+                     list(oloraculo_ratings.get_team_partitions([12, 34])))
+
+    for player_count in range(2, 11):
+      player_ids = list(range(player_count))
+      partitions = list(oloraculo_ratings.get_team_partitions(player_ids))
+      matches = [
+          frozenset([frozenset(team_a), frozenset(team_b)])
+          for team_a, team_b in partitions
+      ]
+      # each split exactly once
+      self.assertEqual(len(matches), len(set(matches)))
+      self.assertEqual(brute_force(player_ids), set(matches))
+
+  def test_parse_dont_mix(self):
+    self.assertEqual(frozenset(), oloraculo_ratings.parse_dont_mix(''))
+    self.assertEqual(frozenset(), oloraculo_ratings.parse_dont_mix(None))
+    self.assertEqual(
+        frozenset([frozenset([1234, 5678]),
+                   frozenset([1234, 9987])]),
+        oloraculo_ratings.parse_dont_mix('1234:5678, 1234:9987,5678:1234,'))
+    self.assertEqual(
+        frozenset([frozenset([12, 34])]),
+        oloraculo_ratings.parse_dont_mix('12:34,12,12:12,ab:34,1:2:3'))
+
+  def test_get_team_partitions_dont_mix(self):
+    randomizer = random.Random(1234)
+    for player_count in range(2, 11):
+      player_ids = list(range(player_count))
+      for pair_count in [1, 2, 4]:
+        pairs = [
+            frozenset(randomizer.sample(player_ids, 2))
+            for _ in range(pair_count)
+        ]
+        # plus a pair with a player that isn't present
+        dont_mix = frozenset(pairs + [frozenset([0, 99])])
+        expected = [
+            (team_a, team_b)
+            for team_a, team_b in oloraculo_ratings.get_team_partitions(
+                player_ids)
+            if not any(pair <= set(team_a) or pair <= set(team_b)
+                       for pair in pairs)
+        ]
+        self.assertEqual(
+            expected,
+            list(oloraculo_ratings.get_team_partitions(player_ids, dont_mix)))
+
+    # nothing left
+    dont_mix = oloraculo_ratings.parse_dont_mix('12:34,12:56,12:78')
+    self.assertEqual([],
+                     list(
+                         oloraculo_ratings.get_team_partitions(
+                             [12, 34, 56, 78], dont_mix)))
+
+  @patch('builtins.open', mock_open(read_data=json.dumps({})))
+  def test_get_best_matches(self):
+    olor = oloraculo.oloraculo()
+    randomizer = random.Random(1234)
+    for player_count in range(2, 11):
+      for max_mu in [3, 50]:
+        player_ids = list(range(1, player_count + 1))
+        randomizer.shuffle(player_ids)
+        for player_id in player_ids:
+          olor.stats.set_rating(
+              'ad', player_id,
+              trueskill_fake.Rating(randomizer.randint(1, max_mu)))
+
+        exhaustive = oloraculo_ratings.sort_match_qualities(
+            olor.get_match_qualities(player_ids))
+        for count in [1, 4]:
+          expected = [[q, list(teams)] for q, teams in exhaustive[:count]]
+          best = olor.get_best_matches(player_ids, count)
+          self.assertEqual(expected, [[q, list(teams)] for q, teams in best])
+
+  def test_get_best_partitions_ties(self):
+    # Every split of equal ratings ties: the first ones are kept, and found
+    # without visiting the others.
+    player_ids = list(range(1, 25))
+    mus = dict.fromkeys(player_ids, 25)
+    start = time.time()
+    best = oloraculo_ratings.get_best_partitions(player_ids, mus, 4)
+    self.assertLess(time.time() - start, 1)
+    self.assertEqual(
+        list(itertools.islice(oloraculo_ratings.get_team_partitions(player_ids),
+                              4)), best)
+
+    # Same as the exhaustive search with two levels of ratings.
+    player_ids = list(range(1, 17))
+    mus = {player_id: 25 + 5 * (player_id % 2) for player_id in player_ids}
+    partitions = list(oloraculo_ratings.get_team_partitions(player_ids))
+    expected = sorted(partitions,
+                      key=lambda teams: abs(
+                          sum(mus[player_id] for player_id in teams[0]) -
+                          sum(mus[player_id] for player_id in teams[1])))[:4]
+    expected.sort(key=partitions.index)
+    self.assertEqual(expected,
+                     oloraculo_ratings.get_best_partitions(player_ids, mus, 4))
+
+  @patch('builtins.open', mock_open(read_data=RATINGS_JSON))
+  def test_get_best_matches_engines(self):
+    olor = oloraculo.oloraculo()
+    self.assertEqual('search', olor.get_engine())
+    player_ids = [12, 34, 56, 78]
+    expected = olor.get_best_matches(player_ids)
+
+    olor.set_cvar('qlx_oloraculoEngine', 'exhaustive')
+    self.assertEqual('exhaustive', olor.get_engine())
+    self.assertEqual(expected, olor.get_best_matches(player_ids))
+
+    olor.set_cvar('qlx_oloraculoEngine', 'invalid')
+    self.assertEqual('search', olor.get_engine())
+
+  @patch('builtins.open', mock_open(read_data=json.dumps({})))
+  def test_get_best_matches_dont_mix(self):
+    olor = oloraculo.oloraculo()
+    randomizer = random.Random(1234)
+    player_ids = list(range(1, 10))
+    for player_id in player_ids:
+      olor.stats.set_rating('ad', player_id,
+                            trueskill_fake.Rating(randomizer.randint(1, 50)))
+    olor.set_cvar('qlx_oloraculoDontMix', '1:2,3:4,1:5')
+    dont_mix = olor.get_dont_mix()
+    self.assertEqual(3, len(dont_mix))
+
+    for player_count in range(2, 10):
+      present = player_ids[:player_count]
+      exhaustive = oloraculo_ratings.sort_match_qualities(
+          olor.get_match_qualities(present))
+      self.assertEqual(exhaustive[:4], olor.get_best_matches(present, 4))
+
+      engines = ['search', 'exhaustive']
+      if oloraculo_ratings.numpy is not None:
+        engines.append('numpy')
+      for engine in engines:
+        best = olor.get_best_matches(present, 4, engine=engine)
+        self.assertTrue(best or player_count < 4)
+        for team_a, team_b in [teams for _, teams in best]:
+          for pair in dont_mix:
+            self.assertFalse(pair <= set(team_a) or pair <= set(team_b))
+
+  @patch('builtins.open', mock_open(read_data=RATINGS_JSON))
+  def test_oloraculo_dont_mix(self):
+    olor = oloraculo.oloraculo()
+    minqlx_fake.Plugin.set_players_by_team({
+        'red': [PLAYER_ID_MAP[12], PLAYER_ID_MAP[34]],
+        'blue': [PLAYER_ID_MAP[56], PLAYER_ID_MAP[78]]
+    })
+
+    def get_predictions():
+      return [l for l in minqlx_fake.Plugin.messages if ' vs ' in l]
+
+    minqlx_fake.call_command('!oloraculo')
+    self.assertEqual(3, len(get_predictions()))
+
+    # parsed once, until the cvar changes
+    olor.set_cvar('qlx_oloraculoDontMix', '12:34,12:56')
+    dont_mix = olor.get_dont_mix()
+    self.assertIs(dont_mix, olor.get_dont_mix())
+
+    minqlx_fake.Plugin.reset_log()
+    minqlx_fake.call_command('!oloraculo')
+    self.assertEqual(1, len(get_predictions()))
+    self.assertInMessages('john, ringo')
+    # not the predictions cached without the pairs
+    self.assertEqual(2, len(olor.predictions_cache))
+
+    olor.set_cvar('qlx_oloraculoDontMix', '12:34,12:56,12:78')
+    self.assertIsNot(dont_mix, olor.get_dont_mix())
+    minqlx_fake.Plugin.reset_log()
+    minqlx_fake.call_command('!oloraculo')
+    self.assertInMessages('No teams keep the qlx_oloraculoDontMix pairs apart')
+
+  @unittest.skipIf(oloraculo_ratings.numpy is None, 'numpy is not installed')
+  @unittest.skipIf(REAL_TRUESKILL is None, 'trueskill is not installed')
+  def test_get_vectorized_qualities(self):
+    randomizer = random.Random(1234)
+    player_ids = list(range(7))
+    ratings = {
+        player_id: REAL_TRUESKILL.Rating(randomizer.uniform(15, 35),
+                                         randomizer.uniform(1, 8))
+        for player_id in player_ids
+    }
+
+    with patch.object(oloraculo_ratings, 'trueskill', REAL_TRUESKILL):
+      for dont_mix in [None, oloraculo_ratings.parse_dont_mix('0:1,2:3')]:
+        expected = oloraculo_ratings.get_match_qualities(
+            player_ids, ratings, dont_mix)
+        qualities = oloraculo_ratings.get_vectorized_match_qualities(
+            player_ids, ratings, dont_mix)
+        self.assertEqual([teams for _, teams in expected],
+                         [teams for _, teams in qualities])
+        for (quality, _), (expected_quality, _) in zip(qualities, expected):
+          self.assertAlmostEqual(expected_quality, quality)
+
+  @unittest.skipIf(oloraculo_ratings.numpy is None, 'numpy is not installed')
+  @unittest.skipIf(REAL_TRUESKILL is None, 'trueskill is not installed')
+  def test_get_vectorized_best_matches(self):
+    randomizer = random.Random(4321)
+    player_ids = list(range(9))
+    ratings = {
+        player_id: REAL_TRUESKILL.Rating(randomizer.uniform(15, 35),
+                                         randomizer.uniform(1, 8))
+        for player_id in player_ids
+    }
+    equal_ratings = {
+        player_id: REAL_TRUESKILL.Rating(25, 5) for player_id in player_ids
+    }
+
+    # Small chunks, so the best matches are carried over several of them.
+    with patch.object(oloraculo_ratings, 'trueskill', REAL_TRUESKILL), \
+        patch.object(oloraculo_ratings, 'VECTORIZED_CHUNK_SIZE', 7):
+      for dont_mix in [None, oloraculo_ratings.parse_dont_mix('0:1,2:3')]:
+        for count in [1, 5, 1000]:
+          expected = oloraculo_ratings.sort_match_qualities(
+              oloraculo_ratings.get_vectorized_match_qualities(
+                  player_ids, ratings, dont_mix))[:count]
+          self.assertEqual(
+              expected,
+              oloraculo_ratings.get_vectorized_best_matches(
+                  player_ids, ratings, count, dont_mix))
+          exhaustive = oloraculo_ratings.get_best_matches(
+              player_ids, ratings, count, 'exhaustive', dont_mix)
+          self.assertEqual([teams for _, teams in exhaustive],
+                           [teams for _, teams in expected])
+
+          # All ties: the first splits win.
+          partitions = list(
+              oloraculo_ratings.get_team_partitions(player_ids, dont_mix))
+          self.assertEqual(
+              [list(teams) for teams in partitions[:count]], [
+                  teams for _, teams in oloraculo_ratings.get_best_matches(
+                      player_ids, equal_ratings, count, 'numpy', dont_mix)
+              ])
+
+  @unittest.skipIf(oloraculo_ratings.numpy is None, 'numpy is not installed')
+  @patch('builtins.open', mock_open(read_data=RATINGS_JSON))
+  def test_oloraculo_numpy_engine(self):
+    olor = oloraculo.oloraculo()
+    olor.set_cvar('qlx_oloraculoEngine', 'numpy')
+    self.assertEqual('numpy', olor.get_engine())
+    matches = olor.get_best_matches([12, 34, 56, 78])
+    self.assertEqual(3, len(matches))
+    for quality, teams in matches:
+      self.assertIsInstance(quality, float)
+      self.assertEqual(2, len(teams))
+
   @patch('builtins.open', mock_open(read_data=RATINGS_JSON))
   def test_oloraculo_no_predictions(self):
     olor = oloraculo.oloraculo()
@@ -248,6 +944,82 @@ class TestOloraculo(unittest.TestCase):
       self.assertEqual(match_key(expected[1], expected[2]),
                        match_key(parts[1].split(','), parts[2].split(',')))
 
+  @patch('builtins.open', mock_open(read_data=RATINGS_JSON))
+  def test_oloraculo_cached_predictions(self):
+    olor = oloraculo.oloraculo()
+    minqlx_fake.Plugin.set_players_by_team({
+        'red': [PLAYER_ID_MAP[12], PLAYER_ID_MAP[34]],
+        'blue': [PLAYER_ID_MAP[56], PLAYER_ID_MAP[78]]
+    })
+
+    with patch.object(olor, 'get_best_matches',
+                      wraps=olor.get_best_matches) as get_best_matches:
+      minqlx_fake.Plugin.reset_log()
+      minqlx_fake.call_command('!oloraculo')
+      first_predictions = minqlx_fake.Plugin.messages
+      minqlx_fake.Plugin.reset_log()
+      minqlx_fake.call_command('!oloraculo')
+      self.assertEqual(first_predictions, minqlx_fake.Plugin.messages)
+      self.assertEqual(1, get_best_matches.call_count)
+
+      # ratings changed
+      minqlx_fake.run_game(PLAYER_ID_MAP, '', [12, 34], [56, 78], 7, 15)
+      minqlx_fake.call_command('!oloraculo')
+      self.assertEqual(2, get_best_matches.call_count)
+
+    # least recently used entries are dropped
+    for generation in range(oloraculo.PREDICTIONS_CACHE_SIZE + 1):
+      olor.ratings_generation += 1
+      olor.get_cached_best_matches([12, 34])
+    self.assertEqual(oloraculo.PREDICTIONS_CACHE_SIZE,
+                     len(olor.predictions_cache))
+
+  @patch('builtins.open', mock_open(read_data=RATINGS_JSON))
+  @patch('threading.Thread', FakeThread)
+  def test_oloraculo_precomputed_predictions(self):
+    olor = oloraculo.oloraculo()
+    FakeThread.started = 0
+    minqlx_fake.Plugin.set_players_by_team({
+        'red': [PLAYER_ID_MAP[12], PLAYER_ID_MAP[34], PLAYER_ID_MAP[56]],
+        'blue': [PLAYER_ID_MAP[78]]
+    })
+    minqlx_fake.load_player(PLAYER_ID_MAP[78])
+    self.assertEqual(1, FakeThread.started)
+
+    # same players, already computed
+    minqlx_fake.switch_team(PLAYER_ID_MAP[56], 'blue')
+    self.assertEqual(1, FakeThread.started)
+
+    minqlx_fake.switch_team(PLAYER_ID_MAP[56], 'spectator')
+    self.assertEqual(2, FakeThread.started)
+
+    with patch.object(olor, 'get_best_matches') as get_best_matches:
+      minqlx_fake.call_command('!oloraculo')
+      self.assertFalse(get_best_matches.called)
+    self.assertEqual(
+        3, len([l for l in minqlx_fake.Plugin.messages if ' vs ' in l]))
+
+    # no precomputation for less than 2 players
+    minqlx_fake.disconnect_player(PLAYER_ID_MAP[12])
+    self.assertEqual(3, FakeThread.started)
+    minqlx_fake.disconnect_player(PLAYER_ID_MAP[34])
+    self.assertEqual(3, FakeThread.started)
+
+    # not during matches
+    minqlx_fake.Plugin.game.state = 'in_progress'
+    minqlx_fake.switch_team(PLAYER_ID_MAP[56], 'red')
+    self.assertEqual(3, FakeThread.started)
+
+    # roster without precomputed predictions is computed inline
+    minqlx_fake.Plugin.set_players_by_team({
+        'red': [PLAYER_ID_MAP[12], PLAYER_ID_MAP[34]],
+        'blue': [PLAYER_ID_MAP[56]]
+    })
+    minqlx_fake.Plugin.reset_log()
+    minqlx_fake.call_command('!oloraculo')
+    self.assertEqual(
+        3, len([l for l in minqlx_fake.Plugin.messages if ' vs ' in l]))
+
   @patch('builtins.open', mock_open(read_data=RATINGS_JSON))
   def test_oloraculo_move_players(self):
     olor = oloraculo.oloraculo()
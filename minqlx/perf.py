@@ -0,0 +1,111 @@
+import json
+import minqlx
+import os
+import threading
+import time
+
+if __package__:
+  # Loaded by minqlx, as <plugins_dir>.<name>.
+  from . import chat_output
+  from . import instrumentation
+  from . import persistence
+else:
+  import chat_output
+  import instrumentation
+  import persistence
+
+HEADER_COLOR_STRING = '^2'
+JSON_FILE_NAME = 'perf_metrics.json'
+ROOT_PATH = os.path.dirname(os.path.realpath(__file__))
+JSON_FILE_PATH = os.path.join(ROOT_PATH, JSON_FILE_NAME)
+WRITE_INTERVAL_CVAR = 'qlx_perfWriteInterval'
+# Handlers shown by !perf, slowest p99 first.
+PRINTED_HANDLERS = 10
+"""
+Metrics file for reference, written every qlx_perfWriteInterval seconds:
+{
+  "time": unix_time,
+  "handlers": {
+    "plugin.command:name": {
+      "count": calls, "max": s, "p50": s, "p95": s, "p99": s,
+      "alloc_p50": blocks, "alloc_p95": blocks, "alloc_p99": blocks
+    },
+    ...
+  }
+}
+"""
+
+
+class perf(chat_output.Buffered, minqlx.Plugin):
+
+  def __init__(self):
+    self.add_command('perf', self.cmd_perf, 2)
+    self.add_hook('unload', self.handle_unload)
+
+    self.set_cvar_once(WRITE_INTERVAL_CVAR, '60')
+    self.stop_writing = threading.Event()
+    self.writer = threading.Thread(target=self.write_metrics_periodically,
+                                   args=(self.get_write_interval(),),
+                                   daemon=True)
+    self.writer.start()
+
+  def print_log(self, msg):
+    self.msg('%sPerf:^7 %s' % (HEADER_COLOR_STRING, msg))
+
+  def print_header(self, message):
+    self.msg('%s%s' % (HEADER_COLOR_STRING, '=' * 80))
+    self.msg('%sPerf v1.0:^7 %s' % (HEADER_COLOR_STRING, message))
+    self.msg('%s%s' % (HEADER_COLOR_STRING, '-' * 80))
+
+  def get_write_interval(self):
+    try:
+      return max(1, self.get_cvar(WRITE_INTERVAL_CVAR, int))
+    except (TypeError, ValueError):
+      return 60
+
+  def get_metrics(self):
+    return {
+        'time': int(time.time()),
+        'handlers': instrumentation.REGISTRY.get_summaries()
+    }
+
+  def write_metrics(self):
+    persistence.save(JSON_FILE_PATH,
+                     json.dumps(self.get_metrics(), sort_keys=True, indent=2))
+
+  def write_metrics_periodically(self, interval):
+    # Runs on its own thread until unload.
+    while not self.stop_writing.wait(interval):
+      self.write_metrics()
+
+  def handle_unload(self, plugin):
+    if plugin != self.__class__.__name__:
+      return
+    self.stop_writing.set()
+    self.write_metrics()
+    persistence.flush()
+
+  def cmd_perf(self, player, msg, channel):
+    summaries = instrumentation.REGISTRY.get_summaries()
+    if len(msg) > 1:
+      summaries = {
+          key: summary
+          for key, summary in summaries.items()
+          if msg[1].lower() in key.lower()
+      }
+    summaries = [(key, summary)
+                 for key, summary in summaries.items()
+                 if 'p99' in summary]
+    if not summaries:
+      self.print_log('No handler calls recorded yet.')
+      return
+
+    summaries.sort(key=lambda item: item[1]['p99'], reverse=True)
+    self.print_header('handler latency (ms), slowest first')
+    for key, summary in summaries[:PRINTED_HANDLERS]:
+      self.msg('^5%-32s^7 ^3%6.1f %6.1f %6.1f^7 max %6.1f · %5d calls · '
+               '%d blocks' % (key, summary['p50'] * 1000,
+                              summary['p95'] * 1000, summary['p99'] * 1000,
+                              summary['max'] * 1000, summary['count'],
+                              summary['alloc_p99']))
+    self.msg(' ')
@@ -0,0 +1,91 @@
+import json
+import minqlx_fake
+import persistence_fake
+import sys
+import unittest
+
+from unittest.mock import mock_open
+from unittest.mock import patch
+
+sys.modules['minqlx'] = minqlx_fake
+sys.modules['persistence'] = persistence_fake
+import instrumentation
+import perf
+
+
+class TestPerf(unittest.TestCase):
+
+  def setUp(self):
+    minqlx_fake.reset()
+    instrumentation.REGISTRY.reset()
+    for index in range(100):
+      instrumentation.REGISTRY.add('funes.hook:game_end', 0.001 * index, 10)
+      instrumentation.REGISTRY.add('timba.command:timba', 0.0001, 0)
+
+  def get_plugin(self):
+    plugin = perf.perf()
+    self.addCleanup(plugin.stop_writing.set)
+    return plugin
+
+  def test_registers_commands_and_hooks(self):
+    plugin = self.get_plugin()
+    self.assertEqual(['perf'],
+                     [cmd[0] for cmd in minqlx_fake.Plugin.registered_commands])
+    self.assertEqual(['unload'],
+                     [hook[0] for hook in minqlx_fake.Plugin.registered_hooks])
+    self.assertTrue(plugin.writer.is_alive())
+
+  def test_perf(self):
+    plugin = self.get_plugin()
+    minqlx_fake.call_command('!perf')
+    lines = [l for l in minqlx_fake.Plugin.messages if 'calls' in l]
+    self.assertEqual(2, len(lines))
+    # slowest first
+    self.assertIn('funes.hook:game_end', lines[0])
+    self.assertIn('49.0   94.0   98.0 max   99.0 ·   100 calls', lines[0])
+    self.assertIn('timba.command:timba', lines[1])
+
+    minqlx_fake.Plugin.reset_log()
+    minqlx_fake.call_command('!perf TIMBA')
+    lines = [l for l in minqlx_fake.Plugin.messages if 'calls' in l]
+    self.assertEqual(1, len(lines))
+    self.assertIn('timba.command:timba', lines[0])
+
+  def test_perf_no_calls(self):
+    instrumentation.REGISTRY.reset()
+    plugin = self.get_plugin()
+    minqlx_fake.call_command('!perf')
+    self.assertEqual(['Perf: No handler calls recorded yet.'],
+                     minqlx_fake.Plugin.messages)
+
+  @patch('builtins.open', new_callable=mock_open)
+  def test_writes_metrics(self, m):
+    plugin = self.get_plugin()
+    plugin.write_metrics()
+    m.assert_called_once_with(perf.JSON_FILE_PATH, 'w+')
+    metrics = json.loads(m.return_value.write.call_args[0][0])
+    self.assertEqual(['funes.hook:game_end', 'timba.command:timba'],
+                     sorted(metrics['handlers']))
+    self.assertEqual(100, metrics['handlers']['funes.hook:game_end']['count'])
+
+  @patch('builtins.open', new_callable=mock_open)
+  def test_writes_metrics_periodically(self, m):
+    minqlx_fake.Plugin.cvars[perf.WRITE_INTERVAL_CVAR] = '1'
+    plugin = perf.perf()
+    with patch.object(plugin.stop_writing, 'wait',
+                      side_effect=[False, False, True]):
+      plugin.write_metrics_periodically(1)
+    self.assertEqual(2, m.call_count)
+
+    # unload stops the thread, after a last write
+    plugin.handle_unload('funes')
+    self.assertFalse(plugin.stop_writing.is_set())
+    plugin.handle_unload('perf')
+    self.assertTrue(plugin.stop_writing.is_set())
+    self.assertEqual(3, m.call_count)
+    plugin.writer.join(5)
+    self.assertFalse(plugin.writer.is_alive())
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,136 @@
+import atexit
+import logging
+import os
+import threading
+"""
+Write-behind file persistence shared by the plugins.
+
+Plugins hand over the full contents of a file (save) or a chunk to add at its
+end (append) and return right away. A single background thread does the disk
+work, in the order it was requested:
+  * a save replaces anything still pending for the same file, so a burst of
+    saves only writes the last one;
+  * consecutive appends to the same file are written at once;
+  * saves go to a temporary file that is fsynced and renamed over the old one,
+    so a crash never leaves a partially written file.
+
+Call flush() before reading a file that may have pending writes, and when a
+plugin unloads.
+"""
+
+
+def write_atomically(file_name, data):
+  temp_file_name = '%s.tmp' % file_name
+  with open(temp_file_name, 'w') as temp_file:
+    temp_file.write(data)
+    temp_file.flush()
+    os.fsync(temp_file.fileno())
+  os.replace(temp_file_name, file_name)
+
+
+def append_durably(file_name, data):
+  with open(file_name, 'ab' if isinstance(data, bytes) else 'a') as append_file:
+    append_file.write(data)
+    append_file.flush()
+    os.fsync(append_file.fileno())
+
+
+class Writer(object):
+
+  def __init__(self):
+    self._condition = threading.Condition()
+    # [[file_name, mode ('w' or 'a'), data, [on_written, ...]], ...]
+    self._pending = []
+    # File being written by the thread, if any.
+    self._writing = None
+    self._thread = None
+
+  def _enqueue(self, file_name, mode, data, on_written):
+    callbacks = [on_written] if on_written else []
+    with self._condition:
+      last = self._pending[-1] if self._pending else None
+      if mode == 'w':
+        # Whatever was pending for the file would be overwritten anyway.
+        for operation in self._pending:
+          if operation[0] == file_name:
+            callbacks = operation[3] + callbacks
+        self._pending = [op for op in self._pending if op[0] != file_name]
+        self._pending.append([file_name, mode, data, callbacks])
+      elif last and last[0] == file_name:
+        # Appending right after a pending write to the same file.
+        last[2] += data
+        last[3] += callbacks
+      else:
+        self._pending.append([file_name, mode, data, callbacks])
+
+      if self._thread is None:
+        self._thread = threading.Thread(target=self._run,
+                                        name='persistence',
+                                        daemon=True)
+        self._thread.start()
+      self._condition.notify_all()
+
+  def _run(self):
+    while True:
+      with self._condition:
+        while not self._pending:
+          self._condition.wait()
+        file_name, mode, data, callbacks = self._pending.pop(0)
+        self._writing = file_name
+
+      try:
+        if mode == 'w':
+          write_atomically(file_name, data)
+        else:
+          append_durably(file_name, data)
+        for callback in callbacks:
+          callback()
+      except Exception:
+        logging.getLogger(__name__).exception('Could not write %s', file_name)
+      finally:
+        with self._condition:
+          self._writing = None
+          self._condition.notify_all()
+
+  def save(self, file_name, data, on_written=None):
+    """Replaces the contents of file_name with data, in the background."""
+    self._enqueue(file_name, 'w', data, on_written)
+
+  def append(self, file_name, data, on_written=None):
+    """Adds data (str or bytes) at the end of file_name, in the background."""
+    self._enqueue(file_name, 'a', data, on_written)
+
+  def is_pending(self, file_name=None):
+    with self._condition:
+      return self._is_pending(file_name)
+
+  def _is_pending(self, file_name):
+    if file_name is None:
+      return bool(self._pending) or self._writing is not None
+    return (self._writing == file_name or
+            any(op[0] == file_name for op in self._pending))
+
+  def flush(self, file_name=None, timeout=None):
+    """Waits until file_name (or every file) is written.
+
+    Returns False if timeout seconds passed first.
+    """
+    with self._condition:
+      return self._condition.wait_for(
+          lambda: not self._is_pending(file_name), timeout)
+
+
+WRITER = Writer()
+atexit.register(WRITER.flush)
+
+
+def save(file_name, data, on_written=None):
+  WRITER.save(file_name, data, on_written)
+
+
+def append(file_name, data, on_written=None):
+  WRITER.append(file_name, data, on_written)
+
+
+def flush(file_name=None, timeout=None):
+  return WRITER.flush(file_name, timeout)
@@ -0,0 +1,31 @@
+# Writes right away, so tests can check files (or mocked open() calls) as soon
+# as a plugin saves.
+
+saved = []
+
+
+def reset():
+  global saved
+  saved = []
+
+
+def write_atomically(file_name, data):
+  open(file_name, 'w+').write(data)
+
+
+def save(file_name, data, on_written=None):
+  open(file_name, 'w+').write(data)
+  saved.append(file_name)
+  if on_written:
+    on_written()
+
+
+def append(file_name, data, on_written=None):
+  open(file_name, 'ab' if isinstance(data, bytes) else 'a').write(data)
+  saved.append(file_name)
+  if on_written:
+    on_written()
+
+
+def flush(file_name=None, timeout=None):
+  return True
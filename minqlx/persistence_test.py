@@ -0,0 +1,105 @@
+import os
+import sys
+import tempfile
+import threading
+import unittest
+
+# Plugin tests replace the module with persistence_fake.
+sys.modules.pop('persistence', None)
+import persistence
+
+from unittest.mock import patch
+
+
+class TestPersistence(unittest.TestCase):
+
+  def setUp(self):
+    self.directory = tempfile.TemporaryDirectory()
+    self.file_name = os.path.join(self.directory.name, 'data.json')
+    self.writer = persistence.Writer()
+
+  def tearDown(self):
+    self.writer.flush()
+    self.directory.cleanup()
+
+  def read(self, file_name=None):
+    return open(file_name or self.file_name).read()
+
+  def test_save(self):
+    written = []
+    self.writer.save(self.file_name, '{"a": 1}', lambda: written.append(1))
+    self.assertTrue(self.writer.flush(self.file_name, 5))
+    self.assertEqual('{"a": 1}', self.read())
+    self.assertEqual([1], written)
+    self.assertFalse(self.writer.is_pending())
+    self.assertFalse(os.path.exists(self.file_name + '.tmp'))
+
+  def test_append(self):
+    self.writer.save(self.file_name, 'a\n')
+    self.writer.append(self.file_name, 'b\n')
+    self.writer.append(self.file_name, 'c\n')
+    self.writer.flush()
+    self.assertEqual('a\nb\nc\n', self.read())
+
+  def test_append_bytes(self):
+    self.writer.append(self.file_name, b'\x00\x01')
+    self.writer.append(self.file_name, b'\x02')
+    self.writer.flush()
+    self.assertEqual(b'\x00\x01\x02', open(self.file_name, 'rb').read())
+
+  def test_coalesces_saves(self):
+    other_file_name = os.path.join(self.directory.name, 'other.json')
+    written = []
+    release = threading.Event()
+    real_write = persistence.write_atomically
+
+    def slow_write(file_name, data):
+      release.wait(5)
+      written.append(data)
+      real_write(file_name, data)
+
+    with patch.object(persistence, 'write_atomically', slow_write):
+      # the first one is picked up right away, the rest wait
+      self.writer.save(other_file_name, 'other')
+      for index in range(10):
+        self.writer.save(self.file_name, str(index))
+      self.assertTrue(self.writer.is_pending(self.file_name))
+      release.set()
+      self.writer.flush()
+
+    self.assertEqual(['other', '9'], written)
+    self.assertEqual('9', self.read())
+    self.assertEqual('other', self.read(other_file_name))
+
+  def test_keeps_order(self):
+    log_file_name = os.path.join(self.directory.name, 'data.log')
+    order = []
+
+    def on_written(name):
+      return lambda: order.append(name)
+
+    self.writer.append(log_file_name, '1', on_written('log'))
+    self.writer.save(self.file_name, 'snapshot', on_written('snapshot'))
+    self.writer.save(log_file_name, '', on_written('truncate'))
+    self.writer.append(log_file_name, '2', on_written('log'))
+    self.writer.flush()
+    self.assertEqual('snapshot', self.read())
+    self.assertEqual('2', self.read(log_file_name))
+    # the first append may be dropped by the truncate, not its callback
+    self.assertEqual(['log', 'log', 'snapshot', 'truncate'], sorted(order))
+    self.assertLess(order.index('snapshot'), order.index('truncate'))
+    self.assertEqual('log', order[-1])
+
+  def test_write_error(self):
+    missing_file_name = os.path.join(self.directory.name, 'nope', 'data.json')
+    with self.assertLogs('persistence'):
+      self.writer.save(missing_file_name, 'data')
+      self.writer.flush()
+    # still usable
+    self.writer.save(self.file_name, 'data')
+    self.writer.flush()
+    self.assertEqual('data', self.read())
+
+
+if __name__ == '__main__':
+  unittest.main()
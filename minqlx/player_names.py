@@ -0,0 +1,47 @@
+import functools
+import re
+"""
+Clean player names, shared by the plugins.
+
+get_clean_name() strips clan tags and decorations from a name, e.g.
+"]v[ - fundiar" is "fundiar". Names repeat a lot, so results are kept in a
+bounded LRU cache.
+
+DIRECTORY maps the steam_id of every player seen (on player_loaded, or when a
+plugin looks at the players) to their clean name, for all plugins.
+"""
+
+CLEAN_NAME_REGEX = re.compile(
+    r'([\W]*\]v\[[\W]*|^\W+|\W+$|[^a-zA-Z0-9\ ]+.+\W$)')
+CACHE_SIZE = 1024
+
+
+@functools.lru_cache(maxsize=CACHE_SIZE)
+def get_clean_name(name):
+  return CLEAN_NAME_REGEX.sub('', name).lower().strip()
+
+
+class Directory(object):
+  """steam_id to clean name, of every player seen so far."""
+
+  def __init__(self):
+    self.names = {}
+
+  def add(self, player):
+    """Records the name of player and returns it."""
+    name = get_clean_name(player.clean_name)
+    self.names[player.steam_id] = name
+    return name
+
+  def add_players(self, players):
+    for player in players:
+      self.add(player)
+
+  def get(self, steam_id, default=None):
+    return self.names.get(steam_id, default)
+
+  def clear(self):
+    self.names = {}
+
+
+DIRECTORY = Directory()
@@ -0,0 +1,60 @@
+import minqlx_fake
+import unittest
+
+import player_names
+
+
+class TestPlayerNames(unittest.TestCase):
+
+  def setUp(self):
+    player_names.get_clean_name.cache_clear()
+
+  def test_get_clean_name(self):
+    get_clean_name = player_names.get_clean_name
+    self.assertEqual('bluesyquaker', get_clean_name('--bluesyquaker--'))
+    self.assertEqual('bluesy quaker', get_clean_name('==bluesy quaker=='))
+    self.assertEqual('renga73', get_clean_name(']v[renga73'))
+    self.assertEqual('fundiar', get_clean_name(']v[ - fundiar'))
+    self.assertEqual('p-lu-k', get_clean_name(']v[ p-lu-k'))
+    self.assertEqual('mandiok', get_clean_name('mandiok -- ]v[ --'))
+    self.assertEqual('cococrue', get_clean_name('coco]v[crue'))
+    self.assertEqual('toro', get_clean_name('toro'))
+    self.assertEqual('jaunpi.diazv', get_clean_name('jaunpi.diazv'))
+    self.assertEqual('jaunpi', get_clean_name('jaunpi [[KoK]]'))
+
+  def test_get_clean_name_cache(self):
+    for _ in range(3):
+      player_names.get_clean_name(']v[ - fundiar')
+    cache_info = player_names.get_clean_name.cache_info()
+    self.assertEqual(1, cache_info.misses)
+    self.assertEqual(2, cache_info.hits)
+
+    for index in range(player_names.CACHE_SIZE * 2):
+      player_names.get_clean_name('player %d' % index)
+    self.assertEqual(player_names.CACHE_SIZE,
+                     player_names.get_clean_name.cache_info().currsize)
+
+  def test_directory(self):
+    directory = player_names.Directory()
+    self.assertEqual(None, directory.get(12))
+    self.assertEqual('...', directory.get(12, '...'))
+
+    self.assertEqual('fundiar',
+                     directory.add(minqlx_fake.Player(12, ']v[ - fundiar')))
+    directory.add_players([
+        minqlx_fake.Player(34, '--bluesyquaker--'),
+        minqlx_fake.Player(56, 'toro')
+    ])
+    self.assertEqual('fundiar', directory.get(12))
+    self.assertEqual('bluesyquaker', directory.get(34))
+
+    # renamed
+    directory.add(minqlx_fake.Player(56, ']v[ el toro'))
+    self.assertEqual('el toro', directory.get(56))
+
+    directory.clear()
+    self.assertEqual(None, directory.get(12))
+
+
+if __name__ == '__main__':
+  unittest.main()
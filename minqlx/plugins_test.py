@@ -0,0 +1,70 @@
+import glob
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+ROOT_PATH = os.path.dirname(os.path.realpath(__file__))
+
+# Run in a fresh interpreter: only the plugins package is importable, so a
+# top-level import of a helper module fails like it does under minqlx.
+LOAD_PLUGIN = '''
+import importlib
+import sys
+module = importlib.import_module('plugins.%s')
+assert hasattr(module, '%s')
+print(' '.join(sorted(name for name in sys.modules
+                      if name.startswith('plugins.'))))
+'''
+
+
+class TestPlugins(unittest.TestCase):
+  """The plugins load the way minqlx loads them, as <plugins_dir>.<name>."""
+
+  def setUp(self):
+    directory = tempfile.TemporaryDirectory()
+    self.addCleanup(directory.cleanup)
+    self.directory = directory.name
+    # Like docker/setup_plugins.sh, with the fake standing in for minqlx.
+    plugins_path = os.path.join(self.directory, 'plugins')
+    os.mkdir(plugins_path)
+    for file_name in glob.glob(os.path.join(ROOT_PATH, '*.py')):
+      if not file_name.endswith(('_test.py', '_fake.py')):
+        shutil.copy(file_name, plugins_path)
+    shutil.copy(os.path.join(ROOT_PATH, 'minqlx_fake.py'),
+                os.path.join(self.directory, 'minqlx.py'))
+
+  def load(self, plugin):
+    process = subprocess.run(
+        [sys.executable, '-c', LOAD_PLUGIN % (plugin, plugin)],
+        cwd=self.directory,
+        env=dict(os.environ, PYTHONPATH=''),
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        universal_newlines=True)
+    self.assertEqual(0, process.returncode, process.stderr)
+    return process.stdout.split()
+
+  def test_load(self):
+    for plugin in [
+        'funes', 'lagparatodos', 'lmsound', 'mapuche', 'perf', 'timba'
+    ]:
+      self.assertIn('plugins.chat_output', self.load(plugin))
+    self.assertIn('plugins.player_names', self.load('funes'))
+
+  def test_load_oloraculo(self):
+    try:
+      import trueskill
+    except ImportError:
+      self.skipTest('trueskill is not installed')
+    self.assertLessEqual(
+        {
+            'plugins.oloraculo_daemon', 'plugins.oloraculo_history',
+            'plugins.oloraculo_ratings', 'plugins.persistence'
+        }, set(self.load('oloraculo')))
+
+
+if __name__ == '__main__':
+  unittest.main()
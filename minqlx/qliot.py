@@ -6,6 +6,14 @@ import time
 
 from Adafruit_IO import *
 
+if __package__:
+  # Loaded by minqlx, as <plugins_dir>.<name>.
+  from . import chat_output
+  from . import instrumentation
+else:
+  import chat_output
+  import instrumentation
+
 # Set to your Adafruit IO key & username below.
 ADAFRUIT_IO_KEY = '23e6038612264843b38d1b7f8a54c808'
 ADAFRUIT_IO_USERNAME = 'lucote'
@@ -19,7 +27,8 @@ def connected(client):
 def disconnected(client):
   print('Disconnected from Adafruit IO!')
 
-class qliot(minqlx.Plugin):
+class qliot(chat_output.Buffered, instrumentation.Instrumented,
+            minqlx.Plugin):
   def __init__(self):
     self.add_hook('player_loaded', self.handle_player_loaded)
     self.add_hook('player_disconnect', self.handle_player_disconnect)
@@ -3,10 +3,21 @@ import itertools
 import json
 import minqlx
 import os
-import re
 import threading
 import time
 
+if __package__:
+  # Loaded by minqlx, as <plugins_dir>.<name>.
+  from . import chat_output
+  from . import instrumentation
+  from . import persistence
+  from . import player_names
+else:
+  import chat_output
+  import instrumentation
+  import persistence
+  import player_names
+
 HEADER_COLOR_STRING = '^2'
 JSON_FILE_NAME = 'timba_credits.json'
 ROOT_PATH = os.path.dirname(os.path.realpath(__file__))
@@ -16,7 +27,8 @@ INTERESTING_GAME_TYPES = ['ad', 'ctf']
 BETTING_WINDOW_SECS = 30
 
 
-class timba(minqlx.Plugin):
+class timba(chat_output.Buffered, instrumentation.Instrumented,
+            minqlx.Plugin):
 
   def __init__(self):
     self.betting_timer = None
@@ -26,14 +38,13 @@ class timba(minqlx.Plugin):
     self.current_bets = {}
     # dict: {player_id: credits, ...}
     self.credits = {}
-    # dict: {player_id: clean_name, ...}
-    self.names_by_id = {}
     self.load_credits()
 
     self.add_command('timba', self.cmd_timba, 3)
     self.add_hook('game_countdown', self.handle_game_countdown)
     self.add_hook('game_start', self.handle_game_start)
     self.add_hook('game_end', self.handle_game_end)
+    self.add_hook('unload', self.handle_unload)
 
   def print_log(self, msg):
     self.msg('%sTimba:^7 %s' % (HEADER_COLOR_STRING, msg))
@@ -52,10 +63,6 @@ class timba(minqlx.Plugin):
   def is_betting_window_open(self):
     return self.betting_timer and self.betting_timer.is_alive()
 
-  def get_clean_name(self, name):
-    return re.sub(r'([\W]*\]v\[[\W]*|^\W+|\W+$|[^a-zA-Z0-9\ ]+.+\W$)', '',
-                  name).lower().strip()
-
   def get_current_bets(self):
     return self.current_bets
 
@@ -66,6 +73,7 @@ class timba(minqlx.Plugin):
     return self.betting_timer
 
   def load_credits(self):
+    persistence.flush(JSON_FILE_PATH)
     try:
       credits = json.loads(open(JSON_FILE_PATH).read())
       for key, value in credits.items():
@@ -77,10 +85,13 @@ class timba(minqlx.Plugin):
       self.print_error('Could not load credits (%s)' % e)
 
   def save_credits(self):
-    open(JSON_FILE_PATH,
-         'w+').write(json.dumps(self.credits, sort_keys=True, indent=2))
+    persistence.save(JSON_FILE_PATH,
+                     json.dumps(self.credits, sort_keys=True, indent=2))
     self.print_log('Credits saved.')
 
+  def handle_unload(self, plugin):
+    persistence.flush()
+
   def print_bets(self, bets, winners, losers):
     self.print_header('Bets for this game:')
     if bets:
@@ -88,7 +99,7 @@ class timba(minqlx.Plugin):
         # for player_id, bet in self.current_bets.items():
         bet = bets[player_id]
         amount = bet['amount'] if player_id in winners else -bet['amount']
-        clean_name = self.get_clean_name(self.names_by_id[player_id])
+        clean_name = player_names.DIRECTORY.get(player_id)
         amount_color = '^2' if player_id in winners else '^1'
         msg_string = '^5%30s^7 : %s%5d^7 on %-4s' % (clean_name, amount_color,
                                                      amount, bet['team'])
@@ -257,7 +268,7 @@ class timba(minqlx.Plugin):
       return
 
     player_id = player.steam_id
-    self.names_by_id[player_id] = self.get_clean_name(player.clean_name)
+    player_names.DIRECTORY.add(player)
     current_credits = self.credits.setdefault(player_id, STARTING_CREDITS)
 
     if not self.is_betting_window_open():
@@ -2,6 +2,7 @@ import copy
 import datetime
 import json
 import minqlx_fake
+import persistence_fake
 import sys
 import unittest
 
@@ -10,6 +11,7 @@ from unittest.mock import patch
 from unittest.mock import MagicMock
 
 sys.modules['minqlx'] = minqlx_fake
+sys.modules['persistence'] = persistence_fake
 import timba
 
 PLAYER_ID_MAP = {
@@ -102,7 +104,7 @@ class TestTimba(unittest.TestCase):
     self.assertEqual(['timba'],
                      [cmd[0] for cmd in minqlx_fake.Plugin.registered_commands])
 
-    self.assertEqual(['game_countdown', 'game_start', 'game_end'],
+    self.assertEqual(['game_countdown', 'game_start', 'game_end', 'unload'],
                      [hook[0] for hook in minqlx_fake.Plugin.registered_hooks])
 
   @patch('builtins.open', mock_open(read_data=CREDITS_JSON))
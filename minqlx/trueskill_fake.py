@@ -1,6 +1,10 @@
 import copy
 
 MU = 25
+SIGMA = MU / 3.0
+BETA = SIGMA / 2.0
+TAU = SIGMA / 100.0
+DRAW_PROBABILITY = 0.10
 
 
 class Rating(object):
@@ -34,3 +38,13 @@ def quality(ratings):
   sum_a = sum([r.mu for r in ratings[0]])
   sum_b = sum([r.mu for r in ratings[1]])
   return min(sum_a, sum_b) / max(sum_a, sum_b)
+
+
+class TrueSkill(object):
+
+  def __init__(self, beta=BETA):
+    self.beta = beta
+
+
+def global_env():
+  return TrueSkill()